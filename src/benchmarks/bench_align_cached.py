@@ -0,0 +1,66 @@
+"""
+Alignment from a station calibration against searching from home
+
+    cd src
+    python -m benchmarks.bench_align_cached [max drift]
+
+Every alignment starts a new System from the calibration file the last
+one left behind, like restarting the server between runs.
+"""
+
+import logging
+import tempfile
+from pathlib import Path
+
+from rit import processing
+from rit.calibration import StationCalibration
+from rit.cam import HqCamera
+from rit.cam_emulator import CameraEmulator, CardScene, HQ_SIZE
+from rit.emulator import StageEmulator
+from rit.stage import Stage
+from rit.system import System
+
+
+def main(args):
+    max_drift = int(args[1]) if len(args) >= 2 else 100
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger(processing.__name__).setLevel(logging.WARNING)
+
+    scene = CardScene(edge=5000, noise=1.0, ring=20, ring_time=0.05)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "station.pos"
+        path.write_text(StationCalibration.HEADER + "\n")
+
+        def align(name: str, emulator: StageEmulator, card_edge: int, verify: bool = True):
+            scene.edge = card_edge
+            stage = Stage(emulator.serial())
+            hq = HqCamera(-1, backend=CameraEmulator(HQ_SIZE, scene, emulator.physical_position, latency=0.1))
+            system = System(stage, hq, None, calibration=StationCalibration.open(path))
+
+            for _ in system.align(coarse_n=300, step_delay=0.5, verify=verify, max_drift=max_drift):
+                pass
+            stats = system.align_stats
+            print(f"{name:<36} {stats.strategy:<10} {stats.iterations:3d} frames {stats.travel:6d} eighths "
+                  f"{stats.time:6.2f}s, off by {emulator.physical_position() - card_edge:+d} eighths, "
+                  f"drift {system.calibration.drift}")
+
+        with StageEmulator(travel=16000, start=1000) as emulator:
+            align("no calibration yet", emulator, 5000)
+            align("same card, searching from home", emulator, 5000, verify=False)
+            align("same card", emulator, 5000)
+            align(f"card moved {max_drift // 2}", emulator, 5000 + max_drift // 2)
+            align(f"card moved {max_drift * 4}", emulator, 5000 + max_drift * 4)
+
+        # Power cycled, the position has to be found from home again
+        with StageEmulator(travel=16000, start=1000) as emulator:
+            align("stage power cycled", emulator, 5000 + max_drift * 4)
+
+        print(path.read_text())
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,67 @@
+"""
+Per step cost of alignment frames: RGB stream frames versus the lores Y plane
+
+    cd src
+    python -m benchmarks.bench_align_frames [iterations]
+"""
+
+import time
+
+import cv2
+
+from rit import processing
+from rit.cam import Camera
+from rit.cam_emulator import CardScene
+
+
+def run(name: str, fn, nbytes: int, number: int):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    elapsed = (time.perf_counter() - start) / number
+    print(f"{name:<36} {elapsed * 1e3:8.3f} ms/frame {nbytes / 1e6:8.3f} MB/frame")
+
+
+def main(args):
+    number = int(args[1]) if len(args) >= 2 else 200
+
+    scene = CardScene(edge=3000, noise=1.0)
+    position = 2800
+
+    # What the stream hands over in each mode (XBGR8888 main, YUV420 lores)
+    w, h = Camera.ALIGN_MAIN_SIZE
+    xbgr = cv2.cvtColor(scene.render((w, h), position), cv2.COLOR_RGB2RGBA)
+    lw, lh = Camera.ALIGN_SIZE
+    yuv = cv2.cvtColor(scene.render((lw, lh), position), cv2.COLOR_RGB2YUV_I420)
+
+    def rgb_path():
+        img = cv2.cvtColor(xbgr, cv2.COLOR_BGR2RGB)
+        return processing.detect_card_edge(img, 12, 100, 100, 0.5)
+
+    def luma_path():
+        img = yuv[:lh, :lw].copy()
+        return processing.detect_card_edge_luma(img, 12, 100, 100, 0.5)
+
+    def rgb_prepare():
+        img = cv2.cvtColor(xbgr, cv2.COLOR_BGR2RGB)
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(img, (lw, lh))
+
+    def luma_prepare():
+        return yuv[:lh, :lw].copy()
+
+    print(f"edge (rgb)  {rgb_path()[0]:.4f}")
+    print(f"edge (luma) {luma_path()[0]:.4f}")
+
+    run(f"RGB stream {w}x{h} preparation", rgb_prepare, xbgr.nbytes + w * h * 3, number)
+    run(f"lores Y plane {lw}x{lh} preparation", luma_prepare, lw * lh, number)
+    run(f"RGB stream {w}x{h} total", rgb_path, xbgr.nbytes + w * h * 3, number)
+    run(f"lores Y plane {lw}x{lh} total", luma_path, lw * lh, number)
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
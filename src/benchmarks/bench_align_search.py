@@ -0,0 +1,56 @@
+"""
+Frames and time System.align takes to find the card edge with each search
+
+    cd src
+    python -m benchmarks.bench_align_search [card edge]
+
+Linear steps forward from home, galloping starts from where the edge was
+last aligned (the next card sits a little further along) or from the middle
+of where the card holder can put the edge.
+"""
+
+import logging
+
+from rit import processing
+from rit.cam import HqCamera
+from rit.cam_emulator import CameraEmulator, CardScene, HQ_SIZE
+from rit.emulator import StageEmulator
+from rit.stage import Stage
+from rit.system import System
+
+
+def main(args):
+    edge = int(args[1]) if len(args) >= 2 else 5000
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger(processing.__name__).setLevel(logging.WARNING)
+
+    scene = CardScene(edge=edge, noise=1.0, ring=20, ring_time=0.05)
+    with StageEmulator(travel=16000, start=1000) as emulator:
+        stage = Stage(emulator.serial())
+        hq = HqCamera(-1, backend=CameraEmulator(HQ_SIZE, scene, emulator.physical_position, latency=0.1))
+
+        def align(name: str, system: System, card_edge: int):
+            scene.edge = card_edge
+            for _ in system.align(coarse_n=300, step_delay=0.5):
+                pass
+            stats = system.align_stats
+            print(f"{name:<32} {stats.strategy:<10} {stats.iterations:3d} frames {stats.moves:3d} moves "
+                  f"{stats.travel:6d} eighths {stats.time:6.2f}s, "
+                  f"off by {emulator.physical_position() - card_edge:+d} eighths")
+
+        system = System(stage, hq, None)
+        align("first card", system, edge)
+        align("next card, 250 further", system, edge + 250)
+        align("next card, 2500 further", system, edge + 2750)
+        align("next card, 2000 closer", system, edge + 750)
+
+        system = System(stage, hq, None, edge_range=(1000, 12000))
+        align("card holder geometry", system, edge)
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,80 @@
+"""
+Concurrent frame requests with and without the frame broker
+
+    cd src
+    python -m benchmarks.bench_broker [clients] [requests]
+
+Every client asks for still frames back to back. Without the broker
+each request captures its own frame under the camera lock, with it
+requests made while a capture is pending share the next one.
+A slow stream consumer shows the frames it skips.
+"""
+
+import logging
+import threading
+import time
+
+from rit.broker import FrameBroker
+from rit.cam import HqCamera, CameraMode
+from rit.cam_emulator import CameraEmulator, CardScene, HQ_SIZE
+
+
+def run(name: str, camera: HqCamera, clients: int, requests: int, acquire):
+    frames = camera.camera.frames
+    latencies = []
+
+    def client():
+        for _ in range(requests):
+            start = time.perf_counter()
+            acquire()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{name:<10} {clients * requests} requests, {camera.camera.frames - frames} captures in {elapsed:.2f}s, "
+          f"latency p50 {latencies[len(latencies) // 2] * 1e3:.0f} ms max {latencies[-1] * 1e3:.0f} ms")
+
+
+def main(args):
+    clients = int(args[1]) if len(args) >= 2 else 8
+    requests = int(args[2]) if len(args) >= 3 else 5
+    logging.basicConfig(level=logging.WARNING)
+
+    camera = HqCamera(-1, backend=CameraEmulator(HQ_SIZE, CardScene(), latency=0.05))
+
+    def locked():
+        with camera:
+            camera.acquire_array()
+
+    run("locked", camera, clients, requests, locked)
+
+    with FrameBroker(camera) as broker:
+        run("broker", camera, clients, requests, lambda: broker.capture(CameraMode.STILL))
+
+        # A consumer slower than the camera only ever sees the latest frame
+        with broker.subscribe(CameraMode.STREAM) as subscription:
+            seen = 0
+            end = time.monotonic() + 2.0
+            while time.monotonic() < end:
+                subscription.get(timeout=1.0)
+                seen += 1
+                time.sleep(0.15)
+            print(f"stream     slow consumer saw {seen} frames, skipped {subscription.dropped}")
+
+        print(f"broker     {broker.dict()}")
+
+    camera.close()
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,67 @@
+"""
+Card ID capture from the full AUX frame against the hardware ROI
+
+    cd src
+    python -m benchmarks.bench_card_id [iterations]
+
+Only the host side is timed: converting the frame out of the camera
+buffer and preparing it for OCR. The sensor readout and transfer the
+ROI saves on the hardware are shown as the frame size.
+"""
+
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from rit import processing
+from rit.cam import AuxCamera, CardIdRoi
+from rit.cam_emulator import CardIdScene
+
+CROP = (1, 1150, 1300, 600, 1250)
+
+
+def run(name: str, fn, frame: np.ndarray, number: int):
+    best = float("inf")
+    for _ in range(number):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<24} {frame.shape[1]}x{frame.shape[0]} {frame.nbytes / 1e6:8.2f} MB {best * 1e3:8.2f} ms")
+    return result
+
+
+def main(args):
+    number = int(args[1]) if len(args) >= 2 else 20
+
+    # There is no OCR to compare without tesseract, only the preparation
+    logging.getLogger("rit.processing").setLevel(logging.ERROR)
+
+    roi = CardIdRoi(AuxCamera.STILL_SIZE, *CROP)
+    x, y, w, h = roi.region
+    print(f"ScalerCrop region {roi.region} read out at {roi.size}")
+
+    # Frames as the camera hands them out, the ROI one is what the ISP scales the crop to
+    full = CardIdScene().render(AuxCamera.STILL_SIZE, None)
+    small = cv2.resize(full[y:y + h, x:x + w], roi.size, interpolation=cv2.INTER_AREA)
+
+    def full_frame():
+        img = cv2.cvtColor(full, cv2.COLOR_BGR2RGB)
+        return processing.card_id(img, *CROP)[1]
+
+    def roi_frame():
+        img = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        return roi.card_id(img)[1]
+
+    a = run("full frame", full_frame, full, number)
+    b = run("ROI", roi_frame, small, number)
+    assert a.shape == b.shape
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
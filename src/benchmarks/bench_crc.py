@@ -0,0 +1,75 @@
+"""
+Benchmarks for the CRC8 engine
+
+    cd src
+    python -m benchmarks.bench_crc [frames]
+"""
+
+import os
+import time
+
+import numpy as np
+
+from rit.crc import CRC8_TABLE, crc8, Crc8, crc8_bulk, crc8_check_frames
+
+
+def legacy_crc8(m: bytes):
+    """
+    CRC8 before the table was bound locally
+    """
+    crc = 0xFF
+    for c in m:
+        crc = CRC8_TABLE[crc ^ c] & 0xFF
+    return crc & 0xFF
+
+
+def run(name: str, fn, nbytes: int, repeat: int = 5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<40} {best * 1e3:10.3f} ms {nbytes / best / 1e6:10.2f} MB/s")
+
+
+def main(args):
+    nframes = int(args[1]) if len(args) >= 2 else 10000
+
+    # Captured serial log of back-to-back 12 byte frames
+    log = bytearray(os.urandom(nframes * 12))
+    for i in range(nframes):
+        log[i * 12 + 9] = crc8(log[i * 12:i * 12 + 9])
+    log = bytes(log)
+    frames = np.frombuffer(log, dtype=np.uint8).reshape(nframes, 12)
+
+    assert crc8_check_frames(log, 12, 9).all()
+    assert legacy_crc8(log) == crc8(log)
+
+    def legacy_frames():
+        return [legacy_crc8(log[i:i + 9]) == log[i + 9] for i in range(0, len(log), 12)]
+
+    def scalar_frames():
+        return [crc8(log[i:i + 9]) == log[i + 9] for i in range(0, len(log), 12)]
+
+    def incremental():
+        crc = Crc8()
+        for i in range(0, len(log), 64):
+            crc.update(log[i:i + 64])
+        return crc.value
+
+    print(f"{nframes} frames, {len(log)} bytes")
+    run("legacy crc8 per frame", legacy_frames, nframes * 9)
+    run("crc8 per frame", scalar_frames, nframes * 9)
+    run("crc8_bulk (N, 9)", lambda: crc8_bulk(frames[:, :9]), nframes * 9)
+    run("crc8_check_frames", lambda: crc8_check_frames(log, 12, 9), nframes * 9)
+    run("legacy crc8 stream", lambda: legacy_crc8(log), len(log))
+    run("crc8 stream", lambda: crc8(log), len(log))
+    run("Crc8.update stream (64 byte chunks)", incremental, len(log))
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,76 @@
+"""
+Card edge detection over a stack of frames, one at a time against batched
+
+    cd src
+    python -m benchmarks.bench_edge_batch [frames]
+
+Frames sweep the card edge across the view like a scan alignment does,
+most of them are of the background either side of the card.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from rit import processing
+from rit.cam import Camera, HqCamera
+from rit.cam_emulator import CardScene
+
+
+def run(name: str, fn, n: int, repeat: int = 5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"  {name:<36} {best * 1e3:9.1f} ms {n / best:9.0f} frames/s")
+    return result
+
+
+def compare(name: str, size, n: int):
+    scene = CardScene(edge=3000, noise=2.0)
+    frames = np.stack([cv2.cvtColor(scene.render(size, p), cv2.COLOR_RGB2GRAY)
+                       for p in np.linspace(0, 6000, n).astype(int)])
+    print(f"{name}: {n} frames {size[0]}x{size[1]}")
+
+    def luma():
+        return [processing.detect_card_edge_luma(img)[0] for img in frames]
+
+    def pyramid():
+        return [processing.detect_card_edge_pyramid(img)[0] for img in frames]
+
+    run("detect_card_edge_luma", luma, n)
+    single = run("detect_card_edge_pyramid", pyramid, n)
+    with ThreadPoolExecutor(1) as pool:
+        run("detect_card_edges, 1 thread", lambda: processing.detect_card_edges(frames, executor=pool), n)
+    with ThreadPoolExecutor(os.cpu_count()) as pool:
+        positions, _, _ = run(f"detect_card_edges, {os.cpu_count()} threads",
+                              lambda: processing.detect_card_edges(frames, executor=pool), n)
+
+    single = np.array([np.nan if p is None else p for p in single])
+    assert np.array_equal(np.isnan(single), np.isnan(positions))
+    assert np.allclose(single[~np.isnan(single)], positions[~np.isnan(positions)])
+    print(f"  {np.count_nonzero(~np.isnan(positions))} frames with an edge, same positions")
+
+
+def main(args):
+    n = int(args[1]) if len(args) >= 2 else 400
+
+    # Rejected fits log every time
+    logging.getLogger(processing.__name__).setLevel(logging.WARNING)
+
+    compare("lores Y plane", Camera.ALIGN_SIZE, n)
+    compare("HQ still", (int(HqCamera.STILL_SIZE[0] * processing.EDGE_SCALE),
+                         int(HqCamera.STILL_SIZE[1] * processing.EDGE_SCALE)), n // 10 or 1)
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
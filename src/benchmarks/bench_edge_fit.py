@@ -0,0 +1,94 @@
+"""
+Card edge line fit residuals against the image rotation they replaced
+
+    cd src
+    python -m benchmarks.bench_edge_fit [iterations]
+
+Runs at the working resolution of detect_card_edge on HQ stills
+(EDGE_SCALE times 4056x3040).
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from rit import processing
+from rit.cam import HqCamera
+from rit.cam_emulator import CardScene
+
+
+def legacy_compute_error(img: np.ndarray, vx: float, vy: float, cx: float, cy: float, dsize=None):
+    """
+    compute_error before the residuals were computed in closed form,
+    dsize defaults to the (h, w) it used to pass by mistake
+    """
+    v = np.array([vx, vy])
+    p = np.array([cx, cy])
+    theta = np.arccos(np.dot(v, [0, 1]) / np.linalg.norm(v))
+    r = cv2.getRotationMatrix2D((cx, cy), -180 / np.pi * theta, 1.0)
+    rot_img = cv2.warpAffine(img, r, dsize or img.shape[0:2], flags=cv2.INTER_LINEAR)
+    points = cv2.findNonZero(rot_img).reshape(-1, 2)
+    err = (points - p)[:, 0] ** 2
+    return np.sqrt(np.einsum('i,i->', err, err) / len(points)), theta
+
+
+def run(name: str, fn, number: int):
+    best = float("inf")
+    for _ in range(number):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<36} {best * 1e3:8.3f} ms")
+    return result
+
+
+def edge_points(scene: CardScene, size, position: int):
+    img = cv2.cvtColor(scene.render(size, position), cv2.COLOR_RGB2GRAY)
+    img = cv2.convertScaleAbs(cv2.Laplacian(cv2.blur(img, (10, 10)), cv2.CV_16S, ksize=3))
+    _, img = cv2.threshold(img, 12, 255, cv2.THRESH_BINARY)
+    return img, cv2.findNonZero(img)
+
+
+def main(args):
+    number = int(args[1]) if len(args) >= 2 else 20
+
+    w, h = (int(HqCamera.STILL_SIZE[0] * processing.EDGE_SCALE), int(HqCamera.STILL_SIZE[1] * processing.EDGE_SCALE))
+    scene = CardScene(edge=3000, noise=2.0)
+
+    img, points = edge_points(scene, (w, h), 3000)
+    vx, vy, cx, cy = processing.fit_line(points)
+    print(f"{w}x{h}, {len(points)} edge points, edge at x={cx:.1f}")
+
+    old, _ = run("legacy compute_error", lambda: legacy_compute_error(img, vx, vy, cx, cy), number)
+    fixed, _ = run("legacy compute_error (w, h)", lambda: legacy_compute_error(img, vx, vy, cx, cy, (w, h)), number)
+    new, _ = run("compute_error (findNonZero)", lambda: processing.compute_error(img, vx, vy, cx, cy), number)
+    run("compute_error (points)", lambda: processing.compute_error(img, vx, vy, cx, cy, points), number)
+    print(f"error: legacy {old:.3f}, legacy (w, h) {fixed:.3f}, closed form {new:.3f}")
+
+    # The legacy output was h pixels wide, an edge right of that got cropped away
+    right, right_points = edge_points(scene, (w, h), 3400)
+    vx, vy, cx, cy = processing.fit_line(right_points)
+    try:
+        legacy = f"{legacy_compute_error(right, vx, vy, cx, cy)[0]:.3f}"
+    except AttributeError:
+        legacy = "no points left"
+    print(f"edge at x={cx:.1f}: legacy {legacy}, closed form {processing.compute_error(right, vx, vy, cx, cy)[0]:.3f}")
+
+    # Speckles off the card the robust fits should ignore, a quarter of the points
+    rng = np.random.default_rng(1)
+    speckles = img.copy()
+    speckles[rng.integers(0, h, len(points) // 3), rng.integers(0, w // 3, len(points) // 3)] = 255
+    noisy = cv2.findNonZero(speckles)
+    for fit in processing.EDGE_FITS:
+        vx, vy, cx, cy = run(f"fit_line {fit}", lambda: processing.fit_line(noisy, fit), number)
+        rms = np.sqrt(np.mean(processing.line_residuals(points, vx, vy, cx, cy) ** 2))
+        print(f"{'':<4}{fit}: x at mid height {cx + (h / 2 - cy) * vx / vy:.1f}, rms on the edge {rms:.2f} px")
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,88 @@
+"""
+Coarse to fine card edge detection against fitting the whole frame
+
+    cd src
+    python -m benchmarks.bench_edge_pyramid [iterations]
+
+Runs on the lores Y plane System.align detects edges on, and on HQ
+stills at the working resolution of detect_card_edge.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from rit import processing
+from rit.cam import Camera, HqCamera
+from rit.cam_emulator import CardScene
+from rit.system import IM_WIDTH_PER_EIGHTH_STEP
+
+
+def run(name: str, fn, number: int):
+    best = float("inf")
+    for _ in range(number):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<40} {best * 1e3:8.3f} ms")
+    return result
+
+
+def frames(scene: CardScene, size, positions):
+    return [cv2.cvtColor(scene.render(size, p), cv2.COLOR_RGB2GRAY) for p in positions]
+
+
+def compare(name: str, size, number: int):
+    scene = CardScene(edge=3000, noise=2.0)
+    print(f"{name} {size[0]}x{size[1]}")
+
+    # Card well out of view, what most coarse alignment steps see
+    empty = frames(scene, size, [0])[0]
+    run("  luma, no edge", lambda: processing.detect_card_edge_luma(empty), number)
+    run("  pyramid, no edge", lambda: processing.detect_card_edge_pyramid(empty), number)
+
+    edge = frames(scene, size, [2900])[0]
+    run("  luma, edge", lambda: processing.detect_card_edge_luma(edge), number)
+    run("  pyramid, edge", lambda: processing.detect_card_edge_pyramid(edge), number)
+
+    # Both should put the edge in the same place across the frame
+    positions = list(range(2600, 3400, 40))
+    worst = 0.0
+    missed = 0
+    confidence = []
+    for p, img in zip(positions, frames(scene, size, positions)):
+        luma, _ = processing.detect_card_edge_luma(img)
+        pyramid, _, c = processing.detect_card_edge_pyramid(img)
+        if luma is None or pyramid is None:
+            missed += (luma is None) != (pyramid is None)
+            continue
+        worst = max(worst, abs(luma - pyramid))
+        confidence.append(c)
+
+    print(f"  {len(positions)} positions: {missed} found by only one, "
+          f"worst difference {worst / IM_WIDTH_PER_EIGHTH_STEP:.2f} eighth steps, "
+          f"confidence {min(confidence):.2f} - {max(confidence):.2f}")
+
+
+def main(args):
+    number = int(args[1]) if len(args) >= 2 else 50
+
+    compare("lores Y plane", Camera.ALIGN_SIZE, number)
+    compare("HQ still", (int(HqCamera.STILL_SIZE[0] * processing.EDGE_SCALE),
+                         int(HqCamera.STILL_SIZE[1] * processing.EDGE_SCALE)), number // 5 or 1)
+
+    # A second edge off the card, the strongest step still wins
+    scene = CardScene(edge=3000, noise=2.0)
+    img = frames(scene, Camera.ALIGN_SIZE, [3000])[0]
+    img[:, :20] = np.clip(img[:, :20].astype(int) + 60, 0, 255)
+    pos, _, c = processing.detect_card_edge_pyramid(img)
+    print(f"with a second step: edge @{pos:.3f}, confidence {c:.2f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,69 @@
+"""
+Benchmark of frame conversion with and without the frame pool
+Simulates the HQ still buffer (4056x3040 BGR888 with row padding)
+since picamera2 is only available on the Pi.
+
+    cd src
+    python -m benchmarks.bench_frames [frames]
+"""
+
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from rit.cam import FramePool
+
+WIDTH, HEIGHT = 4056, 3040
+
+# libcamera pads rows to a multiple of 64 bytes
+STRIDE = (WIDTH * 3 + 63) // 64 * 64
+
+
+def legacy(buffer: np.ndarray) -> np.ndarray:
+    """
+    capture_array() copies the frame without its padding, then cvtColor allocates again
+    """
+    img = np.asarray(buffer.reshape(HEIGHT, STRIDE)[:, :WIDTH * 3], order="C").reshape(HEIGHT, WIDTH, 3)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def pooled(buffer: np.ndarray, pool: FramePool):
+    img = buffer.reshape(HEIGHT, STRIDE)[:, :WIDTH * 3].reshape(HEIGHT, WIDTH, 3)
+    lease = pool.lease()
+    cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=lease.array)
+    return lease
+
+
+def run(name: str, fn, frames: int):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {elapsed / frames * 1e3:8.1f} ms/frame {peak / 1e6:8.1f} MB peak allocated")
+
+
+def main(args):
+    frames = int(args[1]) if len(args) >= 2 else 10
+
+    buffer = np.random.randint(0, 255, HEIGHT * STRIDE, dtype=np.uint8)
+    pool = FramePool((HEIGHT, WIDTH, 3), size=3)
+
+    lease = pooled(buffer, pool)
+    assert np.array_equal(lease.array, legacy(buffer))
+    lease.release()
+
+    run("legacy", lambda: legacy(buffer), frames)
+    run("pooled", lambda: pooled(buffer, pool).release(), frames)
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,84 @@
+"""
+Microbenchmarks for the stage packet codec
+
+    cd src
+    python -m benchmarks.bench_packet [iterations]
+"""
+
+import struct
+import timeit
+
+from rit.crc import crc8
+from rit.stage import StagePacket, StageOpcode, StageFlags, StageFrameParser
+
+
+def legacy_encode(pkt: StagePacket) -> bytes:
+    """
+    Packet encoder before the codec used precompiled structs
+    """
+    packet_start = struct.pack(
+        f"<BBH{'i' if type(pkt.arg) is int else 'f'}B",
+        0xDE, 0xAD,
+        pkt.opcode,
+        pkt.arg,
+        pkt.flags)
+
+    return packet_start + struct.pack(
+        "BBB", crc8(packet_start), 0xBE, 0xEF)
+
+
+def legacy_decode(m: bytes):
+    """
+    Packet decoder before the codec used precompiled structs
+    """
+    s1, s2, opcode, arg, flags, xsum, e1, e2 = struct.unpack("BBHiBBBB", m)
+
+    assert s1 == 0xDE and s2 == 0xAD, (hex(s1), hex(s2))
+    assert e1 == 0xBE and e2 == 0xEF, (hex(e1), hex(e2))
+
+    crc8(m[:9])
+    return StagePacket(opcode, arg, flags)
+
+
+def run(name: str, stmt, number: int):
+    t = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<32} {t / number * 1e9:10.1f} ns/op")
+
+
+def main(args):
+    number = int(args[1]) if len(args) >= 2 else 100000
+
+    int_pkt = StagePacket(StageOpcode.RELATIVE, 350, StageFlags.MOTOR_IS_REVERSED | 2)
+    float_pkt = StagePacket(StageOpcode.LED_PWM, 0.2)
+    reply = int_pkt.encode()
+    buf = bytearray(StagePacket.SIZE)
+    out = StagePacket(StageOpcode.IDLE)
+    parser = StageFrameParser()
+    noisy = b"\x00\xDE" + reply[:5] + reply
+
+    assert legacy_encode(int_pkt) == reply
+    assert legacy_encode(float_pkt) == float_pkt.encode()
+
+    run("crc8 (9 bytes)", lambda: crc8(reply[:9]), number)
+
+    run("legacy encode (int)", lambda: legacy_encode(int_pkt), number)
+    run("encode (int)", int_pkt.encode, number)
+    run("encode_into (int)", lambda: int_pkt.encode_into(buf), number)
+
+    run("legacy encode (float)", lambda: legacy_encode(float_pkt), number)
+    run("encode (float)", float_pkt.encode, number)
+    run("encode_into (float)", lambda: float_pkt.encode_into(buf), number)
+
+    run("legacy decode", lambda: legacy_decode(reply), number)
+    run("decode", lambda: StagePacket.decode(reply), number)
+    run("decode_into", lambda: StagePacket.decode_into(reply, out), number)
+    run("parser feed", lambda: parser.feed(reply), number)
+    run("parser feed (resync)", lambda: parser.feed(noisy), number)
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
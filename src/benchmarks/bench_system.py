@@ -0,0 +1,103 @@
+"""
+End to end alignment and card capture against the stage and camera emulators
+
+    cd src
+    python -m benchmarks.bench_system [cards]
+"""
+
+import logging
+import time
+
+from rit import processing
+from rit.cam import HqCamera, AuxCamera
+from rit.cam_emulator import CameraEmulator, CardScene, CardIdScene, HQ_SIZE, AUX_SIZE
+from rit.emulator import StageEmulator
+from rit.stage import Stage, StageStepSize
+from rit.system import System, CaptureScheduler
+
+
+def main(args):
+    cards = int(args[1]) if len(args) >= 2 else 3
+    logging.basicConfig(level=logging.WARNING)
+
+    # The stage rings for a while after stopping, captures wait for it to settle
+    scene = CardScene(edge=3000, noise=1.0, ring=20, ring_time=0.05)
+    with StageEmulator(travel=16000, start=1000) as emulator:
+        stage = Stage(emulator.serial())
+        hq = HqCamera(-1, backend=CameraEmulator(HQ_SIZE, scene, emulator.physical_position, latency=0.1))
+        aux = AuxCamera(-1, backend=CameraEmulator(AUX_SIZE, CardIdScene(), latency=0.1))
+        system = System(stage, hq, aux)
+
+        for name, align in (("align", lambda: system.align(coarse_n=300, step_delay=0.5)),
+                            ("scan align", lambda: system.scan_align(scan_n=4000, settle_timeout=0.5))):
+            frames = hq.camera.frames
+            start = time.perf_counter()
+            run = align()
+            try:
+                while True:
+                    next(run)
+            except StopIteration:
+                pass
+            elapsed = time.perf_counter() - start
+            edge, _ = processing.detect_card_edge(hq.acquire_array())
+            print(f"{name}: {elapsed:.2f}s, {hq.camera.frames - frames} frames, edge at {edge:.3f} "
+                  f"(stage {emulator.physical_position()}, card edge {scene.edge})")
+
+        offsets = [350] * 6
+        card_id_position = 8200
+
+        def read_card_id(img):
+            return processing.card_id(img, 1, 1150, 1300, 600, 1250)[0]
+
+        def sequential():
+            # Sensors, then a cold AUX camera once the stage reached the card ID
+            frames = 0
+            for _ in system.single_card(2500, delay=0.5, speed=1500, stage_offsets=offsets,
+                                        step_size=StageStepSize.QUARTER):
+                frames += 1
+            system.approach_absolute(card_id_position, StageStepSize.QUARTER)
+            with aux:
+                card_id = read_card_id(aux.acquire_array())
+            aux.close()
+            return frames, card_id
+
+        # The scheduler reads the card ID out of a hardware crop
+        scheduler = CaptureScheduler(system)
+        roi = aux.set_card_id_roi(1, 1150, 1300, 600, 1250)
+
+        def scheduled():
+            scheduler.start()
+            try:
+                frames, card_id = scheduler.run(2500, offsets, StageStepSize.QUARTER, 0.5,
+                                                card_id_position, StageStepSize.QUARTER,
+                                                lambda i, frame: frame.release(),
+                                                lambda img: roi.card_id(img)[0])
+                return sum(1 for frame in frames if frame.result() is None), card_id.result()
+            finally:
+                scheduler.stop()
+
+        for name, capture in (("sequential", sequential), ("scheduled", scheduled)):
+            frames = 0
+            start = time.perf_counter()
+            for _ in range(cards):
+                n, card_id = capture()
+                frames += n
+            elapsed = time.perf_counter() - start
+            print(f"{name} capture: {cards} cards, {frames} frames in {elapsed:.2f}s "
+                  f"({frames / elapsed:.2f} frames/s, {elapsed / cards:.2f}s/card), card ID {card_id!r}")
+        print(f"scheduler: {scheduler.dict()}")
+        scheduler.close()
+        print(f"settle: {hq.settle.dict()}")
+        print(f"frames: {hq.frame_stats.dict()}")
+
+        hq.close()
+        aux.close()
+        stage.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,65 @@
+"""
+Alignment through the web app in dummy mode
+
+    cd src
+    python -m benchmarks.bench_web_dummy [timeout]
+
+Starts the app with WERFEN_DUMMY set, so the stage emulator and the
+emulated cameras stand in for the hardware, and aligns twice over
+/system/align: once searching from home and once verifying the
+calibration the first one left behind. Fails if either takes longer
+than the timeout, a hung alignment holds the HQ camera for good.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+def main(args):
+    timeout = float(args[1]) if len(args) >= 2 else 60.0
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["WERFEN_DUMMY"] = "1"
+        os.environ["WERFEN_CALIBRATION"] = str(Path(tmp) / "station.pos")
+
+        from fastapi.testclient import TestClient
+        from web.main import app
+
+        client = TestClient(app)
+        for name in ("from home", "verified"):
+            result = {}
+
+            def align():
+                result["response"] = client.post("/system/align", params={"coarse_n": 300})
+
+            start = time.monotonic()
+            thread = threading.Thread(target=align, daemon=True)
+            thread.start()
+            thread.join(timeout)
+            elapsed = time.monotonic() - start
+
+            if thread.is_alive():
+                print(f"{name}: still aligning after {timeout:.0f}s")
+                return 1
+
+            response = result["response"]
+            if response.status_code != 200:
+                print(f"{name}: {response.status_code} {response.text}")
+                return 1
+
+            stats = response.json()
+            print(f"{name:<10} {stats['strategy']:<10} {stats['iterations']:3d} frames "
+                  f"edge {stats['edge']} in {elapsed:.2f}s")
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -0,0 +1,300 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional, Dict, List, Deque
+
+import numpy as np
+
+from rit.cam import Camera, CameraMode
+
+log = logging.getLogger(__name__)
+
+
+class BrokerStats:
+    """
+    requests: one-shot frames asked for
+    captures: frames actually captured
+    delivered: frames handed to requesters and subscribers
+    dropped: frames a subscriber fell too far behind to see
+    """
+
+    requests: int
+    captures: int
+    delivered: int
+    dropped: int
+    errors: int
+
+    def __init__(self):
+        self.requests = 0
+        self.captures = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "captures": self.captures,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+class FrameRequest:
+    """
+    Requesters waiting on the next capture in a mode
+    """
+
+    future: Future
+    settle_timeout: float
+    requesters: int
+
+    def __init__(self):
+        self.future = Future()
+        self.settle_timeout = 0.0
+        self.requesters = 0
+
+
+class FrameSubscription:
+    """
+    Continuous frames from a FrameBroker
+    Only the latest depth frames are kept, a consumer falling behind
+    loses the oldest ones instead of holding up the camera or the
+    other consumers.
+    """
+
+    mode: CameraMode
+    depth: int
+    dropped: int
+
+    def __init__(self, broker: 'FrameBroker', mode: CameraMode, depth: int = 1):
+        self.broker = broker
+        self.mode = mode
+        self.depth = depth
+        self.dropped = 0
+        self.closed = False
+        self._frames: Deque[np.ndarray] = collections.deque(maxlen=depth)
+
+    def _put(self, frame: np.ndarray) -> bool:
+        """
+        Called with the broker condition held
+        :return: True if an older frame was dropped to make room
+        """
+        dropped = len(self._frames) == self.depth
+        if dropped:
+            self.dropped += 1
+        self._frames.append(frame)
+        return dropped
+
+    def get(self, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """
+        Wait for the next frame
+        :param timeout: seconds to wait, None to wait forever
+        :return: read only frame, None once the subscription is closed
+        """
+        with self.broker._cond:
+            if not self.broker._cond.wait_for(lambda: self._frames or self.closed, timeout):
+                raise TimeoutError(f"No frame within {timeout}s")
+            return self._frames.popleft() if self._frames else None
+
+    def close(self):
+        self.broker._unsubscribe(self)
+
+    def __iter__(self):
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
+
+    def __enter__(self) -> 'FrameSubscription':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FrameBroker:
+    """
+    Owns a camera and serves its frames to any number of consumers.
+    Every capture happens on the broker thread. Requests for a mode made
+    before a capture starts are all served by that one capture, and
+    subscribers to a mode share the same frames. The camera only switches
+    modes between captures. Code driving the camera itself for a while
+    (alignment, a card run) holds it with exclusive(), the broker captures
+    nothing until it is done.
+    """
+
+    # Wait before retrying after a failed capture for subscribers
+    ERROR_BACKOFF = 0.5
+
+    camera: Camera
+    stats: BrokerStats
+
+    def __init__(self, camera: Camera):
+        self.camera = camera
+        self.stats = BrokerStats()
+
+        self._cond = threading.Condition()
+        self._gate = threading.Lock()
+        self._requests: Dict[CameraMode, FrameRequest] = {}
+        self._subscriptions: List[FrameSubscription] = []
+
+        # Subscribed mode captured last, the others get their turn before it comes round again
+        self._stream_mode: Optional[CameraMode] = None
+
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"{self.camera.name}-broker", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            for subscription in self._subscriptions:
+                subscription.closed = True
+            self._subscriptions.clear()
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> 'FrameBroker':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Hold the camera, the broker waits for the current capture
+        to finish and then captures nothing until released
+        """
+        with self._gate:
+            yield self.camera
+
+    def capture(self,
+                mode: CameraMode = CameraMode.STILL,
+                settle_timeout: float = 0.0,
+                timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """
+        Get the next frame captured in a mode
+        The frame is shared with every other requester of the
+        same capture and must not be written to.
+        :param mode: camera mode to capture in
+        :param settle_timeout: wait up to this long (seconds) for the image to stop moving
+        :param timeout: seconds to wait for the frame, None to wait forever
+        """
+        with self._cond:
+            request = self._requests.get(mode)
+            if request is None:
+                request = self._requests[mode] = FrameRequest()
+            request.settle_timeout = max(request.settle_timeout, settle_timeout)
+            request.requesters += 1
+            self.stats.requests += 1
+            self._cond.notify_all()
+
+        return request.future.result(timeout)
+
+    def subscribe(self, mode: CameraMode = CameraMode.STREAM, depth: int = 1) -> FrameSubscription:
+        """
+        Receive every frame captured in a mode until the subscription is closed
+        :param mode: camera mode to capture in
+        :param depth: frames kept for a consumer that falls behind
+        """
+        subscription = FrameSubscription(self, mode, depth)
+        with self._cond:
+            self._subscriptions.append(subscription)
+            self._cond.notify_all()
+        return subscription
+
+    def _unsubscribe(self, subscription: FrameSubscription):
+        with self._cond:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+            subscription.closed = True
+            self._cond.notify_all()
+
+    def _next(self):
+        """
+        Pick what to capture next, one-shot requests before subscribers
+        Subscribed modes take turns, one capture each.
+        Called with the condition held.
+        """
+        if self._requests:
+            # Oldest mode asked for first
+            mode = next(iter(self._requests))
+            return mode, self._requests.pop(mode)
+
+        modes = list(dict.fromkeys(subscription.mode for subscription in self._subscriptions))
+        turn = modes.index(self._stream_mode) + 1 if self._stream_mode in modes else 0
+        self._stream_mode = modes[turn % len(modes)]
+        return self._stream_mode, None
+
+    def _capture(self, mode: CameraMode, settle_timeout: float) -> Optional[np.ndarray]:
+        self.camera.session.acquire(mode)
+        if mode == CameraMode.ALIGN:
+            return self.camera.acquire_luma(settle_timeout)
+        return self.camera.acquire_array(settle_timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or self._requests or self._subscriptions)
+                if not self._running:
+                    break
+
+            with self._gate:
+                # Requests made while waiting for the gate join this capture
+                with self._cond:
+                    if not self._requests and not self._subscriptions:
+                        continue
+                    mode, request = self._next()
+
+                try:
+                    frame = self._capture(mode, request.settle_timeout if request else 0.0)
+                except Exception as e:
+                    log.exception("%s camera capture failed", self.camera.name)
+                    with self._cond:
+                        self.stats.errors += 1
+                    if request:
+                        request.future.set_exception(e)
+                    else:
+                        time.sleep(self.ERROR_BACKOFF)
+                    continue
+
+            if frame is not None:
+                # Shared between every consumer
+                frame.flags.writeable = False
+
+            with self._cond:
+                self.stats.captures += 1
+                if request:
+                    self.stats.delivered += request.requesters
+                for subscription in self._subscriptions if frame is not None else ():
+                    if subscription.mode == mode:
+                        self.stats.delivered += 1
+                        self.stats.dropped += subscription._put(frame)
+                idle = not self._requests and not self._subscriptions
+                self._cond.notify_all()
+
+            if request:
+                request.future.set_result(frame)
+            if idle:
+                self.camera.stop()
+
+    def dict(self) -> dict:
+        with self._cond:
+            return {
+                "subscribers": len(self._subscriptions),
+                "waiting": sum(request.requesters for request in self._requests.values()),
+                **self.stats.dict(),
+            }
@@ -0,0 +1,105 @@
+import datetime
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+log = logging.getLogger(__name__)
+
+
+class StationCalibration:
+    """
+    Alignment of one station kept between runs
+    Stored as a .pos file, a "# CAL" header followed by one "key value"
+    line per field. A file with just the header has nothing aligned yet.
+
+    edge: eighth steps from the home limit the card edge was last aligned at
+    background: grey level of the frames at home
+    aligned: when the edge was last aligned or verified
+    drift: eighth steps the edge had moved by when last verified
+    """
+
+    HEADER = "# CAL"
+
+    path: Path
+    edge: Optional[int]
+    background: Optional[float]
+    aligned: Optional[datetime.datetime]
+    drift: Optional[int]
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.edge = None
+        self.background = None
+        self.aligned = None
+        self.drift = None
+
+    @classmethod
+    def open(cls, path: Union[str, Path]) -> 'StationCalibration':
+        """
+        Load a station's calibration, nothing aligned if the file does not exist yet
+        """
+        calibration = cls(path)
+        if not calibration.path.exists():
+            return calibration
+
+        with calibration.path.open() as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                key, _, value = line.partition(" ")
+                value = value.strip()
+                try:
+                    if key == "edge":
+                        calibration.edge = int(value)
+                    elif key == "background":
+                        calibration.background = float(value)
+                    elif key == "aligned":
+                        calibration.aligned = datetime.datetime.fromisoformat(value)
+                    elif key == "drift":
+                        calibration.drift = int(value)
+                except ValueError:
+                    log.warning("Ignoring bad %s %r in %s", key, value, calibration.path)
+
+        return calibration
+
+    def save(self):
+        """
+        Replace the file in one go so a crash never leaves half a calibration
+        """
+        lines = [self.HEADER]
+        for key in ("edge", "background", "aligned", "drift"):
+            value = getattr(self, key)
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            if value is not None:
+                lines.append(f"{key} {value}")
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+
+    def update(self, edge: int, background: Optional[float], drift: Optional[int] = None):
+        """
+        Record an alignment and save it
+        """
+        self.edge = edge
+        if background is not None:
+            self.background = background
+        self.drift = drift
+        self.aligned = datetime.datetime.now()
+        self.save()
+
+    def dict(self) -> dict:
+        return {
+            "path": str(self.path),
+            "edge": self.edge,
+            "background": self.background,
+            "aligned": self.aligned.isoformat() if self.aligned else None,
+            "drift": self.drift,
+        }
@@ -1,46 +1,556 @@
 import abc
+import collections
+import enum
+import queue
 import threading
+import time
+from typing import Optional, Tuple, Deque
 
 import cv2
 import numpy as np
 import logging
 import coloredlogs as coloredlogs
 
+from rit import processing
+
 coloredlogs.install(fmt='%(asctime)s,%(msecs)03d %(levelname)s %(message)s')
 log = logging.getLogger(__name__)
 
 
+class CameraMode(enum.Enum):
+    STILL = "still"
+    STREAM = "stream"
+    ALIGN = "align"
+    ROI = "roi"
+    PREVIEW = "preview"
+
+
+class CameraSession:
+    """
+    Keeps a camera running between acquisitions.
+    Picamera2 tears down and rebuilds the whole pipeline on every
+    configure(), so the session only reconfigures when a different
+    mode is asked for. Releasing the camera leaves it running in its
+    current mode unless keep_alive is turned off.
+    """
+
+    mode: Optional[CameraMode]
+    keep_alive: bool
+
+    switches: int
+    switch_time_total: float
+    switch_time_max: float
+    last_switch_time: float
+
+    def __init__(self, camera: 'Camera', keep_alive: bool = True):
+        self.camera = camera
+        self.keep_alive = keep_alive
+        self.mode = None
+        self._lock = threading.Lock()
+
+        self.switches = 0
+        self.switch_time_total = 0.0
+        self.switch_time_max = 0.0
+        self.last_switch_time = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    @property
+    def switch_time_mean(self) -> float:
+        return self.switch_time_total / self.switches if self.switches else 0.0
+
+    def acquire(self, mode: CameraMode) -> bool:
+        """
+        Get the camera running in a mode
+        :param mode: STILL, STREAM, ALIGN or ROI
+        :return: True if the pipeline had to be reconfigured
+        """
+        with self._lock:
+            if self.mode == mode:
+                return False
+
+            start = time.monotonic()
+            if self.camera.has_camera:
+                picam = self.camera.camera
+                if self.mode is not None:
+                    picam.stop()
+                picam.configure(self.camera.config(mode))
+                picam.set_controls({"AwbMode": 4})
+                picam.start()
+            self.mode = mode
+
+            elapsed = time.monotonic() - start
+            self.switches += 1
+            self.switch_time_total += elapsed
+            self.switch_time_max = max(self.switch_time_max, elapsed)
+            self.last_switch_time = elapsed
+            log.debug("%s camera switched to %s mode in %.3fs", self.camera.name, mode.value, elapsed)
+            return True
+
+    def release(self):
+        """
+        Done with the camera for now, only stops it without keep_alive
+        """
+        if not self.keep_alive:
+            self.close()
+
+    def close(self):
+        """
+        Stop the camera
+        """
+        with self._lock:
+            if self.mode is not None and self.camera.has_camera:
+                self.camera.camera.stop()
+            self.mode = None
+
+    def dict(self) -> dict:
+        return {
+            "mode": self.mode.value if self.mode else None,
+            "keep_alive": self.keep_alive,
+            "switches": self.switches,
+            "switch_time_mean": self.switch_time_mean,
+            "switch_time_max": self.switch_time_max,
+            "last_switch_time": self.last_switch_time,
+        }
+
+
+class FrameLease:
+    """
+    Frame buffer borrowed from a FramePool
+    Release it as soon as the image is no longer needed,
+    the buffer gets reused for a later frame.
+    """
+
+    __slots__ = ("array", "_pool")
+
+    array: np.ndarray
+
+    def __init__(self, pool: 'FramePool', array: np.ndarray):
+        self.array = array
+        self._pool = pool
+
+    def release(self):
+        if self._pool is not None:
+            self._pool._free.put(self.array)
+            self._pool = None
+
+    def __enter__(self) -> 'FrameLease':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FramePool:
+    """
+    Preallocated frame buffers handed out as leases
+    Leasing blocks while every buffer is out, which bounds
+    the memory held by frames waiting to be processed.
+    """
+
+    shape: Tuple[int, ...]
+    size: int
+
+    def __init__(self, shape: Tuple[int, ...], size: int = 3, dtype=np.uint8):
+        self.shape = shape
+        self.size = size
+
+        # Most recently released buffer first, it is more likely to still be cached
+        self._free: queue.LifoQueue = queue.LifoQueue()
+        for _ in range(size):
+            self._free.put(np.empty(shape, dtype=dtype))
+
+    @property
+    def available(self) -> int:
+        return self._free.qsize()
+
+    def lease(self, timeout: Optional[float] = None) -> FrameLease:
+        """
+        Borrow a buffer, waiting for one to be released if needed
+        :param timeout: seconds to wait, None to wait forever
+        """
+        try:
+            return FrameLease(self, self._free.get(timeout=timeout))
+        except queue.Empty:
+            raise TimeoutError(f"No frame buffer released within {timeout}s")
+
+
+class SettleStats:
+    """
+    Time the image took to settle before each capture
+    """
+
+    count: int
+    timeouts: int
+    total: float
+    max: float
+    recent: Deque[float]
+
+    def __init__(self, keep: int = 1000):
+        self.count = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=keep)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, elapsed: float, timed_out: bool):
+        self.count += 1
+        self.timeouts += timed_out
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.recent.append(elapsed)
+
+    def dict(self) -> dict:
+        recent = np.array(self.recent) if self.recent else np.zeros(1)
+        return {
+            "count": self.count,
+            "timeouts": self.timeouts,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": float(np.percentile(recent, 50)),
+            "p90": float(np.percentile(recent, 90)),
+            "recent": list(self.recent)[-20:],
+        }
+
+
+class Frame:
+    """
+    A captured image along with what the camera reported about it
+    Times are in seconds, timestamp is on the monotonic clock and marks the
+    middle of the exposure, where a moving stage was on average while the
+    frame was taken. Exposure and frame duration are in microseconds like
+    the Picamera2 metadata. Anything the camera did not report is None.
+    A frame converted into the camera's frame pool holds on to the buffer
+    until released.
+    """
+
+    __slots__ = ("array", "timestamp", "exposure_time", "analogue_gain", "frame_duration", "latency",
+                 "_request", "_lease")
+
+    array: Optional[np.ndarray]
+    timestamp: Optional[float]
+    exposure_time: Optional[int]
+    analogue_gain: Optional[float]
+    frame_duration: Optional[int]
+    latency: float
+
+    def __init__(self, array: Optional[np.ndarray], metadata: dict, latency: float):
+        """
+        :param array: image, None until converted
+        :param metadata: request metadata
+        :param latency: seconds the host waited for the frame, settling included
+        """
+        self.array = array
+        self.timestamp = self.timestamp_of(metadata)
+        self.exposure_time = metadata.get("ExposureTime")
+        self.analogue_gain = metadata.get("AnalogueGain")
+        self.frame_duration = metadata.get("FrameDuration")
+        self.latency = latency
+        self._request = None
+        self._lease: Optional[FrameLease] = None
+
+    @staticmethod
+    def timestamp_of(metadata: dict) -> Optional[float]:
+        """
+        Frame timestamp from request metadata, None if the camera did not report one
+        SensorTimestamp is the start of the exposure in nanoseconds on
+        CLOCK_MONOTONIC, the same clock as time.monotonic()
+        """
+        timestamp = metadata.get("SensorTimestamp")
+        if timestamp is None:
+            return None
+        return timestamp / 1e9 + (metadata.get("ExposureTime") or 0) / 2e6
+
+    def release(self):
+        """
+        Give back the camera or pool buffer the frame holds, if any
+        """
+        if self._request is not None:
+            self._request.release()
+            self._request = None
+        if self._lease is not None:
+            self._lease.release()
+            self._lease = None
+
+    def __enter__(self) -> 'Frame':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def dict(self) -> dict:
+        return {
+            "timestamp": self.timestamp,
+            "exposure_time": self.exposure_time,
+            "analogue_gain": self.analogue_gain,
+            "frame_duration": self.frame_duration,
+            "latency": self.latency,
+        }
+
+
+class FrameStats:
+    """
+    Rolling record of the frames a camera captured
+    Intervals are between the timestamps of consecutive frames (see Frame),
+    their spread is the capture jitter. Throughput is over the frames
+    kept, in frames per second of host time.
+    """
+
+    count: int
+    recent: Deque[Tuple[float, float, float, float, float, float]]
+
+    def __init__(self, keep: int = 1000):
+        self.count = 0
+        self.recent = collections.deque(maxlen=keep)
+
+    def add(self, metadata: dict, latency: float, now: Optional[float] = None):
+        """
+        :param metadata: request metadata
+        :param latency: seconds the host waited for the frame
+        :param now: monotonic time the frame arrived
+        """
+        timestamp = Frame.timestamp_of(metadata)
+        self.count += 1
+        self.recent.append((
+            time.monotonic() if now is None else now,
+            timestamp if timestamp is not None else np.nan,
+            latency,
+            metadata.get("ExposureTime", np.nan),
+            metadata.get("AnalogueGain", np.nan),
+            metadata.get("FrameDuration", np.nan),
+        ))
+
+    def dict(self) -> dict:
+        if not self.recent:
+            return {"count": self.count}
+
+        arrived, timestamp, latency, exposure, gain, duration = np.array(self.recent, dtype=np.float64).T
+        intervals = np.diff(timestamp[~np.isnan(timestamp)])
+        span = arrived[-1] - arrived[0]
+
+        def mean(a: np.ndarray) -> Optional[float]:
+            a = a[~np.isnan(a)]
+            return float(a.mean()) if len(a) else None
+
+        return {
+            "count": self.count,
+            "throughput": float((len(arrived) - 1) / span) if span > 0 else 0.0,
+            "interval_mean": float(intervals.mean()) if len(intervals) else None,
+            "interval_jitter": float(intervals.std()) if len(intervals) else None,
+            "interval_max": float(intervals.max()) if len(intervals) else None,
+            "latency_mean": float(latency.mean()),
+            "latency_p50": float(np.percentile(latency, 50)),
+            "latency_p90": float(np.percentile(latency, 90)),
+            "latency_max": float(latency.max()),
+            "exposure_time_mean": mean(exposure),
+            "analogue_gain_mean": mean(gain),
+            "frame_duration_mean": mean(duration),
+        }
+
+
+class CardIdRoi:
+    """
+    Hardware crop of the AUX camera covering what processing.card_id() reads
+    card_id() scales the whole frame and rotates it counter clockwise before
+    cropping, so its rows run right to left across the frame and its columns
+    top to bottom. The crop is mapped back onto the unrotated frame and read
+    out at the size card_id() would have scaled it to, leaving card_id() to
+    rotate it and trim the padding the output size is aligned with.
+    """
+
+    # Picamera2 rounds output sizes down to multiples of these
+    ALIGN = (32, 2)
+
+    region: Tuple[int, int, int, int]
+    size: Tuple[int, int]
+    rows: Tuple[int, int]
+    cols: Tuple[int, int]
+
+    def __init__(self,
+                 frame_size: Tuple[int, int],
+                 scale: float,
+                 start_row: int,
+                 end_row: int,
+                 start_col: int,
+                 end_col: int):
+        """
+        :param frame_size: size of the full frame card_id() is given
+        :param scale: card_id() crop parameters
+        :param start_row:
+        :param end_row:
+        :param start_col:
+        :param end_col:
+        """
+        # Size of the frame once card_id() scaled it
+        scaled_w, scaled_h = (int(frame_size[0] * scale), int(frame_size[1] * scale))
+
+        w = min(-(-(end_row - start_row) // self.ALIGN[0]) * self.ALIGN[0], scaled_w)
+        h = min(-(-(end_col - start_col) // self.ALIGN[1]) * self.ALIGN[1], scaled_h)
+
+        # Rotated row r is column scaled_w - 1 - r of the frame,
+        # the padding goes after the crop in the rotated frame
+        x = min(max(scaled_w - start_row - w, 0), scaled_w - w)
+        y = min(max(start_col, 0), scaled_h - h)
+
+        # Region of the full frame, before scaling
+        self.region = (int(round(x / scale)), int(round(y / scale)),
+                       int(round(w / scale)), int(round(h / scale)))
+        self.size = (w, h)
+
+        # Crop of the rotated region frame matching the original crop
+        row = start_row - (scaled_w - x - w)
+        col = start_col - y
+        self.rows = (row, row + end_row - start_row)
+        self.cols = (col, col + end_col - start_col)
+
+    def card_id(self, img: np.ndarray) -> Tuple[str, np.ndarray]:
+        """
+        Read the card ID from a frame captured in ROI mode
+        """
+        return processing.card_id(img, 1, *self.rows, *self.cols)
+
+
 class Camera(abc.ABC):
+    # Size of the low resolution stream used to watch for motion
+    LORES_SIZE = (320, 240)
+
+    # Stream frames and the lores stream detect_card_edge_luma works on in ALIGN mode
+    ALIGN_MAIN_SIZE = (640, 480)
+    ALIGN_SIZE = (int(640 * processing.EDGE_SCALE), int(480 * processing.EDGE_SCALE))
+
+    # Mean grey level change between consecutive lores frames below which the image is settled
+    SETTLE_THRESHOLD = 2.0
+
     cam: int
+    emulated: bool
     still_config: dict
     stream_config: dict
+    align_config: dict
+    roi_config: Optional[dict]
     preview_config: dict
+    session: CameraSession
+    settle: SettleStats
+    frame_stats: FrameStats
+    settle_threshold: float
+    pool_size: int
+    _pool: Optional[FramePool]
     _lock: threading.Lock
 
     preview: bool
 
-    def __init__(self, cam: int, name: str):
+    def __init__(self, cam: int, name: str, pool_size: int = 3, backend=None):
+        """
+        :param cam: Picamera2 camera index, negative for no camera
+        :param name: name used in logs
+        :param pool_size: number of frame buffers kept for acquire_lease()
+        :param backend: stand-in for Picamera2 (see rit.cam_emulator) used instead of the hardware
+        """
         self.cam = cam
         self.name = name
         self.preview = False
+        self.session = CameraSession(self)
+        self.settle = SettleStats()
+        self.frame_stats = FrameStats()
+        self.settle_threshold = self.SETTLE_THRESHOLD
+        self.pool_size = pool_size
+        self._pool = None
         self._lock = threading.Lock()
-        if self.is_hardware:
+        self.roi_config = None
+        self._roi = None
+        self.emulated = backend is not None
+        if self.emulated:
+            self.camera = backend
+        elif self.is_hardware:
             from picamera2 import Picamera2
             self.camera = Picamera2(cam)
+        else:
+            self.camera = None
 
     @property
     def is_hardware(self) -> bool:
-        return self.cam >= 0
+        return self.cam >= 0 and not self.emulated
+
+    @property
+    def has_camera(self) -> bool:
+        """
+        Backed by hardware or an emulator, cameras without one give no frames
+        """
+        return self.camera is not None
+
+    def config(self, mode: CameraMode) -> dict:
+        """
+        Configuration built for a mode when the camera was opened
+        """
+        if mode == CameraMode.STILL:
+            return self.still_config
+        elif mode == CameraMode.STREAM:
+            return self.stream_config
+        elif mode == CameraMode.ALIGN:
+            return self.align_config
+        elif mode == CameraMode.ROI:
+            return self.roi_config or self.still_config
+        return self.preview_config
 
     def start(self, still=True):
-        if self.is_hardware:
-            self.camera.configure(self.still_config if still else self.stream_config)
-            self.camera.set_controls({"AwbMode": 4})
-            self.camera.start()
+        self.session.acquire(CameraMode.STILL if still else CameraMode.STREAM)
+
+    def start_align(self):
+        """
+        Start streaming for alignment, see acquire_luma()
+        """
+        self.session.acquire(CameraMode.ALIGN)
+
+    def start_roi(self):
+        """
+        Start capturing the region set with set_roi(), the whole still frame when none is set
+        """
+        self.session.acquire(CameraMode.ROI)
+
+    def set_roi(self, region: Optional[Tuple[int, int, int, int]], size: Optional[Tuple[int, int]] = None):
+        """
+        Read out only part of the still frame in ROI mode
+        The region is cropped by the ISP (ScalerCrop) and scaled to size,
+        so nothing outside it gets transferred or converted.
+        :param region: x, y, width and height in still frame pixels, None for the whole frame
+        :param size: output size, the region size if None
+        """
+        roi = None if region is None else (tuple(region), tuple(size or region[2:]))
+        if roi == self._roi:
+            return
+
+        self._roi = roi
+        self.roi_config = None
+        if roi is not None and self.has_camera:
+            (x, y, w, h), size = roi
+
+            # ScalerCrop is in pixel array coordinates, the still frame covers the largest crop
+            frame_w, frame_h = self.still_config["main"]["size"]
+            crop_x, crop_y, crop_w, crop_h = self.camera.camera_properties["ScalerCropMaximum"]
+            scaler_crop = (crop_x + x * crop_w // frame_w, crop_y + y * crop_h // frame_h,
+                           w * crop_w // frame_w, h * crop_h // frame_h)
+
+            # Keep the full resolution sensor mode, a binned one would halve the detail
+            self.roi_config = self.camera.create_still_configuration(
+                main={"size": size},
+                raw={"size": self.camera.sensor_resolution},
+                controls={"ScalerCrop": scaler_crop},
+            )
+
+        if self.session.mode == CameraMode.ROI:
+            # Picked up on the next start_roi()
+            self.session.close()
 
     def start_preview(self):
         from picamera2 import Preview
 
+        # The preview needs the pipeline to itself
+        self.session.close()
         self.camera.configure(self.preview_config)
         if self.camera._preview:
             self.camera.stop_preview()
@@ -48,53 +558,300 @@ class Camera(abc.ABC):
 
         self.camera.start_preview(Preview.QTGL)
         self.camera.start()
+        self.session.mode = CameraMode.PREVIEW
         self.preview = True
 
     def stop_preview(self):
-        self.camera.stop()
+        self.session.close()
         self.preview = False
         self.camera.stop_preview()
 
     def stop(self):
-        if self.is_hardware:
-            self.camera.stop()
+        self.session.release()
+
+    def close(self):
+        """
+        Stop the camera even if the session would keep it running
+        """
+        self.session.close()
 
     def __enter__(self):
-        self.start()
+        # Hold the lock before touching the camera mode
         self._lock.acquire()
+        try:
+            self.start()
+        except BaseException:
+            self._lock.release()
+            raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop()
-        self._lock.release()
+        try:
+            self.stop()
+        finally:
+            self._lock.release()
 
     def acquire(self, name: str):
-        if self.is_hardware:
+        if self.has_camera:
             self.camera.capture_file(name)
 
-    def acquire_array(self) -> np.ndarray:
-        if self.is_hardware:
-            img = self.camera.capture_array()
-            return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def _capture(self, settle_timeout: float = 0.0):
+        """
+        Capture a request and record it in frame_stats
+        :param settle_timeout: give up waiting for the image to settle after this many seconds, 0 to not wait
+        """
+        start = time.monotonic()
+        request = self._settled_request(settle_timeout)
+
+        now = time.monotonic()
+        self.frame_stats.add(request.get_metadata(), now - start, now)
+        return request
+
+    def _settled_request(self, settle_timeout: float = 0.0):
+        """
+        Capture a request, once the image stopped moving
+        Consecutive lores frames are compared until the motion energy
+        between them drops below settle_threshold. The settled frame is
+        the one returned, so waiting costs no extra frame.
+        :param settle_timeout: give up waiting and capture after this many seconds, 0 to not wait
+        """
+        request = self.camera.capture_request()
+        if settle_timeout <= 0:
+            return request
+
+        start = time.monotonic()
+        lores = request.config.get("lores")
+        if lores is None:
+            # Nothing cheap to compare frames with, sit out the whole delay
+            request.release()
+            time.sleep(settle_timeout)
+            self.settle.add(settle_timeout, True)
+            return self.camera.capture_request()
+
+        w, h = lores["size"]
+        previous = None
+        while True:
+            # Y plane of the YUV420 lores stream
+            y = request.make_array("lores")[:h, :w]
+            elapsed = time.monotonic() - start
+
+            if previous is not None and processing.motion_energy(previous, y) <= self.settle_threshold:
+                self.settle.add(elapsed, False)
+                return request
+            if elapsed >= settle_timeout:
+                log.debug("%s camera did not settle within %.2fs", self.name, settle_timeout)
+                self.settle.add(elapsed, True)
+                return request
+
+            request.release()
+            previous = y
+            request = self.camera.capture_request()
+
+    def _convert(self, request, dst: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Convert a captured request straight out of the camera buffer and release it
+        :param request: completed request from _capture()
+        :param dst: array to write the frame to, allocated if None
+        """
+        try:
+            config = request.config["main"]
+            fmt = config["format"]
+            if not self.is_hardware or fmt not in ("BGR888", "RGB888", "XBGR8888", "XRGB8888"):
+                img = request.make_array("main")
+                return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=dst)
+
+            from picamera2 import MappedArray
+
+            # MappedArray copies the whole frame to drop the row
+            # padding, view the padded buffer in place instead
+            w, h = config["size"]
+            channels = 4 if fmt.startswith("X") else 3
+            with MappedArray(request, "main", reshape=False) as m:
+                img = m.array.reshape(h, config["stride"])[:, :w * channels].reshape(h, w, channels)
+                return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=dst)
+        finally:
+            request.release()
+
+    def acquire_array(self, settle_timeout: float = 0.0) -> np.ndarray:
+        """
+        Capture a frame
+        :param settle_timeout: wait up to this long (seconds) for the image to stop moving
+        """
+        if self.has_camera:
+            return self._convert(self._capture(settle_timeout))
+
+    def acquire_frame(self,
+                      settle_timeout: float = 0.0,
+                      pooled: bool = False,
+                      timeout: Optional[float] = None,
+                      convert: bool = True) -> Optional[Frame]:
+        """
+        Capture a frame along with its metadata
+        :param settle_timeout: wait up to this long (seconds) for the image to stop moving
+        :param pooled: convert into a buffer from the camera's frame pool, release the frame once done with it
+        :param timeout: seconds to wait for a free pool buffer, None to wait forever
+        :param convert: False to leave the frame holding the camera buffer until
+            convert_frame(), which lets the conversion happen once the stage moved on
+        """
+        if not self.has_camera:
+            return None
+
+        start = time.monotonic()
+        request = self._capture(settle_timeout)
+        frame = Frame(None, request.get_metadata(), time.monotonic() - start)
+        frame._request = request
+        if convert:
+            self.convert_frame(frame, pooled, timeout)
+        return frame
+
+    def convert_frame(self, frame: Frame, pooled: bool = False, timeout: Optional[float] = None) -> Frame:
+        """
+        Convert a frame from acquire_frame(convert=False), releasing its camera buffer whatever happens
+        :param pooled: convert into a buffer from the camera's frame pool
+        :param timeout: seconds to wait for a free pool buffer, None to wait forever
+        """
+        request, frame._request = frame._request, None
+        if request is None:
+            # Already converted
+            return frame
+        if not pooled:
+            frame.array = self._convert(request)
+            return frame
+
+        try:
+            lease = self._lease(timeout)
+        except BaseException:
+            request.release()
+            raise
+
+        try:
+            self._convert(request, lease.array)
+        except BaseException:
+            lease.release()
+            raise
+        frame.array, frame._lease = lease.array, lease
+        return frame
+
+    def acquire_luma(self, settle_timeout: float = 0.0) -> Optional[np.ndarray]:
+        """
+        Capture the Y plane of the lores stream
+        In ALIGN mode this is the grayscale frame detect_card_edge_luma works
+        on, with no colour conversion or resize of the main stream.
+        :param settle_timeout: wait up to this long (seconds) for the image to stop moving
+        """
+        if not self.has_camera:
+            return None
+
+        request = self._capture(settle_timeout)
+        try:
+            w, h = request.config["lores"]["size"]
+            return request.make_array("lores")[:h, :w]
+        finally:
+            request.release()
+
+    def acquire_timed_luma(self) -> Tuple[Optional[np.ndarray], float]:
+        """
+        Capture the Y plane of the lores stream along with when it was exposed
+        Meant for streaming while the stage moves, nothing waits for the image to settle.
+        :return: frame and its timestamp, see Frame
+        """
+        if not self.has_camera:
+            return None, time.monotonic()
+
+        request = self._capture()
+        try:
+            w, h = request.config["lores"]["size"]
+            return request.make_array("lores")[:h, :w], self._timestamp(request)
+        finally:
+            request.release()
+
+    @staticmethod
+    def _timestamp(request) -> float:
+        """
+        Frame timestamp of a request, see Frame, or the time now if the camera did not report one
+        """
+        timestamp = Frame.timestamp_of(request.get_metadata())
+        return time.monotonic() if timestamp is None else timestamp
+
+    def _lease(self, timeout: Optional[float] = None) -> FrameLease:
+        config = self.camera.camera_config["main"]
+        w, h = config["size"]
+        if self._pool is None or self._pool.shape != (h, w, 3):
+            # Leases from the old pool release into it and it gets garbage collected
+            self._pool = FramePool((h, w, 3), self.pool_size)
+
+        return self._pool.lease(timeout)
+
+    def acquire_lease(self, timeout: Optional[float] = None, settle_timeout: float = 0.0) -> Optional[FrameLease]:
+        """
+        Capture a frame into a buffer from the camera's frame pool
+        No memory is allocated once the pool exists, the lease
+        must be released for the buffer to be reused.
+        :param timeout: seconds to wait for a free buffer, None to wait forever
+        :param settle_timeout: wait up to this long (seconds) for the image to stop moving
+        """
+        if not self.has_camera:
+            return None
+
+        lease = self._lease(timeout)
+        try:
+            self._convert(self._capture(settle_timeout), lease.array)
+        except BaseException:
+            lease.release()
+            raise
+        return lease
 
 
 class HqCamera(Camera):
-    def __init__(self, cam: int):
-        super().__init__(cam, "HQ")
-        if self.is_hardware:
+    STILL_SIZE = (4056, 3040)
+
+    def __init__(self, cam: int, backend=None):
+        super().__init__(cam, "HQ", backend=backend)
+        if self.has_camera:
             self.still_config = self.camera.create_still_configuration(
-                main={"size": (4056, 3040)},
+                main={"size": self.STILL_SIZE},
+                lores={"size": self.LORES_SIZE},
             )
 
-            self.stream_config = self.camera.create_preview_configuration()
+            self.stream_config = self.camera.create_preview_configuration(lores={"size": self.LORES_SIZE})
+            self.align_config = self.camera.create_preview_configuration(
+                main={"size": self.ALIGN_MAIN_SIZE},
+                lores={"size": self.ALIGN_SIZE},
+            )
             self.preview_config = self.camera.create_preview_configuration(main={"size": (2028, 1520)})
 
 
 class AuxCamera(Camera):
-    def __init__(self, cam: int):
-        super().__init__(cam, "AUX")
-        if self.is_hardware:
+    STILL_SIZE = (3280, 2464)
+
+    def __init__(self, cam: int, backend=None):
+        super().__init__(cam, "AUX", backend=backend)
+        if self.has_camera:
             self.still_config = self.camera.create_still_configuration(
-                main={"size": (3280, 2464)},
+                main={"size": self.STILL_SIZE},
+                lores={"size": self.LORES_SIZE},
+            )
+            self.stream_config = self.camera.create_preview_configuration(lores={"size": self.LORES_SIZE})
+            self.align_config = self.camera.create_preview_configuration(
+                main={"size": self.ALIGN_MAIN_SIZE},
+                lores={"size": self.ALIGN_SIZE},
             )
-            self.stream_config = self.camera.create_preview_configuration()
             self.preview_config = self.camera.create_preview_configuration(main={"size": (1640, 1232)})
+
+    def set_card_id_roi(self,
+                        scale: float,
+                        start_row: int,
+                        end_row: int,
+                        start_col: int,
+                        end_col: int) -> CardIdRoi:
+        """
+        Only read out the card ID in ROI mode
+        :param scale: processing.card_id() crop parameters
+        :param start_row:
+        :param end_row:
+        :param start_col:
+        :param end_col:
+        :return: mapping to read the card ID of ROI frames with
+        """
+        roi = CardIdRoi(self.STILL_SIZE, scale, start_row, end_row, start_col, end_col)
+        self.set_roi(roi.region, roi.size)
+        return roi
@@ -0,0 +1,350 @@
+"""
+Emulator of the Picamera2 cameras for running without the Pi
+
+Stands in for Picamera2 behind rit.cam.Camera and serves synthetic or
+recorded frames at the HQ and AUX resolutions with a configurable frame
+latency. Frames can follow the position of a StageEmulator so that
+alignment and card capture run end to end:
+
+    stage_emulator = StageEmulator()
+    hq = HqCamera(-1, backend=CameraEmulator(HQ_SIZE, CardScene(), stage_emulator.physical_position))
+    aux = AuxCamera(-1, backend=CameraEmulator(AUX_SIZE, CardIdScene()))
+"""
+
+import logging
+import math
+import time
+from pathlib import Path
+from typing import Optional, Callable, Tuple, Dict, List
+
+import cv2
+import numpy as np
+
+from rit.system import IM_WIDTH_PER_EIGHTH_STEP
+
+log = logging.getLogger(__name__)
+
+HQ_SIZE = (4056, 3040)
+AUX_SIZE = (3280, 2464)
+
+# Picamera2 default for create_preview_configuration()
+PREVIEW_SIZE = (640, 480)
+
+
+class CardScene:
+    """
+    Synthetic view of a sensor card from the HQ camera.
+    The card is a bright plate whose vertical edge slides across a dark
+    background as the stage moves, using the same image width per step
+    that System calibrates its fine motion with.
+    """
+
+    edge: int
+    background: int
+    card: int
+    noise: float
+    ring: float
+    ring_time: float
+
+    # Frequency the stage rings at after stopping
+    RING_HZ = 25.0
+
+    def __init__(self,
+                 edge: int = 3000,
+                 background: int = 40,
+                 card: int = 200,
+                 noise: float = 0.0,
+                 ring: float = 0.0,
+                 ring_time: float = 0.05):
+        """
+        :param edge: stage position (eighth steps) that puts the card edge in the middle of the frame
+        :param background: grey level around the card
+        :param card: grey level of the card
+        :param noise: standard deviation of gaussian noise added to every frame
+        :param ring: amplitude (eighth steps) the image shakes with once the stage stops
+        :param ring_time: time constant (seconds) the shaking dies out with
+        """
+        self.edge = edge
+        self.background = background
+        self.card = card
+        self.noise = noise
+        self.ring = ring
+        self.ring_time = ring_time
+
+        self._last_position: Optional[int] = None
+        self._moved_at = float("-inf")
+
+    def _shake(self, position: int) -> float:
+        """
+        Decaying oscillation after the stage last moved, in eighth steps
+        The ringing only starts once the stage stops.
+        """
+        now = time.monotonic()
+        if position != self._last_position:
+            self._last_position = position
+            self._moved_at = now
+            return 0.0
+
+        age = now - self._moved_at
+        return self.ring * math.exp(-age / self.ring_time) * math.cos(2 * math.pi * self.RING_HZ * age)
+
+    def edge_x(self, position: int) -> float:
+        """
+        Where the edge appears for a stage position, 0 is the left side of the frame and 1 the right
+        """
+        return 0.5 + (position - self.edge) * IM_WIDTH_PER_EIGHTH_STEP
+
+    def render(self, size: Tuple[int, int], position: Optional[int]) -> np.ndarray:
+        w, h = size
+        position = self.edge if position is None else position
+        x = self.edge_x(position + (self._shake(position) if self.ring else 0.0))
+
+        img = np.full((h, w), self.background, dtype=np.uint8)
+        img[:, :min(max(int(round(x * w)), 0), w)] = self.card
+
+        if self.noise > 0:
+            noise = np.empty((h, w), dtype=np.int16)
+            cv2.randn(noise, 0, self.noise)
+            img = cv2.convertScaleAbs(cv2.add(img, noise, dtype=cv2.CV_16S))
+
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+
+
+class CardIdScene:
+    """
+    Synthetic view of the card ID from the AUX camera.
+    The digits are drawn where processing.card_id crops them from
+    with the default CardIDParameters (after rotating the frame).
+    """
+
+    text: str
+    box: Tuple[int, int, int, int]
+
+    def __init__(self, text: str = "1234567", box: Tuple[int, int, int, int] = (1150, 1300, 600, 1250)):
+        """
+        :param text: card ID to draw
+        :param box: start row, end row, start column and end column of the ID in the rotated frame
+        """
+        self.text = text
+        self.box = box
+        self._cache: Dict[Tuple[int, int], np.ndarray] = {}
+
+    def render(self, size: Tuple[int, int], position: Optional[int]) -> np.ndarray:
+        if size not in self._cache:
+            w, h = size
+            start_row, end_row, start_col, end_col = self.box
+
+            # card_id rotates the frame counter clockwise before cropping
+            rotated = np.full((w, h), 255, dtype=np.uint8)
+            font_scale = cv2.getFontScaleFromHeight(cv2.FONT_HERSHEY_SIMPLEX, (end_row - start_row) * 2 // 3, 8)
+            cv2.putText(rotated, self.text, (start_col + 10, end_row - (end_row - start_row) // 6),
+                        cv2.FONT_HERSHEY_SIMPLEX, font_scale, 0, 8, cv2.LINE_AA)
+
+            frame = cv2.rotate(rotated, cv2.ROTATE_90_CLOCKWISE)
+            self._cache[size] = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+
+        return self._cache[size].copy()
+
+
+class RecordedScene:
+    """
+    Frames loaded from a directory of images.
+    Images named after the stage position they were taken at (e.g. 2500.png)
+    are served for the closest position, otherwise they are played in a loop.
+    """
+
+    paths: List[Path]
+    positions: Optional[np.ndarray]
+
+    def __init__(self, directory: Path):
+        self.paths = sorted(p for p in Path(directory).iterdir()
+                            if p.suffix.lower() in (".png", ".jpg", ".jpeg", ".tif", ".tiff"))
+        if not self.paths:
+            raise FileNotFoundError(f"No images in {directory}")
+
+        try:
+            positions = [int(p.stem) for p in self.paths]
+            order = np.argsort(positions)
+            self.paths = [self.paths[i] for i in order]
+            self.positions = np.array(positions)[order]
+        except ValueError:
+            self.positions = None
+
+        self._next = 0
+        self._cache: Dict[Tuple[int, Tuple[int, int]], np.ndarray] = {}
+
+    def _index(self, position: Optional[int]) -> int:
+        if self.positions is None or position is None:
+            i = self._next
+            self._next = (self._next + 1) % len(self.paths)
+            return i
+
+        i = int(np.searchsorted(self.positions, position))
+        if i == len(self.positions) or (i > 0 and position - self.positions[i - 1] < self.positions[i] - position):
+            i -= 1
+        return i
+
+    def render(self, size: Tuple[int, int], position: Optional[int]) -> np.ndarray:
+        i = self._index(position)
+        if (i, size) not in self._cache:
+            img = cv2.imread(str(self.paths[i]), cv2.IMREAD_COLOR)
+            if img is None:
+                raise IOError(f"Failed to read {self.paths[i]}")
+            if (img.shape[1], img.shape[0]) != size:
+                img = cv2.resize(img, size)
+            self._cache[(i, size)] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        return self._cache[(i, size)].copy()
+
+
+class CameraEmulator:
+    """
+    The subset of Picamera2 used by rit.cam.Camera.
+    Like the real "BGR888" format, frames are handed out in RGB order
+    and lores streams are YUV420.
+    """
+
+    sensor_size: Tuple[int, int]
+    latency: float
+    camera_config: Optional[dict]
+    started: bool
+    frames: int
+
+    def __init__(self,
+                 sensor_size: Tuple[int, int],
+                 scene,
+                 position: Optional[Callable[[], Optional[int]]] = None,
+                 latency: float = 0.05):
+        """
+        :param sensor_size: full resolution (width, height) used for still captures
+        :param scene: CardScene, CardIdScene, RecordedScene or anything with the same render()
+        :param position: returns the current stage position (eighth steps) the frame is taken at
+        :param latency: minimum time (seconds) a capture takes
+        """
+        self.sensor_size = sensor_size
+        self.scene = scene
+        self.position = position
+        self.latency = latency
+
+        self.camera_config = None
+        self.controls = {}
+        self.started = False
+        self.frames = 0
+
+        self.sensor_resolution = sensor_size
+        self.camera_properties = {
+            "PixelArraySize": sensor_size,
+            "ScalerCropMaximum": (0, 0) + tuple(sensor_size),
+        }
+
+    @staticmethod
+    def _configuration(main: Optional[dict], lores: Optional[dict], size: Tuple[int, int], fmt: str,
+                       controls: Optional[dict] = None) -> dict:
+        config = {
+            "main": {"size": tuple((main or {}).get("size", size)), "format": (main or {}).get("format", fmt)},
+            "lores": None,
+            "controls": dict(controls or {}),
+        }
+        if lores is not None:
+            config["lores"] = {"size": tuple(lores["size"]), "format": lores.get("format", "YUV420")}
+        return config
+
+    def create_still_configuration(self, main: Optional[dict] = None, lores: Optional[dict] = None,
+                                   controls: Optional[dict] = None, **kwargs) -> dict:
+        return self._configuration(main, lores, self.sensor_size, "BGR888", controls)
+
+    def create_preview_configuration(self, main: Optional[dict] = None, lores: Optional[dict] = None,
+                                     controls: Optional[dict] = None, **kwargs) -> dict:
+        return self._configuration(main, lores, PREVIEW_SIZE, "XBGR8888", controls)
+
+    def configure(self, config: dict):
+        if self.started:
+            raise RuntimeError("Camera must be stopped before configuring")
+        self.camera_config = config
+
+        # Like Picamera2, configuring replaces the controls with the configuration's
+        self.controls = dict(config.get("controls", {}))
+
+    def set_controls(self, controls: dict):
+        self.controls.update(controls)
+
+    def start(self):
+        if self.camera_config is None:
+            raise RuntimeError("Camera has not been configured")
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def render(self, name: str, position: Optional[int]) -> np.ndarray:
+        """
+        Produce a stream of the current configuration for a stage position
+        """
+        config = self.camera_config[name]
+        if config is None:
+            raise RuntimeError(f"Stream {name} is not configured")
+
+        crop = self.controls.get("ScalerCrop")
+        if crop is None:
+            img = self.scene.render(config["size"], position)
+        else:
+            # Every stream is scaled from the same crop of the sensor
+            x, y, w, h = crop
+            img = self.scene.render(self.sensor_size, position)[y:y + h, x:x + w]
+            img = cv2.resize(img, config["size"], interpolation=cv2.INTER_AREA)
+
+        if config["format"] == "YUV420":
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2YUV_I420)
+        elif config["format"].startswith("X"):
+            img = np.dstack((img, np.full(img.shape[:2], 255, dtype=np.uint8)))
+        return img
+
+    def capture_request(self) -> 'EmulatedRequest':
+        if not self.started:
+            raise RuntimeError("Camera is not running")
+
+        # The frame shows where the stage was when the exposure started
+        start = time.monotonic()
+        request = EmulatedRequest(self, self.position() if self.position else None, start)
+
+        self.frames += 1
+        time.sleep(max(self.latency - (time.monotonic() - start), 0))
+        return request
+
+    def capture_array(self, name: str = "main") -> np.ndarray:
+        request = self.capture_request()
+        try:
+            return request.make_array(name)
+        finally:
+            request.release()
+
+    def capture_file(self, name: str):
+        img = self.capture_array()
+        cv2.imwrite(name, cv2.cvtColor(img, cv2.COLOR_RGBA2BGR if img.shape[2] == 4 else cv2.COLOR_RGB2BGR))
+
+
+class EmulatedRequest:
+    """
+    A completed capture, streams are only rendered when asked for
+    """
+
+    def __init__(self, camera: CameraEmulator, position: Optional[int], timestamp: float):
+        self.camera = camera
+        self.position = position
+        self.timestamp = timestamp
+        self.config = camera.camera_config
+
+    def make_array(self, name: str) -> np.ndarray:
+        return self.camera.render(name, self.position)
+
+    def get_metadata(self) -> dict:
+        # Frames are rendered at a single instant, there is no exposure to speak of
+        return {
+            "SensorTimestamp": int(self.timestamp * 1e9),
+            "ExposureTime": 0,
+            "AnalogueGain": 1.0,
+            "FrameDuration": int(self.camera.latency * 1e6),
+        }
+
+    def release(self):
+        pass
@@ -1,5 +1,7 @@
 from typing import Union
 
+import numpy as np
+
 CRC8_TABLE = [
     0x00, 0x31, 0x62, 0x53, 0xc4, 0xf5, 0xa6, 0x97, 0xb9, 0x88, 0xdb, 0xea, 0x7d,
     0x4c, 0x1f, 0x2e, 0x43, 0x72, 0x21, 0x10, 0x87, 0xb6, 0xe5, 0xd4, 0xfa, 0xcb,
@@ -24,8 +26,79 @@ CRC8_TABLE = [
 ]
 
 
-def crc8(m: Union[bytes, bytearray]):
-    crc = 0xFF
+# Same table for vectorised lookups
+CRC8_TABLE_NP = np.array(CRC8_TABLE, dtype=np.uint8)
+
+
+def crc8(m: Union[bytes, bytearray, memoryview], crc: int = 0xFF) -> int:
+    """
+    CRC8 (poly 0x31, init 0xFF) of a buffer
+    :param m: data to checksum
+    :param crc: CRC state to continue from
+    :return: 8-bit checksum
+    """
+    table = CRC8_TABLE
     for c in m:
-        crc = CRC8_TABLE[crc ^ c] & 0xFF
+        crc = table[crc ^ c]
     return crc & 0xFF
+
+
+class Crc8:
+    """
+    Incremental CRC8 for data that arrives in pieces,
+    update(a).update(b) gives the same value as crc8(a + b)
+    """
+
+    __slots__ = ("value",)
+
+    value: int
+
+    def __init__(self, crc: int = 0xFF):
+        self.value = crc
+
+    def update(self, m: Union[bytes, bytearray, memoryview]) -> 'Crc8':
+        self.value = crc8(m, self.value)
+        return self
+
+    def copy(self) -> 'Crc8':
+        return Crc8(self.value)
+
+
+def crc8_bulk(frames: np.ndarray, crc: int = 0xFF) -> np.ndarray:
+    """
+    CRC8 of every row of a 2D byte array at once.
+    Runs one table lookup per column across all the rows.
+    :param frames: (N, L) uint8 array
+    :param crc: CRC state to start every row from
+    :return: (N,) uint8 array of checksums
+    """
+    frames = np.asarray(frames, dtype=np.uint8)
+    assert frames.ndim == 2, frames.shape
+
+    out = np.full(frames.shape[0], crc, dtype=np.uint8)
+    index = np.empty_like(out)
+    for column in np.ascontiguousarray(frames.T):
+        np.bitwise_xor(out, column, out=index)
+        np.take(CRC8_TABLE_NP, index, out=out)
+
+    return out
+
+
+def crc8_check_frames(data: Union[bytes, bytearray, memoryview, np.ndarray],
+                      size: int,
+                      crc_offset: int) -> np.ndarray:
+    """
+    Check the checksum of many back-to-back fixed size frames
+    :param data: raw bytes holding whole frames, a trailing partial frame is ignored
+    :param size: size of each frame in bytes
+    :param crc_offset: position of the checksum byte, it covers all the bytes before it
+    :return: (N,) bool array, True where the checksum matches
+    """
+    if isinstance(data, np.ndarray):
+        raw = data.reshape(-1).view(np.uint8)
+    else:
+        raw = np.frombuffer(data, dtype=np.uint8)
+
+    n = len(raw) // size
+    frames = raw[:n * size].reshape(n, size)
+    return crc8_bulk(frames[:, :crc_offset]) == frames[:, crc_offset]
@@ -0,0 +1,532 @@
+"""
+Emulator for the stage microcontroller firmware (mc/src)
+
+Speaks the same 12 byte packet protocol as the STM32 over a
+pseudo-terminal so that Stage, Cli and web.main can be run and
+load tested without the hardware:
+
+    python -m rit.emulator
+    python -m rit.cli /dev/pts/N
+    WERFEN_SERIAL=/dev/pts/N uvicorn web.main:app
+
+A trace exported by Stage.start_trace() can be replayed against it:
+
+    python -m rit.emulator trace.npy
+
+Motion is simulated in real time from the step rate. The stage
+travel is bounded by limit switch 1 (reversed direction) and limit
+switch 2 (forward direction). Hitting a switch stops the motion with
+a failure and runs the limit step off motion in the other direction.
+"""
+
+import collections
+import logging
+import math
+import os
+import select
+import struct
+import threading
+import time
+import tty
+from typing import Optional, Tuple, Deque
+
+import numpy as np
+import serial
+
+from rit.crc import crc8
+from rit.stage import StageOpcode, StageFlags, StageStepSize, STEP_EIGHTHS, \
+    StageFrameParser, StageTrace, StageTraceDirection
+
+log = logging.getLogger(__name__)
+
+PACKET = struct.Struct("<BBHIBBBB")
+FLOAT = struct.Struct("<f")
+U32 = struct.Struct("<I")
+
+# Firmware return codes
+STATUS_SUCCESS = 0
+STATUS_FAILURE = 0xFFFFFFFF
+
+# Step timer runs at 1MHz (80MHz / 80)
+STEP_TIMER_HZ = 1000000
+
+
+class EmulatedMotion:
+    """
+    A single motor request running on the emulated step timer
+    Step k (1..steps) happens at started_at + k / rate
+    """
+
+    origin: int
+    step: int
+    steps: int
+    rate: float
+    started_at: float
+    stepping_off: bool
+
+    # Last step at which a switch edge was handled
+    checked: int
+
+    def __init__(self, origin: int, step: int, steps: int, rate: float, started_at: float, stepping_off: bool):
+        self.origin = origin
+        self.step = step
+        self.steps = steps
+        self.rate = rate
+        self.started_at = started_at
+        self.stepping_off = stepping_off
+        self.checked = 0
+
+    @property
+    def end_time(self) -> float:
+        return self.started_at + self.steps / self.rate
+
+    def ticks_at(self, t: float) -> int:
+        # Nudge so that t = started_at + k / rate lands on step k
+        return max(0, min(int((t - self.started_at) * self.rate + 1e-6), self.steps))
+
+    def position_at(self, t: float) -> int:
+        return self.origin + self.ticks_at(t) * self.step
+
+
+class StageEmulator:
+    """
+    Python model of the firmware in mc/src/packet.c, motor.c and switch.c
+    Positions are in eighth steps. The physical stage position is kept
+    separate from the firmware position counter which SET_POSITION changes.
+    """
+
+    travel: int
+    bounce: int
+    baudrate: int
+    processing: float
+
+    def __init__(self,
+                 travel: int = 16000,
+                 start: int = 8000,
+                 bounce: int = 0,
+                 baudrate: int = 115200,
+                 processing: float = 0.0001):
+        """
+        :param travel: distance between the two limit switches in eighth steps
+        :param start: physical position of the stage at power up
+        :param bounce: distance (eighth steps) off a switch where it chatters as the stage leaves it
+        :param baudrate: UART baudrate used to simulate packet transfer time
+        :param processing: time taken by the firmware to handle a packet
+        """
+        self.travel = travel
+        self.bounce = bounce
+        self.baudrate = baudrate
+        self.processing = processing
+
+        self.physical = start
+        self.offset = -start
+        self.motion: Optional[EmulatedMotion] = None
+        self.rate = STEP_TIMER_HZ / (STEP_TIMER_HZ // 250)
+        self.failure = False
+        self.software_estop = False
+        self.hardware_estop = False
+        self.calibrated = False
+        self.led = False
+        self.debounce = 0.0
+        self.step_off_size = StageStepSize.EIGHTH
+        self.step_off_count = 300
+
+        self.rx_packets = 0
+        self.rx_errors = 0
+
+        # Line noise to apply to upcoming replies
+        self._glitches: Deque[Tuple[Optional[int], Optional[int], bytes]] = collections.deque()
+
+        self._lock = threading.RLock()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+    @property
+    def frame_time(self) -> float:
+        """
+        Time to move a single packet over the UART (8N1)
+        """
+        return PACKET.size * 10 / self.baudrate
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="stage-emulator", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        os.close(self._master)
+        os.close(self._slave)
+
+    def serial(self, timeout: float = 1.0) -> serial.Serial:
+        """
+        Open the host side of the emulated UART
+        """
+        return serial.Serial(self.port, self.baudrate, timeout=timeout)
+
+    # Switches
+
+    def limit_1(self, position: Optional[int] = None) -> bool:
+        return (self.physical if position is None else position) <= 0
+
+    def limit_2(self, position: Optional[int] = None) -> bool:
+        return (self.physical if position is None else position) >= self.travel
+
+    def estop(self) -> bool:
+        return self.software_estop or self.hardware_estop
+
+    def set_hardware_estop(self, pressed: bool):
+        """
+        Drive the ENABLE pin, a rising edge stops the motor with a failure
+        """
+        with self._lock:
+            self._advance(time.monotonic())
+            if pressed and not self.hardware_estop:
+                self._stop(True, time.monotonic())
+            self.hardware_estop = pressed
+
+    def glitch(self, drop: Optional[int] = None, corrupt: Optional[int] = None, noise: bytes = b""):
+        """
+        Damage the next reply on its way to the host
+        :param drop: index of a reply byte that gets lost
+        :param corrupt: index of a reply byte that gets flipped
+        :param noise: stray bytes received ahead of the reply
+        """
+        with self._lock:
+            self._glitches.append((drop, corrupt, noise))
+
+    def _damage(self, reply: bytes) -> bytes:
+        with self._lock:
+            if not self._glitches:
+                return reply
+            drop, corrupt, noise = self._glitches.popleft()
+
+        damaged = bytearray(reply)
+        if corrupt is not None:
+            damaged[corrupt] ^= 0xFF
+        if drop is not None:
+            del damaged[drop]
+        return noise + bytes(damaged)
+
+    # Motor
+
+    def position(self) -> int:
+        """
+        Firmware position counter
+        """
+        return self.physical + self.offset
+
+    def physical_position(self) -> int:
+        """
+        Where the stage is right now, including part way through a motion
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._advance(now)
+            return self.motion.position_at(now) if self.motion else self.physical
+
+    def _stop(self, failure: bool, now: float):
+        if self.motion:
+            self.physical = self.motion.position_at(now)
+            self.motion = None
+        self.failure = failure
+
+    def _step(self, size: int, n: int, reversed_: bool, ignore_limits: bool, now: float,
+              stepping_off: bool = False) -> int:
+        if size not in STEP_EIGHTHS and size != 7:
+            return STATUS_FAILURE
+        if self.motion:
+            return STATUS_FAILURE
+
+        if not ignore_limits:
+            if self.limit_1() or self.limit_2() or self.estop():
+                return STATUS_FAILURE
+            self.failure = False
+        elif self.estop():
+            return STATUS_FAILURE
+
+        # Step count is a U16 in the firmware
+        n &= 0xFFFF
+        if n == 0:
+            return STATUS_SUCCESS
+
+        eighths = STEP_EIGHTHS.get(size, 1)
+        self.motion = EmulatedMotion(
+            self.physical, -eighths if reversed_ else eighths,
+            n, self.rate, now, stepping_off
+        )
+        return STATUS_SUCCESS
+
+    def _next_edge(self, m: EmulatedMotion) -> Optional[Tuple[int, bool]]:
+        """
+        Find the next rising edge on a limit switch during a motion
+        :return: (step index, True for a real contact / False for chatter), None if no edge
+        """
+        o, s = m.origin, m.step
+        edges = []
+
+        if s < 0:
+            if o > 0:
+                edges.append((math.ceil(o / -s), True))
+            if self.bounce and o > self.travel - self.bounce:
+                edges.append((math.ceil((o - (self.travel - self.bounce)) / -s), False))
+        else:
+            if o < self.travel:
+                edges.append((math.ceil((self.travel - o) / s), True))
+            if self.bounce and o < self.bounce:
+                edges.append((math.ceil((self.bounce - o) / s), False))
+
+        edges = [(k, contact) for k, contact in edges if m.checked < k <= m.steps]
+        return min(edges) if edges else None
+
+    def _advance(self, now: float):
+        """
+        Run the motor model up to the current time
+        """
+        while self.motion:
+            m = self.motion
+            edge = None if m.stepping_off else self._next_edge(m)
+            edge_time = m.started_at + edge[0] / m.rate + self.debounce if edge else math.inf
+
+            if m.end_time <= edge_time:
+                if m.end_time > now:
+                    return
+                # Motion finished, motor_tick() calls motor_stop(FALSE)
+                self._stop(False, m.end_time)
+                continue
+
+            if edge_time > now:
+                return
+
+            k, contact = edge
+            m.checked = k
+
+            # A chatter edge has settled by the time the debounce check runs
+            pressed = contact or self.debounce == 0
+            if pressed:
+                # motor_limit_step_off(): stop and run the other way
+                self._stop(True, edge_time)
+                self._step(self.step_off_size, self.step_off_count,
+                           m.step > 0, True, edge_time, stepping_off=True)
+
+    # Packets
+
+    def handle(self, opcode: int, arg: int, flags: int, now: float) -> int:
+        """
+        Execute a single request, mirrors packet_handler()
+        :return: reply argument
+        """
+        self._advance(now)
+
+        if opcode == StageOpcode.IDLE:
+            return 0
+        elif opcode == StageOpcode.RELATIVE:
+            return self._step(flags & 0x0F, arg, bool(flags & StageFlags.MOTOR_IS_REVERSED),
+                              bool(flags & StageFlags.MOTOR_IGNORE_LIMITS), now)
+        elif opcode == StageOpcode.ABSOLUTE:
+            size = flags & 0x0F
+            desired = struct.unpack("<i", U32.pack(arg))[0]
+            delta = desired - self.position()
+            nsteps = abs(delta) // STEP_EIGHTHS.get(size, 1)
+            return self._step(size, nsteps, delta < 0,
+                              bool(flags & StageFlags.MOTOR_IGNORE_LIMITS), now)
+        elif opcode == StageOpcode.SPEED:
+            if self.motion:
+                return STATUS_FAILURE
+            arr = (STEP_TIMER_HZ // arg) & 0xFFFF if arg else 0
+            if arr == 0:
+                return STATUS_FAILURE
+            self.rate = STEP_TIMER_HZ / arr
+            return STATUS_SUCCESS
+        elif opcode == StageOpcode.STOP:
+            self._stop(False, now)
+        elif opcode == StageOpcode.SET_POSITION:
+            self.offset = struct.unpack("<i", U32.pack(arg))[0] - self.physical
+            self.calibrated = True
+        elif opcode == StageOpcode.GET_POSITION:
+            if self.motion:
+                return U32.unpack(struct.pack("<i", self.motion.position_at(now) + self.offset))[0]
+            return U32.unpack(struct.pack("<i", self.position()))[0]
+        elif opcode == StageOpcode.LED_PWM:
+            self.led = FLOAT.unpack(U32.pack(arg))[0] > 0
+        elif opcode == StageOpcode.LED_VOLTAGE:
+            self.led = FLOAT.unpack(U32.pack(arg))[0] > 0
+        elif opcode == StageOpcode.LED_PID:
+            pass
+        elif opcode == StageOpcode.SWITCH_DEBOUNCE:
+            self.debounce = (arg & 0xFFFF) / 1000
+        elif opcode == StageOpcode.EMERGENCY_STOP:
+            self._stop(True, now)
+            self.software_estop = True
+        elif opcode == StageOpcode.EMERGENCY_CLEAR:
+            self.software_estop = False
+        elif opcode == StageOpcode.LIMIT_STEP_OFF:
+            self.step_off_size = flags & 0x0F
+            self.step_off_count = arg
+        else:
+            return 0xFF
+
+        return 0
+
+    def reply_flags(self, now: float) -> int:
+        position = self.motion.position_at(now) if self.motion else self.physical
+        return (
+                (StageFlags.LIMIT_1 if self.limit_1(position) else 0)
+                | (StageFlags.LIMIT_2 if self.limit_2(position) else 0)
+                | (StageFlags.ESTOP if self.estop() else 0)
+                | (StageFlags.RUNNING if self.motion else 0)
+                | (StageFlags.LED if self.led else 0)
+                | (StageFlags.FAILURE if self.failure else 0)
+                | (StageFlags.CALIBRATED if self.calibrated else 0)
+        )
+
+    def process(self, m: bytes) -> Optional[bytes]:
+        """
+        Handle a raw packet and build the reply
+        :param m: 12 byte packet
+        :return: 12 byte reply, None if the packet was rejected
+        """
+        s1, s2, opcode, arg, flags, xsum, e1, e2 = PACKET.unpack(m)
+        if crc8(m[:9]) != xsum or (s1, s2, e1, e2) != (0xDE, 0xAD, 0xBE, 0xEF):
+            # packet_validate() failed, the firmware stays silent
+            self.rx_errors += 1
+            return None
+
+        self.rx_packets += 1
+        with self._lock:
+            now = time.monotonic()
+            ret = self.handle(opcode, arg, flags, now)
+            reply_flags = self.reply_flags(now)
+
+        reply = bytearray(PACKET.pack(0xDE, 0xAD, opcode, ret & 0xFFFFFFFF, reply_flags, 0, 0xBE, 0xEF))
+        reply[9] = crc8(reply[:9])
+        return bytes(reply)
+
+    def _run(self):
+        buffer = bytearray()
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+
+            try:
+                buffer += os.read(self._master, 4096)
+            except OSError:
+                break
+
+            # The firmware always receives whole 12 byte chunks,
+            # it has no way to resynchronise on a dropped byte
+            while len(buffer) >= PACKET.size:
+                m = bytes(buffer[:PACKET.size])
+                del buffer[:PACKET.size]
+
+                # Time for the request to arrive and get handled
+                time.sleep(self.frame_time + self.processing)
+                reply = self.process(m)
+                if reply is None:
+                    continue
+
+                # Time for the reply to go out
+                time.sleep(self.frame_time)
+                os.write(self._master, self._damage(reply))
+
+
+def replay(records: np.ndarray, emulator: StageEmulator, realtime: bool = True, timeout: float = 1.0) -> dict:
+    """
+    Send the requests of a recorded stage trace to the emulator
+    Requests go out one at a time and each reply is compared to the
+    recorded one. Positions depend on where the emulated stage starts,
+    so differing replies are expected unless it matches the hardware.
+    :param records: trace records as loaded by StageTrace.load()
+    :param emulator: running emulator
+    :param realtime: keep the recorded spacing between requests
+    :param timeout: seconds to wait for each reply
+    :return: counts of replayed requests and how their replies compared
+    """
+    sent = records[records["direction"] == StageTraceDirection.SENT]
+    received = {
+        int(r["sequence"]): r for r in records[records["direction"] == StageTraceDirection.RECEIVED]
+    }
+
+    summary = {"requests": 0, "matched": 0, "differed": 0, "missing": 0, "unrecorded": 0,
+               "recorded_latency": 0.0, "replayed_latency": 0.0}
+    if not len(sent):
+        return summary
+
+    parser = StageFrameParser()
+    with emulator.serial(timeout) as ser:
+        start = time.monotonic()
+        t0 = sent[0]["time"]
+
+        for r in sent:
+            if realtime:
+                time.sleep(max(start + (r["time"] - t0) - time.monotonic(), 0))
+
+            sent_at = time.monotonic()
+            ser.write(r["frame"].tobytes())
+            summary["requests"] += 1
+
+            replies = []
+            deadline = sent_at + timeout
+            while not replies and time.monotonic() < deadline:
+                replies = parser.feed(ser.read(PACKET.size - parser.pending))
+            latency = time.monotonic() - sent_at
+
+            expected = received.get(int(r["sequence"]))
+            if not replies:
+                summary["missing"] += 1
+            elif expected is None:
+                summary["unrecorded"] += 1
+            else:
+                summary["replayed_latency"] += latency
+                summary["recorded_latency"] += float(expected["latency"])
+                if replies[0].encode() == expected["frame"].tobytes():
+                    summary["matched"] += 1
+                else:
+                    summary["differed"] += 1
+                    log.debug("Reply to %s differs", StageOpcode(replies[0].opcode).name)
+
+    compared = summary["matched"] + summary["differed"]
+    if compared:
+        summary["recorded_latency"] /= compared
+        summary["replayed_latency"] /= compared
+
+    return summary
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+
+    with StageEmulator() as emulator:
+        if len(args) >= 2:
+            print(replay(StageTrace.load(args[1]), emulator))
+            return 0
+
+        print(emulator.port, flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    exit(main(sys.argv))
@@ -1,4 +1,5 @@
 import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
 from typing import Optional, Tuple
 
 import numpy as np
@@ -8,37 +9,107 @@ from pytesseract import TesseractNotFoundError
 
 log = logging.getLogger(__name__)
 
+# detect_card_edge works on frames scaled down by this much
+EDGE_SCALE = 0.4
 
-def compute_error(img: np.ndarray, vx: float, vy: float, cx: float, cy: float):
+
+# Line fits detect_card_edge can use
+EDGE_FITS = ("l2", "huber", "ransac")
+
+# Columns in the coarsest level detect_card_edge_pyramid looks for edges on
+PYRAMID_WIDTH = 64
+
+# Rows the coarse level averages down to
+PYRAMID_HEIGHT = 48
+
+
+def line_residuals(points: np.ndarray, vx: float, vy: float, cx: float, cy: float) -> np.ndarray:
+    """
+    Signed perpendicular distance of each point to a line
+    :param points: (N, 2) or (N, 1, 2) x, y coordinates
+    :param vx: Delta X of the line
+    :param vy: Delta Y of the line
+    :param cx: X of a point on the line
+    :param cy: Y of a point on the line
+    :return: (N,) distances in pixels
     """
-    Compute the standard deviation of the point errors given
+    points = points.reshape(-1, 2)
+    return ((points[:, 0] - cx) * vy - (points[:, 1] - cy) * vx) / np.hypot(vx, vy)
+
+
+def fit_line(points: np.ndarray,
+             fit: str = "l2",
+             ransac_threshold: float = 10.0,
+             ransac_iterations: int = 64) -> Tuple[float, float, float, float]:
+    """
+    Fit a line through a point set
+    "l2" is a least squares fit, "huber" re-weights the points by their
+    residuals so outliers pull less on the line, "ransac" fits the points
+    within ransac_threshold of the line through the pair of points most
+    other points agree with.
+    :param points: (N, 1, 2) or (N, 2) coordinates such as from cv2.findNonZero
+    :param fit: one of EDGE_FITS
+    :param ransac_threshold: distance in pixels a point counts as agreeing with a line,
+        the Laplacian of a blurred edge is two bands either side of it which this has to span
+    :param ransac_iterations: number of point pairs tried
+    :return: vx, vy, cx, cy like cv2.fitLine
+    """
+    points = points.reshape(-1, 2).astype(np.float32)
+
+    if fit == "ransac" and len(points) > 2:
+        # Score every candidate line against every point at once
+        pairs = np.random.default_rng(0).integers(0, len(points), size=(ransac_iterations, 2))
+        a = points[pairs[:, 0]]
+        d = points[pairs[:, 1]] - a
+        norm = np.hypot(d[:, 0], d[:, 1])
+        norm[norm == 0] = np.inf
+
+        dist = np.abs((points[None, :, 0] - a[:, None, 0]) * d[:, None, 1]
+                      - (points[None, :, 1] - a[:, None, 1]) * d[:, None, 0]) / norm[:, None]
+        inliers = dist[np.argmax((dist < ransac_threshold).sum(axis=1))] < ransac_threshold
+        if inliers.sum() >= 2:
+            points = points[inliers]
+    elif fit not in EDGE_FITS:
+        raise ValueError(f"Unknown line fit {fit!r}")
+
+    vx, vy, cx, cy = cv2.fitLine(points, cv2.DIST_HUBER if fit == "huber" else cv2.DIST_L2, 0, 0.01, 0.01)
+    return vx[0], vy[0], cx[0], cy[0]
+
+
+def compute_error(img: np.ndarray, vx: float, vy: float, cx: float, cy: float,
+                  points: Optional[np.ndarray] = None):
+    """
+    Compute the spread of the point errors given
     a line of best fit
-    :param img: Image to compute standard deviation on
+    The error is the square root of the mean fourth power of the
+    perpendicular residuals, which is what the standard deviation
+    thresholds of detect_card_edge were tuned against.
+    :param img: Thresholded image the points come from
     :param vx: Delta X of regression.
     :param vy: Delta Y of regression.
     :param cx: Start X point of regression
     :param cy: Start Y point of regression
-    :return: Standard deviation in pixels
+    :param points: Points of img, found again if None
+    :return: Error and angle of the line from the Y axis in radians
     """
-    v = np.array([vx, vy])
-    p = np.array([cx, cy])
+    if points is None:
+        points = cv2.findNonZero(img)
 
-    # Find the rotation to align to Y-axis
-    # This will make the error between point-to-linear-regression
-    # the same as the X-coordinate
-    theta = np.arccos(np.dot(v, [0, 1]) / np.linalg.norm(v))
+    # Angle between the line and the Y-axis
+    theta = np.arccos(vy / np.hypot(vx, vy))
 
-    # Construct a rotation matrix
-    r = cv2.getRotationMatrix2D((cx, cy), -180 / np.pi * theta, 1.0)
-    rot_img = cv2.warpAffine(img, r, img.shape[0:2], flags=cv2.INTER_LINEAR)
+    err = line_residuals(points, vx, vy, cx, cy) ** 2
+    return np.sqrt(np.dot(err, err) / len(err)), theta
 
-    # Compute the error using only the X coordinate
-    # This will be the norm distance of each point to the line
-    points = cv2.findNonZero(rot_img).squeeze(1)
-    err = (points - p)[:, 0] ** 2
 
-    # Compute the standard deviation
-    return np.sqrt(np.einsum('i,i->', err, err) / len(points)), theta
+def motion_energy(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Measure how much changed between two frames
+    :param a: previous grayscale (or Y plane) frame
+    :param b: current frame of the same size
+    :return: mean absolute pixel difference in grey levels
+    """
+    return cv2.mean(cv2.absdiff(a, b))[0]
 
 
 def detect_card_edge(img: np.ndarray,
@@ -46,7 +117,8 @@ def detect_card_edge(img: np.ndarray,
                      num_points_threshold: int = 100,
                      standard_deviation_threshold: float = 50.0,
                      vertical_rad_threshold: float = 0.1,
-                     debug: bool = False) -> Tuple[Optional[float], np.ndarray]:
+                     debug: bool = False,
+                     fit: str = "l2") -> Tuple[Optional[float], np.ndarray]:
     """
     Find the line of best fit for the derivative of an image
     This is essentially like applying a linear regression to
@@ -57,14 +129,49 @@ def detect_card_edge(img: np.ndarray,
     :param standard_deviation_threshold: Threshold for linear regression standard deviation
     :param vertical_rad_threshold: Threshold for how vertical the edge of the card should be
     :param debug: Print debug messages
+    :param fit: Line fit to use, "l2", "huber" (re-weighted) or "ransac" (refit on the inliers)
     :return: None if card edge is not in image (a good, relatively vertical line was not found),
              Float from 0.0 - 1.0 indicating where the edge of the card on the image frame
             (0 means left side of the image, 1 means right side)
     """
     # Compress the data to a manageable size
     img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    scale = 0.4
-    img = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)))
+    img = cv2.resize(img, (int(img.shape[1] * EDGE_SCALE), int(img.shape[0] * EDGE_SCALE)))
+
+    return detect_card_edge_luma(img, laplacian_threshold, num_points_threshold,
+                                 standard_deviation_threshold, vertical_rad_threshold, debug, fit)
+
+
+def detect_card_edge_luma(img: np.ndarray,
+                          laplacian_threshold: float = 10.0,
+                          num_points_threshold: int = 100,
+                          standard_deviation_threshold: float = 50.0,
+                          vertical_rad_threshold: float = 0.1,
+                          debug: bool = False,
+                          fit: str = "l2") -> Tuple[Optional[float], np.ndarray]:
+    """
+    detect_card_edge for a grayscale frame already at the working resolution,
+    such as the Y plane of a lores stream
+    :param img: 8-bit grayscale image, EDGE_SCALE times the size of the stream frames
+    :param fit: line fit to use, see fit_line
+    :return: same as detect_card_edge
+    """
+    pos, img, _ = _fit_card_edge(img, laplacian_threshold, num_points_threshold,
+                                 standard_deviation_threshold, vertical_rad_threshold, debug, fit)
+    return pos, img
+
+
+def _fit_card_edge(img: np.ndarray,
+                   laplacian_threshold: float,
+                   num_points_threshold: int,
+                   standard_deviation_threshold: float,
+                   vertical_rad_threshold: float,
+                   debug: bool,
+                   fit: str) -> Tuple[Optional[float], np.ndarray, Optional[float]]:
+    """
+    detect_card_edge_luma, also returning the error of the line fit
+    (None if there were not enough points to fit)
+    """
     orig_img = img.copy()
 
     h, w = img.shape
@@ -91,14 +198,13 @@ def detect_card_edge(img: np.ndarray,
     if npoints < num_points_threshold:
         if debug:
             log.info("Found only %d points, no edges", npoints)
-        return None, orig_img
+        return None, orig_img, None
 
-    # Perform an L2 norm linear regression to get the line of
+    # Perform a linear regression to get the line of
     # best fit along the threshold edge
-    vx_r, vy_r, cx_r, cy_r = cv2.fitLine(points, cv2.DIST_L2, 0, 0.01, 0.01)
-    vx, vy, cx, cy = vx_r[0], vy_r[0], cx_r[0], cy_r[0]
+    vx, vy, cx, cy = fit_line(points, fit)
 
-    err, theta = compute_error(img, vx, vy, cx, cy)
+    err, theta = compute_error(img, vx, vy, cx, cy, points)
 
     if debug:
         log.info("Edge detection error: %.2f, theta: %.2f, num: %d", err, theta, npoints)
@@ -107,7 +213,7 @@ def detect_card_edge(img: np.ndarray,
     # We just fit some garbage
     if err > standard_deviation_threshold:
         log.info("Not a good line standard deviation: %.2f", err)
-        return None, img
+        return None, img, err
 
     # The line is not vertical enough
     # There are some edges in the image, but they are unlikely
@@ -116,7 +222,7 @@ def detect_card_edge(img: np.ndarray,
     if abs(theta) > vertical_rad_threshold and abs(theta - np.pi) > vertical_rad_threshold:
         if debug:
             log.info("Line not vertical enough %2.f rad", theta)
-        return None, img
+        return None, img, err
 
     # Solve for center of the parametric line
     # Solve a simple system of equations
@@ -130,7 +236,176 @@ def detect_card_edge(img: np.ndarray,
     # This will yield the center point along X axis
     # Scale this solution to the width
     pos = center_ts[1] / w
-    return pos, img
+    return pos, img, err
+
+
+def edge_profile(img: np.ndarray, width: int = PYRAMID_WIDTH, height: int = PYRAMID_HEIGHT) -> Tuple[np.ndarray, int]:
+    """
+    Column means of a coarse level of an image
+    Only every few rows are read, which is all a vertical edge needs.
+    :param img: 8-bit grayscale image
+    :param width: columns to average down to, at most the image width
+    :param height: rows to sample, at most the image height
+    :return: float32 grey level of each coarse column, and how many image columns each one covers
+    """
+    h, w = img.shape
+    f = max(1, w // width)
+    cols = cv2.reduce(img[::max(1, h // height)], 0, cv2.REDUCE_AVG, dtype=cv2.CV_32F)[0]
+    return cols[:w // f * f].reshape(-1, f).mean(axis=1), f
+
+
+def edge_profiles(frames: np.ndarray, width: int = PYRAMID_WIDTH, height: int = PYRAMID_HEIGHT) -> Tuple[np.ndarray, int]:
+    """
+    edge_profile of every frame in a stack at once
+    :param frames: (N, H, W) 8-bit grayscale frames
+    :return: (N, columns) float32 grey levels, and how many image columns each one covers
+    """
+    n, h, w = frames.shape
+    f = max(1, w // width)
+    cols = frames[:, ::max(1, h // height)].mean(axis=1, dtype=np.float32)
+    return cols[:, :w // f * f].reshape(n, -1, f).mean(axis=2), f
+
+
+def edge_steps(profiles: np.ndarray) -> np.ndarray:
+    """
+    Steps across two coarse columns of edge profiles, an edge on a
+    column boundary counts fully in one of them
+    :param profiles: (..., columns) from edge_profile or edge_profiles
+    :return: (..., columns - 2) absolute steps in grey levels
+    """
+    return np.abs(profiles[..., 2:] - profiles[..., :-2])
+
+
+def detect_card_edge_pyramid(img: np.ndarray,
+                             laplacian_threshold: float = 10.0,
+                             num_points_threshold: int = 100,
+                             standard_deviation_threshold: float = 50.0,
+                             vertical_rad_threshold: float = 0.1,
+                             debug: bool = False,
+                             fit: str = "l2",
+                             min_contrast: float = 20.0,
+                             candidates: int = 2,
+                             strip: int = 48) -> Tuple[Optional[float], np.ndarray, float]:
+    """
+    detect_card_edge_luma searching coarse to fine
+    Candidate vertical edges are the steepest steps in the column means
+    of a PYRAMID_WIDTH wide level, a frame with no step of min_contrast
+    is rejected without looking any closer. The line is then only fitted
+    within a strip around each candidate at the working resolution.
+    :param img: 8-bit grayscale image, EDGE_SCALE times the size of the stream frames
+    :param min_contrast: grey levels the card has to differ from the background by
+    :param candidates: most candidate edges to fit, steepest first
+    :param strip: width in pixels of the strip fitted around a candidate, at least four coarse columns
+    :return: same as detect_card_edge, and a confidence from 0.0 - 1.0 that the edge is the card,
+             how far its step stands out from the next steepest one in the frame
+    """
+    profile, f = edge_profile(img)
+    steps = edge_steps(profile)
+
+    peak = steps.max(initial=0.0)
+    if peak < min_contrast:
+        if debug:
+            log.info("Steepest step %.1f grey levels, no edges", peak)
+        return None, img, 0.0
+
+    pos, out, confidence, _ = _refine_card_edge(img, steps, f, laplacian_threshold, num_points_threshold,
+                                                standard_deviation_threshold, vertical_rad_threshold, debug, fit,
+                                                min_contrast, candidates, strip)
+    return pos, out, confidence
+
+
+def _refine_card_edge(img: np.ndarray,
+                      steps: np.ndarray,
+                      f: int,
+                      laplacian_threshold: float,
+                      num_points_threshold: int,
+                      standard_deviation_threshold: float,
+                      vertical_rad_threshold: float,
+                      debug: bool,
+                      fit: str,
+                      min_contrast: float,
+                      candidates: int,
+                      strip: int) -> Tuple[Optional[float], np.ndarray, float, Optional[float]]:
+    """
+    Fine half of detect_card_edge_pyramid, steps is modified
+    :return: position, image, confidence and error of the line fit
+    """
+    w = img.shape[1]
+    half = max(strip, 4 * f) // 2
+
+    out = img
+    for _ in range(candidates):
+        i = int(np.argmax(steps))
+        step = steps[i]
+        if step < min_contrast:
+            break
+
+        # Steps i and i + 2 straddle the middle of column i + 1
+        x = int((i + 1.5) * f)
+        x0, x1 = max(0, x - half), min(w, x + half)
+        pos, strip_img, err = _fit_card_edge(img[:, x0:x1], laplacian_threshold, num_points_threshold,
+                                             standard_deviation_threshold, vertical_rad_threshold, debug, fit)
+
+        if debug or pos is not None:
+            out = np.zeros_like(img)
+            out[:, x0:x1] = strip_img
+
+        # Neighbouring columns belong to the same edge
+        steps[max(0, i - 2):i + 3] = 0
+
+        if pos is not None:
+            confidence = 1.0 - float(steps.max(initial=0.0)) / step
+            return (x0 + pos * (x1 - x0)) / w, out, confidence, err
+
+    return None, out, 0.0, None
+
+
+def detect_card_edges(frames: np.ndarray,
+                      laplacian_threshold: float = 10.0,
+                      num_points_threshold: int = 100,
+                      standard_deviation_threshold: float = 50.0,
+                      vertical_rad_threshold: float = 0.1,
+                      fit: str = "l2",
+                      min_contrast: float = 20.0,
+                      candidates: int = 2,
+                      strip: int = 48,
+                      executor: Optional[Executor] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    detect_card_edge_pyramid over a stack of frames
+    The coarse level of every frame is searched at once, only the frames
+    with a candidate edge are fitted, spread over a thread pool since
+    OpenCV releases the GIL.
+    :param frames: (N, H, W) 8-bit grayscale frames, EDGE_SCALE times the size of the stream frames
+    :param executor: pool to fit the frames on, a thread per CPU for this call if None
+    :return: (N,) edge positions, line fit errors and confidences, NaN (and 0 confidence)
+             where a frame has no card edge
+    """
+    n = len(frames)
+    positions = np.full(n, np.nan)
+    errors = np.full(n, np.nan)
+    confidences = np.zeros(n)
+
+    profiles, f = edge_profiles(frames)
+    steps = edge_steps(profiles)
+    found = np.flatnonzero(steps.max(axis=1, initial=0.0) >= min_contrast)
+
+    def refine(i: int):
+        pos, _, confidence, err = _refine_card_edge(
+            frames[i], steps[i], f, laplacian_threshold, num_points_threshold,
+            standard_deviation_threshold, vertical_rad_threshold, False, fit,
+            min_contrast, candidates, strip)
+        if pos is not None:
+            positions[i] = pos
+            errors[i] = err
+            confidences[i] = confidence
+
+    if executor is None:
+        with ThreadPoolExecutor(thread_name_prefix="card-edge") as pool:
+            list(pool.map(refine, found))
+    else:
+        list(executor.map(refine, found))
+
+    return positions, errors, confidences
 
 
 def card_id(img: np.ndarray,
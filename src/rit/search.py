@@ -0,0 +1,216 @@
+import abc
+import enum
+import logging
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+
+class EdgeNotFoundError(RuntimeError):
+    """
+    The card edge was not in any frame taken where it could be
+    """
+    pass
+
+
+class EdgeSide(enum.IntEnum):
+    """
+    What a frame taken while searching for the card edge shows
+    """
+
+    # Only background, the edge is further forward
+    BEFORE = 0
+
+    # The edge is in view
+    EDGE = 1
+
+    # Only card, the edge is behind
+    AFTER = 2
+
+
+class AlignmentStats:
+    """
+    strategy: name of the search used
+    iterations: frames taken looking for the edge
+    moves: stage moves made looking for the edge
+    travel: eighth steps travelled looking for the edge
+    time: seconds from starting the alignment until the stage position was set
+    edge: eighth steps from the home limit the edge was found at
+    """
+
+    strategy: str
+    iterations: int
+    moves: int
+    travel: int
+    time: float
+    edge: Optional[int]
+
+    def __init__(self, strategy: str):
+        self.strategy = strategy
+        self.iterations = 0
+        self.moves = 0
+        self.travel = 0
+        self.time = 0.0
+        self.edge = None
+
+    def dict(self) -> dict:
+        return {
+            "strategy": self.strategy,
+            "iterations": self.iterations,
+            "moves": self.moves,
+            "travel": self.travel,
+            "time": self.time,
+            "edge": self.edge,
+        }
+
+
+class EdgeSearch(abc.ABC):
+    """
+    Picks where to look for the card edge next
+    Positions are eighth steps from the home limit. A frame taken at a
+    position finds the edge if it is within half a window of it.
+    """
+
+    name = "search"
+
+    # Whether frames without the edge need telling apart by which side of it they are on
+    uses_side = False
+
+    window: int
+    probes: int
+
+    def __init__(self, window: int):
+        """
+        :param window: eighth steps of travel the edge can be found across a frame
+        """
+        self.window = window
+        self.probes = 0
+
+    @abc.abstractmethod
+    def next(self) -> Optional[int]:
+        """
+        :return: position to take the next frame at, None if the edge cannot be anywhere left
+        """
+        pass
+
+    def update(self, position: int, side: EdgeSide):
+        """
+        Learn from the frame taken at a position
+        """
+        self.probes += 1
+
+
+class LinearSearch(EdgeSearch):
+    """
+    Step forward a fixed distance at a time until the edge shows up,
+    how System.align always searched
+    """
+
+    name = "linear"
+
+    step: int
+    end: int
+
+    def __init__(self, window: int, step: int, end: int, start: int = 0):
+        """
+        :param step: eighth steps between frames, at most the window to not step over the edge
+        :param end: give up past this position, such as the stage travel
+        :param start: position of the first frame is one step past this
+        """
+        super().__init__(window)
+        self.step = step
+        self.end = end
+        self._position = start
+
+    def next(self) -> Optional[int]:
+        position = self._position + self.step
+        if position > self.end:
+            return None
+        return position
+
+    def update(self, position: int, side: EdgeSide):
+        super().update(position, side)
+        self._position = position
+
+
+class GallopingSearch(EdgeSearch):
+    """
+    Start where the edge is expected and gallop away from it with doubling
+    steps in the direction the frames point to, until a frame lands on the
+    other side of the edge. The edge is then between two frames and the
+    gap is halved until a frame sees it.
+    """
+
+    name = "galloping"
+    uses_side = True
+
+    lo: int
+    hi: Optional[int]
+
+    def __init__(self, window: int, predicted: int, lo: int = 0, hi: Optional[int] = None):
+        """
+        :param predicted: where the edge is expected, such as where it was last aligned
+        :param lo: closest the edge can be to the home limit
+        :param hi: furthest the edge can be from the home limit, None if unknown
+        """
+        super().__init__(window)
+        self.predicted = predicted
+        self.lo = lo
+        self.hi = hi
+
+        self._last: Optional[int] = None
+        self._direction = 0
+        self._step = window
+        self._bracketed = False
+
+    def next(self) -> Optional[int]:
+        half = self.window // 2
+        lo, hi = self.lo, self.hi
+
+        if hi is not None and hi < lo:
+            # The frames disagree with the geometry
+            return None
+
+        if self._last is None:
+            position = self.predicted
+        elif self._bracketed or (hi is not None and hi - lo <= self.window):
+            position = (lo + hi) // 2
+        else:
+            position = self._last + self._direction * self._step
+
+        # Frames only need to reach the ends of the interval
+        if hi is not None and hi - lo > self.window:
+            position = min(max(position, lo + half), hi - half)
+        elif hi is not None:
+            position = (lo + hi) // 2
+        else:
+            position = max(position, lo + half)
+
+        if position == self._last:
+            # Already looked here
+            return None
+
+        return position
+
+    def update(self, position: int, side: EdgeSide):
+        super().update(position, side)
+        half = self.window // 2
+
+        if side == EdgeSide.BEFORE:
+            self.lo = max(self.lo, position + half)
+            direction = 1
+        elif side == EdgeSide.AFTER:
+            self.hi = position - half if self.hi is None else min(self.hi, position - half)
+            direction = -1
+        else:
+            return
+
+        if self._direction == -direction:
+            # Frames either side of the edge
+            self._bracketed = True
+        elif self._direction == direction:
+            self._step *= 2
+
+        self._direction = direction
+        self._last = position
+        log.debug("Edge between %d and %s after %d frames", self.lo, self.hi, self.probes)
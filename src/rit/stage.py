@@ -1,10 +1,17 @@
+import collections
 import enum
+import functools
+import itertools
 import logging
+import math
+import queue
 import struct
 import threading
 import time
-from typing import Union
+from concurrent.futures import Future
+from typing import Union, Optional, Callable, Deque, Tuple, List
 
+import numpy as np
 import serial
 
 from rit.crc import crc8
@@ -59,7 +66,115 @@ class StageStepSize(enum.IntEnum):
     EIGHTH = 3
 
 
+class StagePacketError(ValueError):
+    """
+    Raised when a reply does not look like a stage packet
+    """
+
+
+class StageChecksumError(StagePacketError):
+    """
+    Raised when a reply is framed right but its checksum does not match
+    """
+
+
+# Packet layouts are fixed, compile them once
+# 0xDEAD, opcode, arg, flags
+_HEAD_INT = struct.Struct("<BBHiB")
+_HEAD_FLOAT = struct.Struct("<BBHfB")
+
+# checksum, 0xBEEF
+_TAIL = struct.Struct("<BBB")
+
+# Replies always carry an integer argument, the start and
+# end markers are read as 0xADDE and 0xEFBE little endian
+_REPLY = struct.Struct("<HHiBBH")
+
+# Every packet starts with 0xDEAD, so the checksum
+# only has to be run over the bytes after it
+_CRC_START = crc8(b"\xDE\xAD")
+
+
+# Checksums of the bytes between 0xDEAD and the checksum, keyed on the
+# fields they were packed from. Polling traffic and its replies are the
+# same few packets over and over, so the checksum itself rarely runs.
+# Integer and float arguments that compare equal pack differently,
+# each layout has its own table.
+_CRC_CACHE_SIZE = 4096
+_CRC_INT: dict = {}
+_CRC_FLOAT: dict = {}
+
+
+def _body_crc(head: struct.Struct, cache: dict, opcode: int, arg: Union[int, float], flags: int) -> int:
+    key = (opcode, arg, flags)
+    crc = cache.get(key)
+    if crc is None:
+        if len(cache) >= _CRC_CACHE_SIZE:
+            cache.clear()
+        crc = cache[key] = crc8(head.pack(0xDE, 0xAD, opcode, arg, flags)[2:], _CRC_START)
+    return crc
+
+
+def _pack_into(buf: Union[bytearray, memoryview], offset: int, opcode: int, arg: Union[int, float], flags: int):
+    """
+    Write the wire format of a packet straight into a buffer
+    """
+    if type(arg) is int:
+        head, cache = _HEAD_INT, _CRC_INT
+    else:
+        head, cache = _HEAD_FLOAT, _CRC_FLOAT
+    head.pack_into(buf, offset, 0xDE, 0xAD, opcode, arg, flags)
+    _TAIL.pack_into(buf, offset + 9, _body_crc(head, cache, opcode, arg, flags), 0xBE, 0xEF)
+
+
+@functools.lru_cache(maxsize=1024, typed=True)
+def _encode(opcode: int, arg: Union[int, float], flags: int) -> bytes:
+    """
+    Build the wire format of a packet
+    Polling traffic (IDLE, GET_POSITION) is the same packet over
+    and over, so packets are only built once.
+    """
+    buf = bytearray(StagePacket.SIZE)
+    _pack_into(buf, 0, opcode, arg, flags)
+    return bytes(buf)
+
+
+def _unpack_from(m: Union[bytes, bytearray, memoryview], offset: int = 0) -> Tuple[int, int, int]:
+    """
+    Unpack and validate the wire format of a reply where it sits in a buffer
+    :return: opcode, arg and flags
+    :raises StagePacketError: not a whole packet, StageChecksumError if only the checksum is wrong
+    """
+    if len(m) - offset < StagePacket.SIZE:
+        raise StagePacketError(f"Expected 12 byte packet: {len(m) - offset}")
+
+    start, opcode, arg, flags, xsum, end = _REPLY.unpack_from(m, offset)
+
+    if start != 0xADDE:
+        raise StagePacketError(f"Bad packet start 0x{start & 0xFF:02x}{start >> 8:02x}")
+    if end != 0xEFBE:
+        raise StagePacketError(f"Bad packet end 0x{end & 0xFF:02x}{end >> 8:02x}")
+
+    crc = _CRC_INT.get((opcode, arg, flags))
+    if crc is None:
+        crc = _body_crc(_HEAD_INT, _CRC_INT, opcode, arg, flags)
+    if crc != xsum:
+        raise StageChecksumError(f"Reply to opcode {opcode} has a bad checksum 0x{crc:02x} != 0x{xsum:02x}")
+
+    return opcode, arg, flags
+
+
 class StagePacket:
+    """
+    12 byte packet exchanged with the microcontroller
+    Packets are packed into caller provided buffers using
+    precompiled struct layouts.
+    """
+
+    __slots__ = ("opcode", "arg", "flags")
+
+    SIZE = 12
+
     opcode: StageOpcode
     arg: Union[int, float]
     flags: int
@@ -71,39 +186,218 @@ class StagePacket:
         self.arg = arg
         self.flags = flags
 
+    def encode_into(self, buf: bytearray, offset: int = 0) -> bytearray:
+        """
+        Pack the packet into a preallocated buffer
+        :param buf: buffer with at least 12 bytes after offset
+        :param offset: where to start writing the packet
+        :return: buf
+        """
+        _pack_into(buf, offset, self.opcode, self.arg, self.flags)
+        return buf
+
     def encode(self) -> bytes:
-        packet_start = struct.pack(
-            f"<BBH{'i' if type(self.arg) is int else 'f'}B",
-            0xDE, 0xAD,
-            self.opcode,
-            self.arg,
-            self.flags)
+        return _encode(self.opcode, self.arg, self.flags)
 
-        return packet_start + struct.pack(
-            "BBB", crc8(packet_start), 0xBE, 0xEF)
+    @staticmethod
+    def decode_into(m: Union[bytes, bytearray], pkt: 'StagePacket', offset: int = 0) -> 'StagePacket':
+        """
+        Unpack a reply into an existing packet object
+        :param m: buffer holding the reply
+        :param pkt: packet to overwrite
+        :param offset: where the reply starts in m
+        :return: pkt
+        """
+        pkt.opcode, pkt.arg, pkt.flags = _unpack_from(m, offset)
+        return pkt
 
     @staticmethod
-    def decode(m: bytes) -> 'StagePacket':
-        assert len(m) == 12, f"Expected 12 byte packet: f{len(m)}"
+    def decode(m: Union[bytes, bytearray]) -> 'StagePacket':
+        return StagePacket(*_unpack_from(m))
+
 
-        s1, s2, opcode, arg, flags, xsum, e1, e2 = struct.unpack("BBHiBBBB", m)
+class StageFrameParser:
+    """
+    Pulls reply packets out of the raw UART byte stream.
+    Frames are located by their 0xDEAD start marker and are only
+    accepted with a 0xBEEF end marker and a matching checksum.
+    Anything else is skipped a byte at a time, so a lost or corrupted
+    byte costs the frame it landed in and the parser is back in sync
+    within the same read.
+    """
 
-        assert s1 == 0xDE and s2 == 0xAD, (hex(s1), hex(s2))
-        assert e1 == 0xBE and e2 == 0xEF, (hex(e1), hex(e2))
+    _START = b"\xDE\xAD"
 
-        calculated_crc = crc8(m[:9])
-        if calculated_crc != xsum:
-            log.warning("Checksum for %s mismatch 0x%02x != 0x%02x",
-                        StageOpcode(opcode).name, calculated_crc, xsum)
+    stats: Optional['StageStats']
 
-        return StagePacket(opcode, arg, flags)
+    def __init__(self, stats: Optional['StageStats'] = None):
+        self.stats = stats
+        self._buffer = bytearray()
+        self._synced = True
 
+    @property
+    def pending(self) -> int:
+        """
+        Bytes of an incomplete frame waiting for the rest to arrive
+        """
+        return len(self._buffer)
 
-class Stage:
+    def reset(self):
+        """
+        Throw away a partial frame whose remaining bytes are never coming
+        """
+        if self._buffer:
+            self._skip(len(self._buffer))
+
+    def _skip(self, n: int):
+        del self._buffer[:n]
+        if self.stats is not None:
+            # Count each loss of sync once, not every byte skipped to get it back
+            self.stats.framing_errors += self._synced
+            self.stats.dropped_bytes += n
+        self._synced = False
+
+    def feed(self, data: Union[bytes, bytearray]) -> List[StagePacket]:
+        """
+        Add bytes read from the port
+        :param data: raw bytes in arrival order
+        :return: every complete and valid packet found so far
+        """
+        buf = self._buffer
+        buf += data
+        packets = []
+
+        while buf:
+            start = buf.find(self._START)
+            if start < 0:
+                # A trailing 0xDE may be the first half of the next start marker
+                if len(buf) > 1 or buf[0] != 0xDE:
+                    self._skip(len(buf) - (buf[-1] == 0xDE))
+                break
+            if start:
+                self._skip(start)
+
+            if len(buf) < StagePacket.SIZE:
+                break
+
+            try:
+                opcode, arg, flags = _unpack_from(buf)
+            except StageChecksumError as e:
+                log.warning("Dropping reply: %s", e)
+                if self.stats is not None:
+                    self.stats.crc_errors += 1
+                self._skip(1)
+                continue
+            except StagePacketError as e:
+                log.debug("Resynchronising stage stream: %s", e)
+                self._skip(1)
+                continue
+
+            del buf[:StagePacket.SIZE]
+            self._synced = True
+            packets.append(StagePacket(opcode, arg, flags))
+
+        return packets
+
+
+# Eighth steps moved by a single step of each size
+STEP_EIGHTHS = {
+    StageStepSize.FULL: 8,
+    StageStepSize.HALF: 4,
+    StageStepSize.QUARTER: 2,
+    StageStepSize.EIGHTH: 1,
+}
+
+
+class StageMotion:
     """
-    Primary driver to interface with the single axis stage
-    Given a UART serial port, all the Tx/Rx operations are
-    hidden behind this class
+    Expected timing of a motion request.
+    The firmware takes one step per timer tick regardless of
+    the step size, so a motion lasts steps / step_rate seconds.
+    """
+
+    steps: Optional[int]
+    step_rate: int
+    started_at: float
+    origin: Optional[int]
+    step: int
+    failed: bool
+    stopped: bool
+
+    def __init__(self,
+                 steps: Optional[int],
+                 step_rate: int,
+                 started_at: float,
+                 origin: Optional[int] = None,
+                 step: int = 0):
+        """
+        :param steps: number of steps in the motion, None if unknown
+        :param step_rate: motor step rate in hertz
+        :param started_at: monotonic time the motion started
+        :param origin: position the motion started from in eighth steps, None if unknown
+        :param step: signed eighth steps moved per motor step
+        """
+        self.steps = steps
+        self.step_rate = step_rate
+        self.started_at = started_at
+        self.origin = origin
+        self.step = step
+
+        # Set once a reply shows the motion hit a limit switch
+        self.failed = False
+
+        # Set when STOP or EMERGENCY_STOP cut the motion short
+        self.stopped = False
+
+    @property
+    def duration(self) -> Optional[float]:
+        """
+        Predicted motion time in seconds, None if the number of steps is unknown
+        """
+        if self.steps is None:
+            return None
+        return self.steps / self.step_rate
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        Monotonic time the motion is predicted to finish at
+        """
+        duration = self.duration
+        if duration is None:
+            return None
+        return self.started_at + duration
+
+    @property
+    def target(self) -> Optional[int]:
+        """
+        Position the motion will end at, None if unknown
+        """
+        if self.origin is None or self.steps is None:
+            return None
+        return self.origin + self.steps * self.step
+
+    def position_at(self, now: float) -> Optional[int]:
+        """
+        Dead reckon the position of the stage part way through the motion
+        :param now: monotonic time
+        :return: position in eighth steps, None if unknown
+        """
+        if self.origin is None:
+            return None
+        if self.steps is None:
+            return self.origin
+
+        done = min(int((now - self.started_at) * self.step_rate), self.steps)
+        return self.origin + max(done, 0) * self.step
+
+
+class StageState:
+    """
+    Host side model of the stage.
+    Flags are taken from every reply. The position is dead reckoned
+    from the requests sent to the stage and only needs to be read back
+    from the hardware when it is unknown or too old.
     """
 
     limit_1: bool
@@ -114,11 +408,13 @@ class Stage:
     failure: bool
     calibrated: bool
 
-    mutex: threading.Lock
-
-    def __init__(self, ser: Union[serial.Serial, None]):
-        self.serial = ser
+    step_rate: int
+    position: Optional[int]
+    motion: Optional[StageMotion]
+    moves: int
+    updated_at: float
 
+    def __init__(self, step_rate: int):
         self.limit_1 = False
         self.limit_2 = False
         self.estop = False
@@ -127,37 +423,35 @@ class Stage:
         self.failure = False
         self.calibrated = False
 
-        self.mutex = threading.Lock()
-
-        with self.mutex:
-            if self.serial:
-                self.serial.flush()
+        self.step_rate = step_rate
+        self.position = None
+        self.motion = None
+        self.moves = 0
+        self.updated_at = float("-inf")
 
-    def send(self, pkt: StagePacket):
+    def age(self, now: Optional[float] = None) -> float:
         """
-        Send a packet to the microcontroller and
-        wait for a reply.
-        :param pkt:
-        :return:
+        Seconds since the last reply from the hardware
         """
+        return (time.monotonic() if now is None else now) - self.updated_at
 
-        with self.mutex:
-            if self.serial:
-                self.serial.flush()
-                self.serial.reset_input_buffer()
-                self.serial.reset_output_buffer()
-                self.serial.write(pkt.encode())
-                reply_bytes = self.serial.read(12)
-            else:
-                if pkt.opcode == StageOpcode.SET_POSITION:
-                    self.calibrated = True
-                reply_bytes = StagePacket(pkt.opcode, 0, StageFlags.CALIBRATED if self.calibrated else 0).encode()
-
-        if len(reply_bytes) < 12:
-            raise TimeoutError(f"Stage UART timed out while waiting for a reply to {pkt.opcode.name}")
-
-        reply = StagePacket.decode(reply_bytes)
+    def estimate_position(self, now: Optional[float] = None) -> Optional[int]:
+        """
+        Best guess of the current stage position
+        :param now: monotonic time
+        :return: position in eighth steps, None if unknown
+        """
+        if self.motion:
+            return self.motion.position_at(time.monotonic() if now is None else now)
+        return self.position
 
+    def apply(self, pkt: StagePacket, reply: StagePacket, now: float):
+        """
+        Update the model with the reply to a request
+        :param pkt: packet that was sent
+        :param reply: reply from the microcontroller
+        :param now: monotonic time the reply was received
+        """
         self.limit_1 = bool(StageFlags.LIMIT_1 & reply.flags)
         self.limit_2 = bool(StageFlags.LIMIT_2 & reply.flags)
         self.estop = bool(StageFlags.ESTOP & reply.flags)
@@ -165,8 +459,802 @@ class Stage:
         self.led = bool(StageFlags.LED & reply.flags)
         self.failure = bool(StageFlags.FAILURE & reply.flags)
         self.calibrated = bool(StageFlags.CALIBRATED & reply.flags)
+        self.updated_at = now
+
+        opcode = pkt.opcode
+        if opcode == StageOpcode.SPEED:
+            # The firmware refuses to change speed during a motion
+            if reply.arg == 0:
+                self.step_rate = pkt.arg
+        elif opcode == StageOpcode.SET_POSITION:
+            self.position = pkt.arg
+            self.motion = None
+        elif opcode == StageOpcode.GET_POSITION:
+            if self.motion and self.running:
+                # Re-anchor the motion on the real position
+                motion = self.motion
+                target = motion.target
+                if target is not None and motion.step:
+                    motion.steps = abs(target - reply.arg) // abs(motion.step)
+                elif motion.steps is not None:
+                    done = min(int((now - motion.started_at) * motion.step_rate), motion.steps)
+                    motion.steps -= max(done, 0)
+                motion.origin = reply.arg
+                motion.started_at = now
+            else:
+                self.position = reply.arg
+        elif opcode in (StageOpcode.RELATIVE, StageOpcode.ABSOLUTE):
+            if reply.arg == 0:
+                self.moves += 1
+                if self.running:
+                    self.motion = self._plan(pkt, now)
+        elif opcode in (StageOpcode.STOP, StageOpcode.EMERGENCY_STOP):
+            if self.motion:
+                # Stopped part way, we no longer know where we are
+                self.motion.stopped = True
+                self.motion = None
+                self.position = None
+
+        if self.motion and self.failure:
+            # The firmware only reports the failure while it steps
+            # off the limit switch, remember it for the end of the motion
+            self.motion.failed = True
+
+        if self.motion and not self.running:
+            # Motion is over, a limit switch hit means
+            # the stage stepped off somewhere unknown
+            self.position = None if self.motion.failed else self.motion.target
+            self.motion = None
+
+    def _plan(self, pkt: StagePacket, now: float) -> StageMotion:
+        size = STEP_EIGHTHS.get(pkt.flags & 0x0F, 1)
+        origin = self.position
+
+        if pkt.opcode == StageOpcode.RELATIVE:
+            # The firmware holds the step count in 16 bits
+            steps = pkt.arg & 0xFFFF
+            step = -size if pkt.flags & StageFlags.MOTOR_IS_REVERSED else size
+        elif origin is not None:
+            delta = pkt.arg - origin
+            steps = abs(delta) // size
+            step = -size if delta < 0 else size
+        else:
+            # Absolute motion from an unknown position
+            steps = None
+            step = 0
+
+        return StageMotion(steps, self.step_rate, now, origin, step)
+
+    def dict(self, now: Optional[float] = None) -> dict:
+        now = time.monotonic() if now is None else now
+        return {
+            "limit1": self.limit_1,
+            "limit2": self.limit_2,
+            "estop": self.estop,
+            "running": self.running,
+            "led": self.led,
+            "failure": self.failure,
+            "calibrated": self.calibrated,
+            "position": self.estimate_position(now),
+            "age": self.age(now),
+        }
+
+
+class StagePriority(enum.IntEnum):
+    URGENT = 0
+    NORMAL = 1
+
+
+class StageRequest:
+    """
+    A single packet waiting to go out to the microcontroller
+    along with the future its reply will be delivered to
+    """
+
+    sequence: int
+    packet: StagePacket
+    priority: StagePriority
+    future: Future
+    submitted_at: float
+    sent_at: float
+    retries: int
+
+    def __init__(self, sequence: int, packet: StagePacket, priority: StagePriority = StagePriority.NORMAL):
+        self.sequence = sequence
+        self.packet = packet
+        self.priority = priority
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.sent_at = 0.0
+        self.retries = 0
+
+
+class StageStats:
+    """
+    Counters kept by the stage driver and its I/O thread
+    """
+
+    sent: int
+    received: int
+    timeouts: int
+    mismatches: int
+    retries: int
+    round_trip_total: float
+
+    framing_errors: int
+    crc_errors: int
+    dropped_bytes: int
+
+    urgent: int
+    urgent_latency_total: float
+    urgent_latency_max: float
+
+    moves: int
+    move_overhead_total: float
+    move_overhead_max: float
+
+    status_reads: int
+    status_refreshes: int
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.mismatches = 0
+        self.retries = 0
+        self.round_trip_total = 0.0
+
+        self.framing_errors = 0
+        self.crc_errors = 0
+        self.dropped_bytes = 0
+
+        self.urgent = 0
+        self.urgent_latency_total = 0.0
+        self.urgent_latency_max = 0.0
+
+        self.moves = 0
+        self.move_overhead_total = 0.0
+        self.move_overhead_max = 0.0
+
+        self.status_reads = 0
+        self.status_refreshes = 0
+
+    @property
+    def round_trip_mean(self) -> float:
+        return self.round_trip_total / self.received if self.received else 0.0
+
+    @property
+    def urgent_latency_mean(self) -> float:
+        return self.urgent_latency_total / self.urgent if self.urgent else 0.0
+
+    @property
+    def move_overhead_mean(self) -> float:
+        return self.move_overhead_total / self.moves if self.moves else 0.0
+
+    def dict(self) -> dict:
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "timeouts": self.timeouts,
+            "mismatches": self.mismatches,
+            "retries": self.retries,
+            "round_trip_mean": self.round_trip_mean,
+            "framing_errors": self.framing_errors,
+            "crc_errors": self.crc_errors,
+            "dropped_bytes": self.dropped_bytes,
+            "urgent": self.urgent,
+            "urgent_latency_mean": self.urgent_latency_mean,
+            "urgent_latency_max": self.urgent_latency_max,
+            "moves": self.moves,
+            "move_overhead_mean": self.move_overhead_mean,
+            "move_overhead_max": self.move_overhead_max,
+            "status_reads": self.status_reads,
+            "status_refreshes": self.status_refreshes,
+        }
+
+
+class StageTraceDirection(enum.IntEnum):
+    SENT = 0
+    RECEIVED = 1
+
+
+# One record per packet on the wire. Frames are kept raw so that
+# a trace can be decoded later or sent again to the emulator.
+STAGE_TRACE_DTYPE = np.dtype([
+    ("time", "<f8"),
+    ("sequence", "<i4"),
+    ("direction", "u1"),
+    ("frame", "u1", (StagePacket.SIZE,)),
+    ("latency", "<f4"),
+])
+
+
+class StageTrace:
+    """
+    Opt-in recorder of the packets exchanged with the microcontroller.
+    Packets are kept in a fixed size ring of STAGE_TRACE_DTYPE records
+    with monotonic timestamps, the oldest records are overwritten once
+    it is full. Round trip latencies are also binned per opcode into
+    log spaced histograms which are not limited by the ring size.
+    """
+
+    # Latency histogram bins: 10 per decade from 10us to 10s
+    BINS_PER_DECADE = 10
+    MIN_DECADE = -5
+    MAX_DECADE = 1
+
+    capacity: int
+    count: int
+    edges: np.ndarray
+
+    def __init__(self, capacity: int = 65536):
+        self.capacity = capacity
+        self.count = 0
+        self._records = np.zeros(capacity, dtype=STAGE_TRACE_DTYPE)
+        self._lock = threading.Lock()
+
+        nbins = (self.MAX_DECADE - self.MIN_DECADE) * self.BINS_PER_DECADE
+        self.edges = np.logspace(self.MIN_DECADE, self.MAX_DECADE, nbins + 1)
+
+        # Under and overflow bins on either side
+        self._histograms = np.zeros((len(StageOpcode), nbins + 2), dtype=np.int64)
+
+    def record(self, direction: StageTraceDirection, sequence: int, frame: bytes,
+               t: Optional[float] = None, latency: float = 0.0):
+        """
+        Add a packet to the trace
+        :param direction: sent to or received from the microcontroller
+        :param sequence: sequence number of the request the packet belongs to, -1 for unsolicited replies
+        :param frame: the 12 bytes on the wire
+        :param t: monotonic time the packet was sent or received
+        :param latency: round trip time for a received packet
+        """
+        t = time.monotonic() if t is None else t
+
+        with self._lock:
+            self._records[self.count % self.capacity] = (
+                t, sequence, direction, np.frombuffer(frame, dtype=np.uint8), latency)
+            self.count += 1
 
-        return reply
+            if direction == StageTraceDirection.RECEIVED and sequence >= 0:
+                opcode = frame[2] | frame[3] << 8
+                if opcode < len(self._histograms):
+                    self._histograms[opcode, self._bin(latency)] += 1
+
+    def _bin(self, latency: float) -> int:
+        if latency <= 0:
+            return 0
+        b = math.floor((math.log10(latency) - self.MIN_DECADE) * self.BINS_PER_DECADE) + 1
+        return min(max(b, 0), self._histograms.shape[1] - 1)
+
+    def records(self) -> np.ndarray:
+        """
+        Copy of the recorded packets, oldest first
+        """
+        with self._lock:
+            if self.count <= self.capacity:
+                return self._records[:self.count].copy()
+            start = self.count % self.capacity
+            return np.concatenate((self._records[start:], self._records[:start]))
+
+    def histogram(self, opcode: StageOpcode) -> np.ndarray:
+        """
+        Round trip latency counts for an opcode
+        :return: counts, the first and last bins hold latencies below edges[0] and above edges[-1]
+        """
+        with self._lock:
+            return self._histograms[opcode].copy()
+
+    def percentile(self, opcode: StageOpcode, q: float) -> Optional[float]:
+        """
+        Estimate a latency percentile from the histogram of an opcode
+        :param q: percentile between 0 and 100
+        :return: upper edge of the bin holding the percentile, None with no samples
+        """
+        counts = self.histogram(opcode)
+        total = counts.sum()
+        if total == 0:
+            return None
+
+        b = int(np.searchsorted(np.cumsum(counts), total * q / 100.0))
+        return float(self.edges[min(b, len(self.edges) - 1)])
+
+    def dict(self) -> dict:
+        histograms = {}
+        for opcode in StageOpcode:
+            counts = self.histogram(opcode)
+            if not counts.any():
+                continue
+            histograms[opcode.name] = {
+                "count": int(counts.sum()),
+                "p50": self.percentile(opcode, 50),
+                "p90": self.percentile(opcode, 90),
+                "p99": self.percentile(opcode, 99),
+                "counts": counts.tolist(),
+            }
+
+        return {
+            "capacity": self.capacity,
+            "recorded": self.count,
+            "edges": self.edges.tolist(),
+            "histograms": histograms,
+        }
+
+    def export(self, f):
+        """
+        Save the recorded packets, oldest first, in numpy .npy format
+        :param f: path or binary file object
+        """
+        np.save(f, self.records(), allow_pickle=False)
+
+    @staticmethod
+    def load(f) -> np.ndarray:
+        """
+        Load packets saved by export()
+        :param f: path or binary file object
+        :return: STAGE_TRACE_DTYPE records
+        """
+        records = np.load(f, allow_pickle=False)
+        if records.dtype != STAGE_TRACE_DTYPE:
+            raise ValueError(f"Not a stage trace: {records.dtype}")
+        return records
+
+
+class StageIO:
+    """
+    Dedicated I/O thread that owns the stage UART.
+    Requests are pulled from a queue and written to the port
+    without flushing or resetting the buffers. Replies are matched
+    back to their request by opcode in sequence order and delivered
+    through a future.
+
+    The firmware has a single receive buffer and does not echo a
+    sequence number, so by default only one request is kept in flight.
+    Urgent requests (STOP, EMERGENCY_STOP) skip the queue, they go out
+    as soon as the requests already in flight got their reply and ahead
+    of anything queued. Writing them any earlier would put their bytes on
+    the line while the firmware still receives or answers the request in
+    flight, it drops bytes while it transmits and one of the two is lost.
+    A motion request is never retried, losing one would leave the stage
+    somewhere nobody asked for.
+
+    Replies are pulled out of the byte stream by a StageFrameParser.
+    The port timeout is shortened to the frame gap so that a frame cut
+    short by a lost byte is noticed right away rather than after the
+    full reply timeout. A request whose reply was garbled or never came
+    is sent again once, unless it is a motion request which the
+    firmware may already have acted on.
+    """
+
+    # Queue marker used to wake up the I/O thread
+    # when an urgent request is waiting
+    _WAKE = object()
+
+    # Requests that are safe to send a second time
+    RETRYABLE = frozenset(set(StageOpcode) - {StageOpcode.RELATIVE, StageOpcode.ABSOLUTE})
+
+    serial: serial.Serial
+    max_in_flight: int
+    max_retries: int
+    reply_timeout: float
+    frame_gap: float
+    stats: StageStats
+    trace: Optional[StageTrace]
+
+    def __init__(self,
+                 ser: serial.Serial,
+                 on_reply: Optional[Callable[[StagePacket, StagePacket], None]] = None,
+                 max_in_flight: int = 1,
+                 stats: Optional[StageStats] = None,
+                 max_retries: int = 1,
+                 frame_gap: float = 0.02):
+        """
+        :param ser: UART connected to the microcontroller, its timeout is used as the reply timeout
+        :param on_reply: called from the I/O thread with each request and its reply
+        :param max_in_flight: number of requests allowed to wait on a reply at once
+        :param stats: counters to update, a new set is made if not given
+        :param max_retries: times a lost reply is retried for requests in RETRYABLE
+        :param frame_gap: silence (seconds) in the middle of a frame after which it is considered lost
+        """
+        assert max_in_flight >= 1, max_in_flight
+
+        self.serial = ser
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.stats = stats if stats is not None else StageStats()
+        self.trace = None
+
+        # Reads return after a frame gap of silence, the
+        # overall reply deadline is kept by the I/O thread
+        self.reply_timeout = ser.timeout or 1.0
+        self.frame_gap = frame_gap
+        self.serial.timeout = frame_gap
+
+        self._parser = StageFrameParser(self.stats)
+        self._replies: Deque[StagePacket] = collections.deque()
+
+        self._on_reply = on_reply
+        self._sequence = itertools.count()
+        self._requests: queue.Queue = queue.Queue()
+        self._urgent: Deque[StageRequest] = collections.deque()
+
+        # Guards writes to the port and the in-flight list
+        self._lock = threading.Lock()
+        self._tx = bytearray(StagePacket.SIZE)
+        self._in_flight: Deque[StageRequest] = collections.deque()
+
+        # Drop anything left over from a previous session
+        self.serial.reset_input_buffer()
+
+        self._thread = threading.Thread(target=self._run, name="stage-io", daemon=True)
+        self._thread.start()
+
+    def submit(self, pkt: StagePacket, priority: StagePriority = StagePriority.NORMAL) -> Future:
+        """
+        Queue a packet to be sent to the microcontroller
+        :param pkt: packet to send
+        :param priority: URGENT packets are written ahead of queued traffic, once
+            the requests in flight got their reply, which is at most a round trip
+        :return: future resolving to the reply packet
+        """
+        request = StageRequest(next(self._sequence), pkt, priority)
+
+        if priority == StagePriority.URGENT:
+            self._urgent.append(request)
+            self._requests.put(self._WAKE)
+        else:
+            self._requests.put(request)
+
+        return request.future
+
+    def close(self):
+        """
+        Stop the I/O thread. Requests still in the queue are failed.
+        """
+        self._requests.put(None)
+        self._thread.join()
+
+    def _fail(self, request: StageRequest, exc: BaseException):
+        if not request.future.done():
+            request.future.set_exception(exc)
+
+    def _write(self, request: StageRequest):
+        """
+        Called with the lock held, which also guards the transmit buffer
+        """
+        request.packet.encode_into(self._tx)
+        request.sent_at = time.monotonic()
+        self.serial.write(self._tx)
+        self._in_flight.append(request)
+        self.stats.sent += 1
+
+        trace = self.trace
+        if trace is not None:
+            trace.record(StageTraceDirection.SENT, request.sequence, bytes(self._tx), request.sent_at)
+
+    def _fill(self) -> bool:
+        """
+        Write queued requests until the pipeline is full
+        Urgent requests go first, once the line is quiet, and hold
+        back queued ones until then. Only block on the queue when
+        nothing is waiting for a reply.
+        :return: False when the I/O thread has been asked to exit
+        """
+        while True:
+            if self._urgent:
+                if self._in_flight:
+                    # Written as soon as the reply to the request in flight is in
+                    break
+                request = self._urgent.popleft()
+            elif len(self._in_flight) >= self.max_in_flight:
+                break
+            else:
+                try:
+                    request = self._requests.get(block=not self._in_flight)
+                except queue.Empty:
+                    break
+
+                if request is None:
+                    return False
+                if request is self._WAKE:
+                    continue
+
+            if not request.future.set_running_or_notify_cancel():
+                continue
+
+            with self._lock:
+                self._write(request)
+
+        return True
+
+    def _read_reply(self) -> Optional[StagePacket]:
+        """
+        Read from the port until the parser has a complete reply
+        :return: the next reply, None if nothing arrived before the reply timeout
+        :raises StagePacketError: the reply was garbled, the stream went quiet
+            while bytes that did not make up a valid frame were seen
+        """
+        deadline = time.monotonic() + self.reply_timeout
+        dropped = self.stats.dropped_bytes
+
+        while not self._replies:
+            data = self.serial.read(StagePacket.SIZE - self._parser.pending)
+            if data:
+                self._replies.extend(self._parser.feed(data))
+                continue
+
+            if self._parser.pending:
+                # The rest of this frame is not coming
+                self._parser.reset()
+            if self.stats.dropped_bytes != dropped:
+                raise StagePacketError(f"{self.stats.dropped_bytes - dropped} bytes did not frame")
+            if time.monotonic() >= deadline:
+                return None
+
+        return self._replies.popleft()
+
+    def _retry_or_fail(self, exc: BaseException):
+        """
+        Deal with the oldest request not getting a usable reply
+        :param exc: error to fail the request with if it can't be retried
+        """
+        with self._lock:
+            request = self._in_flight.popleft()
+            if request.retries < self.max_retries and request.packet.opcode in self.RETRYABLE:
+                log.warning("%s, retrying", exc)
+                request.retries += 1
+                self.stats.retries += 1
+                self._write(request)
+                return
+
+        self._fail(request, exc)
+
+    def _receive(self):
+        """
+        Read a single reply and hand it to the matching request
+        """
+        try:
+            reply = self._read_reply()
+        except StagePacketError as e:
+            self._retry_or_fail(IOError(
+                f"Garbled reply to {self._in_flight[0].packet.opcode.name}: {e}"))
+            return
+
+        if reply is None:
+            self.stats.timeouts += 1
+            self._retry_or_fail(TimeoutError(
+                f"Stage UART timed out while waiting for a reply to {self._in_flight[0].packet.opcode.name}"))
+            return
+
+        # Replies come back in sequence order, anything older than
+        # the first request with a matching opcode lost its reply
+        with self._lock:
+            lost = []
+            while self._in_flight and self._in_flight[0].packet.opcode != reply.opcode:
+                lost.append(self._in_flight.popleft())
+            request = self._in_flight.popleft() if self._in_flight else None
+
+        for r in lost:
+            self.stats.mismatches += 1
+            self._fail(r, IOError(
+                f"Reply to {r.packet.opcode.name} was lost (got {StageOpcode(reply.opcode).name})"))
+
+        trace = self.trace
+        if request is None:
+            log.warning("Dropping unsolicited reply to opcode %d", reply.opcode)
+            if trace is not None:
+                trace.record(StageTraceDirection.RECEIVED, -1, reply.encode())
+            return
+
+        now = time.monotonic()
+        self.stats.received += 1
+        self.stats.round_trip_total += now - request.sent_at
+        if trace is not None:
+            trace.record(StageTraceDirection.RECEIVED, request.sequence, reply.encode(), now, now - request.sent_at)
+        if request.priority == StagePriority.URGENT:
+            latency = now - request.submitted_at
+            self.stats.urgent += 1
+            self.stats.urgent_latency_total += latency
+            self.stats.urgent_latency_max = max(self.stats.urgent_latency_max, latency)
+
+        # Update driver state before waking up the caller
+        if self._on_reply:
+            self._on_reply(request.packet, reply)
+
+        request.future.set_result(reply)
+
+    def _run(self):
+        running = True
+        while running or self._in_flight:
+            try:
+                running = running and self._fill()
+                if self._in_flight:
+                    self._receive()
+            except serial.SerialException as e:
+                log.error("Stage UART failure: %s", e)
+                with self._lock:
+                    failed = list(self._in_flight)
+                    self._in_flight.clear()
+                for request in failed:
+                    self._fail(request, e)
+
+        # Fail anyone still waiting in the queue
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(request, StageRequest):
+                self._fail(request, RuntimeError("Stage I/O thread has been closed"))
+        while self._urgent:
+            self._fail(self._urgent.popleft(), RuntimeError("Stage I/O thread has been closed"))
+
+
+class Stage:
+    """
+    Primary driver to interface with the single axis stage
+    Given a UART serial port, all the Tx/Rx operations are
+    hidden behind this class
+    """
+
+    # Firmware boots with the step timer at 1MHz / 4000
+    DEFAULT_STEP_RATE = 250
+
+    # Start polling this long before a motion is predicted to finish
+    COMPLETION_LEAD = 0.02
+
+    # Polling period once a motion is about to finish
+    COMPLETION_POLL = 0.005
+
+    state: StageState
+    status_ttl: float
+    stats: StageStats
+    io: Optional[StageIO]
+
+    def __init__(self,
+                 ser: Union[serial.Serial, None],
+                 max_in_flight: int = 1,
+                 status_ttl: float = 0.25):
+        """
+        :param ser: UART connected to the microcontroller, None for a dummy stage
+        :param max_in_flight: number of requests allowed to wait on a reply at once
+        :param status_ttl: how old (seconds) the cached stage state may get before status() reads the hardware
+        """
+        self.serial = ser
+        self.state = StageState(self.DEFAULT_STEP_RATE)
+        self.status_ttl = status_ttl
+        self.stats = StageStats()
+
+        # Set whenever a reply shows the motor is not running
+        self._motion_done = threading.Event()
+        self._motion_done.set()
+
+        self._trace: Optional[StageTrace] = None
+        self._dummy_sequence = itertools.count()
+
+        if self.serial:
+            self.io = StageIO(self.serial, self._on_reply, max_in_flight, self.stats)
+        else:
+            self.io = None
+
+    @property
+    def limit_1(self) -> bool:
+        return self.state.limit_1
+
+    @property
+    def limit_2(self) -> bool:
+        return self.state.limit_2
+
+    @property
+    def estop(self) -> bool:
+        return self.state.estop
+
+    @property
+    def running(self) -> bool:
+        return self.state.running
+
+    @property
+    def led(self) -> bool:
+        return self.state.led
+
+    @property
+    def failure(self) -> bool:
+        return self.state.failure
+
+    @property
+    def calibrated(self) -> bool:
+        return self.state.calibrated
+
+    @property
+    def step_rate(self) -> int:
+        return self.state.step_rate
+
+    @property
+    def motion(self) -> Optional[StageMotion]:
+        return self.state.motion
+
+    @property
+    def trace(self) -> Optional[StageTrace]:
+        return self._trace
+
+    def start_trace(self, capacity: int = 65536) -> StageTrace:
+        """
+        Start recording every packet sent and received
+        :param capacity: number of packets kept before the oldest get overwritten
+        :return: the new trace
+        """
+        self._trace = StageTrace(capacity)
+        if self.io:
+            self.io.trace = self._trace
+        return self._trace
+
+    def stop_trace(self) -> Optional[StageTrace]:
+        """
+        Stop recording packets
+        :return: the trace recorded so far
+        """
+        trace = self._trace
+        self._trace = None
+        if self.io:
+            self.io.trace = None
+        return trace
+
+    def close(self):
+        """
+        Shut down the I/O thread owning the serial port
+        """
+        if self.io:
+            self.io.close()
+
+    def _on_reply(self, pkt: StagePacket, reply: StagePacket):
+        self.state.apply(pkt, reply, time.monotonic())
+
+        # A reply to a packet queued before the motion started shows the
+        # motor stopped, the next one showing it running re-arms the waiter
+        if self.state.running:
+            self._motion_done.clear()
+        else:
+            self._motion_done.set()
+
+    def submit(self, pkt: StagePacket, priority: StagePriority = StagePriority.NORMAL) -> Future:
+        """
+        Queue a packet to the microcontroller without
+        waiting for the reply.
+        :param pkt:
+        :param priority: URGENT packets go out ahead of any queued traffic
+        :return: future resolving to the reply packet
+        """
+        if self.io:
+            return self.io.submit(pkt, priority)
+
+        calibrated = self.calibrated or pkt.opcode == StageOpcode.SET_POSITION
+        arg = 0
+        if pkt.opcode == StageOpcode.GET_POSITION:
+            arg = self.state.estimate_position() or 0
+
+        reply = StagePacket(pkt.opcode, arg, StageFlags.CALIBRATED if calibrated else 0)
+        self._on_reply(pkt, reply)
+
+        trace = self._trace
+        if trace is not None:
+            sequence = next(self._dummy_sequence)
+            now = time.monotonic()
+            trace.record(StageTraceDirection.SENT, sequence, pkt.encode(), now)
+            trace.record(StageTraceDirection.RECEIVED, sequence, reply.encode(), now)
+
+        future = Future()
+        future.set_result(reply)
+        return future
+
+    def send(self, pkt: StagePacket, priority: StagePriority = StagePriority.NORMAL) -> StagePacket:
+        """
+        Send a packet to the microcontroller and
+        wait for a reply.
+        :param pkt:
+        :param priority: URGENT packets go out ahead of any queued traffic
+        :return:
+        """
+        return self.submit(pkt, priority).result()
 
     def idle(self):
         """
@@ -180,24 +1268,80 @@ class Stage:
              granularity: float = 0.1,
              fault_on_limit: bool = True):
         """
-        Wait for a motion to finish by sending idle commands
-        until the motor status indicates the motion in complete
+        Wait for a motion to finish.
+        Until a motion is about to finish the status is only checked every
+        granularity seconds, this catches motions cut short by a limit switch.
+        Close to the predicted end of the motion the status is polled densely.
+        Any reply showing the motor has stopped (even one requested by another
+        thread) wakes the waiter immediately.
         :param timeout: Denotes a timeout (0 for none) when the motor motion should be cancelled
-        :param granularity: Denotes how often to check if motor is running
+        :param granularity: Denotes how often to check if motor is running while far from the predicted end
         :param fault_on_limit: Throw assertion failure if motion hit a limit switch
         """
+        start_time = time.monotonic()
+        motion = self.motion
         self.idle()
-        start_time = time.time()
+
+        deadline = motion.deadline if motion else None
         while self.running:
-            if (timeout > 0) and ((time.time() - start_time) > timeout):
+            now = time.monotonic()
+            if (timeout > 0) and ((now - start_time) > timeout):
                 self.stop()
                 raise TimeoutError(f"Motion timed out after {timeout}s")
-            time.sleep(granularity)
+
+            period = granularity
+            if deadline is not None:
+                # Sleep right up to the predicted end, then poll densely
+                period = min(period, max(deadline - self.COMPLETION_LEAD - now, self.COMPLETION_POLL))
+
+            self._motion_done.wait(period)
             self.idle()
 
             if fault_on_limit:
                 assert not self.failure, "Motor request hit a limit switch"
 
+        now = time.monotonic()
+        if deadline is not None and not motion.failed and not motion.stopped and now >= deadline:
+            # Dead time between the predicted end and noticing it, motions
+            # cut short by stop() or ESTOP never get to their predicted end
+            overhead = now - deadline
+            self.stats.moves += 1
+            self.stats.move_overhead_total += overhead
+            self.stats.move_overhead_max = max(self.stats.move_overhead_max, overhead)
+
+        if fault_on_limit:
+            assert not self.failure, "Motor request hit a limit switch"
+
+    def _move(self, pkt: StagePacket):
+        """
+        Send a motion request, the state model plans its timing
+        :param pkt: RELATIVE or ABSOLUTE packet
+        """
+        self._motion_done.clear()
+        try:
+            self.send(pkt)
+        except OSError:
+            # The motor may or may not have started
+            self.state.position = None
+            self._motion_done.set()
+            raise
+
+    def status(self, ttl: Optional[float] = None) -> StageState:
+        """
+        Get the stage state, only talking to the hardware
+        when the cached state is too old or the position is unknown
+        :param ttl: maximum age of the cached state in seconds (defaults to status_ttl)
+        :return: Stage state model
+        """
+        ttl = self.status_ttl if ttl is None else ttl
+
+        self.stats.status_reads += 1
+        if self.state.age() > ttl or self.state.estimate_position() is None:
+            self.stats.status_refreshes += 1
+            self.get_position()
+
+        return self.state
+
     def relative(self, n: int, size: StageStepSize, ignore_limits: bool = False):
         """
         Perform a relative motion
@@ -212,7 +1356,7 @@ class Stage:
             | (StageFlags.MOTOR_IGNORE_LIMITS if ignore_limits else 0)
         )
 
-        self.send(pkt)
+        self._move(pkt)
 
     def absolute(self, n: int, size: StageStepSize = StageStepSize.EIGHTH, ignore_limits: bool = False):
         """
@@ -224,8 +1368,8 @@ class Stage:
         :param size: step size
         :param ignore_limits: Run the motion request even if stuck on a limit switch
         """
-        self.send(StagePacket(StageOpcode.ABSOLUTE, n,
-                              size & 0x0F | (StageFlags.MOTOR_IGNORE_LIMITS if ignore_limits else 0)))
+        self._move(StagePacket(StageOpcode.ABSOLUTE, n,
+                               size & 0x0F | (StageFlags.MOTOR_IGNORE_LIMITS if ignore_limits else 0)))
 
     def home(self, direction: StageDirection, size: StageStepSize):
         """
@@ -247,7 +1391,11 @@ class Stage:
         self.send(StagePacket(StageOpcode.SPEED, hz))
 
     def stop(self):
-        self.send(StagePacket(StageOpcode.STOP))
+        """
+        Cancel the running motion request.
+        Sent on the urgent lane ahead of any queued traffic.
+        """
+        self.send(StagePacket(StageOpcode.STOP), StagePriority.URGENT)
 
     def set_position(self, pos: int):
         """
@@ -312,8 +1460,9 @@ class Stage:
         Set the E-stop software flag
         This will block all motor requests until the flag
         is cleared. This overrides the hardware signal via software.
+        Sent on the urgent lane ahead of any queued traffic.
         """
-        self.send(StagePacket(StageOpcode.EMERGENCY_STOP))
+        self.send(StagePacket(StageOpcode.EMERGENCY_STOP), StagePriority.URGENT)
 
     def emergency_clear(self):
         """
@@ -1,58 +1,329 @@
+import functools
+import itertools
 import logging
-from typing import Optional, List
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, List, Callable, Tuple, Any
+
+import cv2
+import numpy as np
 
 from rit import processing
-from rit.cam import Camera
-from rit.stage import Stage, StageDirection, StageStepSize
+from rit.calibration import StationCalibration
+from rit.cam import Camera, Frame
+from rit.search import AlignmentStats, EdgeNotFoundError, EdgeSearch, EdgeSide, GallopingSearch, LinearSearch
+from rit.stage import Stage, StageDirection, StageStepSize, STEP_EIGHTHS
 
 log = logging.getLogger(__name__)
 
 # Calibrated using GIMP :)
 IM_WIDTH_PER_EIGHTH_STEP = 0.0010059171597633137
 
+# Part of the frame width the card edge is reliably found across
+EDGE_SEARCH_WIDTH = 0.8
+
+# Eighth steps between the two limit switches
+STAGE_TRAVEL = 16000
+
+
+class MotionSavings:
+    """
+    Motion avoided by the planner compared to always
+    overshooting and executing every move as requested.
+    Steps are counted in eighth steps.
+    """
+
+    steps: int
+    moves: int
+    time: float
+
+    def __init__(self):
+        self.steps = 0
+        self.moves = 0
+        self.time = 0.0
+
+    def add(self, steps: int, moves: int, time_: float):
+        self.steps += steps
+        self.moves += moves
+        self.time += time_
+
+    def dict(self) -> dict:
+        return {
+            "steps": self.steps,
+            "moves": self.moves,
+            "time": self.time,
+        }
+
+
+class MotionPlanner:
+    """
+    Plans stage moves so that every position the cameras capture at
+    is reached travelling in the same direction, keeping the lead
+    screw backlash taken up.
+
+    The overshoot past the target is only added when the final leg
+    would travel the wrong way, or when it is too short to take up the
+    backlash and the stage may have last travelled the other way.
+    Requested moves are queued and only executed by settle(), so
+    consecutive moves with no capture in between become a single one.
+    """
+
+    # Distance past the target used to take up backlash, in steps of the requested size
+    OVERSHOOT = 300
+
+    stage: Stage
+    overshoot: int
+    total: MotionSavings
+    card: MotionSavings
+
+    def __init__(self, stage: Stage, overshoot: int = OVERSHOOT):
+        self.stage = stage
+        self.overshoot = overshoot
+        self.total = MotionSavings()
+        self.card = MotionSavings()
+
+        # Direction of the last approach (1 from negative, -1 from positive, 0 unknown)
+        # along with the stage move count it was made at
+        self._direction = 0
+        self._direction_moves = 0
+
+        # Pending target in eighth steps and the motion the
+        # requests making it up would have cost on their own
+        self._target: Optional[int] = None
+        self._size = StageStepSize.EIGHTH
+        self._from_negative = True
+        self._requested_steps = 0
+        self._requested_eighths = 0
+        self._requested_moves = 0
+
+    @property
+    def pending(self) -> bool:
+        return self._target is not None
+
+    def start_card(self):
+        """
+        Start counting savings for a new card
+        """
+        self.card = MotionSavings()
+
+    def _position(self) -> int:
+        if self._target is not None:
+            return self._target
+        return self.stage.status().position
+
+    def _queue(self, target: int, size: StageStepSize, from_negative: bool, steps: int, moves: int):
+        self._target = target
+        self._size = size
+        self._from_negative = from_negative
+        self._requested_steps += steps
+        self._requested_eighths += steps * STEP_EIGHTHS[size]
+        self._requested_moves += moves
+
+    def move_to(self,
+                pos: int,
+                size: StageStepSize = StageStepSize.EIGHTH,
+                from_negative: bool = True):
+        """
+        Queue an approach to an absolute position
+        :param pos: position in eighth steps
+        :param size: step size to move with
+        :param from_negative: approach travelling forward (from lower positions)
+        """
+        eighths = STEP_EIGHTHS[size]
+        sign = 1 if from_negative else -1
+        start = self._position()
+
+        # Overshoot then approach
+        overshoot = pos - sign * self.overshoot * eighths
+        self._queue(pos, size, from_negative,
+                    abs(overshoot - start) // eighths + self.overshoot, 2)
+
+    def move_by(self,
+                n: int,
+                size: StageStepSize = StageStepSize.EIGHTH,
+                from_negative: bool = True,
+                approach: bool = True):
+        """
+        Queue a relative move
+        :param n: number of steps
+        :param size: step size
+        :param from_negative: approach travelling forward (from lower positions)
+        :param approach: the move was previously made with an overshoot
+            rather than as a plain relative move, only used to count savings
+        """
+        start = self._position()
+        if approach:
+            self._queue(start + n * STEP_EIGHTHS[size], size, from_negative,
+                        abs(n - (1 if from_negative else -1) * self.overshoot) + self.overshoot, 2)
+        else:
+            self._queue(start + n * STEP_EIGHTHS[size], size, from_negative, abs(n), 1)
+
+    def travel(self,
+               start: int,
+               target: int,
+               size: StageStepSize = StageStepSize.EIGHTH,
+               from_negative: bool = True) -> int:
+        """
+        Estimate how far an approach would move the stage, in eighth steps
+        The backlash is assumed taken up when already travelling the right way.
+        :param start: position the approach starts from in eighth steps
+        :param target: position to approach in eighth steps
+        :param size: step size to move with
+        :param from_negative: approach travelling forward (from lower positions)
+        """
+        delta = target - start
+        if delta * (1 if from_negative else -1) >= 0:
+            return abs(delta)
+        return abs(delta) + 2 * self.overshoot * STEP_EIGHTHS[size]
+
+    def travelled(self, from_negative: bool = True):
+        """
+        Record a move made outside the planner, which left
+        the backlash taken up in the direction it travelled
+        :param from_negative: the move travelled forward
+        """
+        self._direction = 1 if from_negative else -1
+        self._direction_moves = self.stage.state.moves
+
+    def discard(self):
+        """
+        Drop the queued moves, nothing needs the stage to get there
+        """
+        if self._target is not None:
+            self._save(0, 0, 0)
+        self._target = None
+
+    def settle(self):
+        """
+        Execute the queued moves and wait for the stage to get there
+        """
+        if self._target is None:
+            return
+
+        target = self._target
+        size = self._size
+        sign = 1 if self._from_negative else -1
+        overshoot = self.overshoot * STEP_EIGHTHS[size]
+
+        start = self.stage.status().position
+        delta = target - start
+
+        # Any move made behind the planner's back loses track of the backlash
+        taken_up = self._direction == sign and self._direction_moves == self.stage.state.moves
+
+        self._target = None
+        self._direction = 0
+
+        if delta * sign > 0 and (taken_up or abs(delta) >= overshoot):
+            # Already travelling the right way
+            path = [target]
+        elif delta == 0 and taken_up:
+            path = []
+        else:
+            path = [target - sign * overshoot, target]
+
+        steps = 0
+        for pos in path:
+            steps += abs(pos - start) // STEP_EIGHTHS[size]
+            start = pos
+            self.stage.absolute(pos, size)
+            self.stage.wait()
+
+        self._direction = sign
+        self._direction_moves = self.stage.state.moves
+        self._save(steps, steps * STEP_EIGHTHS[size], len(path))
+
+    def _save(self, steps: int, eighths: int, moves: int):
+        # The motor takes one step per tick whatever the step size,
+        # a move also costs sending it and noticing it finished
+        stats = self.stage.stats
+        move_cost = 2 * stats.round_trip_mean + stats.move_overhead_mean
+
+        saved_moves = self._requested_moves - moves
+        saved_time = (self._requested_steps - steps) / self.stage.step_rate + saved_moves * move_cost
+        saved_eighths = self._requested_eighths - eighths
+
+        self.total.add(saved_eighths, saved_moves, saved_time)
+        self.card.add(saved_eighths, saved_moves, saved_time)
+
+        self._requested_steps = 0
+        self._requested_eighths = 0
+        self._requested_moves = 0
+
+    def dict(self) -> dict:
+        return {
+            "card": self.card.dict(),
+            "total": self.total.dict(),
+        }
+
 
 class System:
     stage: Stage
     hq_cam: Optional[Camera]
     aux_cam: Optional[Camera]
+    planner: MotionPlanner
+    edge_range: Optional[Tuple[int, int]]
+    calibration: Optional[StationCalibration]
+    last_edge: Optional[int]
+    align_stats: Optional[AlignmentStats]
 
     def __init__(self,
                  stage: Stage,
                  hq_cam: Optional[Camera],
-                 aux_cam: Optional[Camera]):
+                 aux_cam: Optional[Camera],
+                 edge_range: Optional[Tuple[int, int]] = None,
+                 calibration: Optional[StationCalibration] = None):
+        """
+        :param edge_range: eighth steps from the home limit the card holder
+            puts the card edge between, None if unknown
+        :param calibration: where alignments are kept between runs
+        """
         self.stage = stage
         self.hq_cam = hq_cam
         self.aux_cam = aux_cam
+        self.planner = MotionPlanner(stage)
+        self.edge_range = edge_range
+        self.calibration = calibration
+        self.last_edge = calibration.edge if calibration else None
+        self.align_stats = None
+
+        # Grey level of the frames at home, what is not the card
+        self._background: Optional[float] = calibration.background if calibration else None
 
     def approach_relative(self,
                           n: int,
                           size: StageStepSize = StageStepSize.EIGHTH,
                           from_negative: bool = True):
-        if from_negative:
-            self.stage.relative(n - 300, size)
-            self.stage.wait(granularity=0.05)
-            self.stage.relative(300, size)
-            self.stage.wait(granularity=0.05)
-        else:
-            self.stage.relative(n + 300, size)
-            self.stage.wait(granularity=0.05)
-            self.stage.relative(-300, size)
-            self.stage.wait(granularity=0.05)
+        self.planner.move_by(n, size, from_negative)
+        self.planner.settle()
 
     def approach_absolute(self,
                           pos: int,
                           size: StageStepSize = StageStepSize.EIGHTH,
                           from_negative: bool = True):
-        if from_negative:
-            self.stage.absolute(pos - 300, size)
-            self.stage.wait(granularity=0.05)
-        else:
-            self.stage.absolute(pos + 300, size)
-            self.stage.wait(granularity=0.05)
+        self.planner.move_to(pos, size, from_negative)
+        self.planner.settle()
+
+    def edge_search(self,
+                    coarse_n: int = 400,
+                    coarse_size: StageStepSize = StageStepSize.QUARTER) -> EdgeSearch:
+        """
+        Where align looks for the card edge by default
+        Around where the edge was last aligned, or anywhere edge_range puts it,
+        and every coarse_n steps of coarse_size from the home limit otherwise.
+        Neither takes frames further than half a frame short of the far limit,
+        which leaves room for homing having stepped off the near one.
+        """
+        window = int(EDGE_SEARCH_WIDTH / IM_WIDTH_PER_EIGHTH_STEP)
+        end = STAGE_TRAVEL - window // 2
+        lo, hi = self.edge_range if self.edge_range else (0, end)
 
-        self.stage.absolute(pos, size)
-        self.stage.wait(granularity=0.05)
+        if self.last_edge is not None:
+            return GallopingSearch(window, self.last_edge, lo, hi)
+        if self.edge_range:
+            return GallopingSearch(window, (lo + hi) // 2, lo, hi)
+        return LinearSearch(window, coarse_n * STEP_EIGHTHS[coarse_size], end)
 
     def align(self,
               coarse_n: int = 400,
@@ -62,26 +333,215 @@ class System:
               standard_deviation_threshold: float = 50.0,
               vertical_rad_threshold: float = 0.1,
               step_delay: float = 0.1,
-              debug: bool = False):
+              debug: bool = False,
+              search: Optional[EdgeSearch] = None,
+              min_contrast: float = 20.0,
+              verify: bool = True,
+              max_drift: int = 100):
+        """
+        Align the stage to the card edge
+        While the stage is still calibrated by the last alignment, a single
+        frame at the zeroed position checks the edge is still there. Otherwise,
+        or if it drifted further than max_drift, the stage homes and then takes
+        frames where the search picks until one shows the edge. The fine motion
+        centres the edge straight from where it is in that frame. Frames without
+        the edge are of the card if they differ from the background seen at home.
+        :param search: where to look for the edge, edge_search(coarse_n, coarse_size) if None
+        :param min_contrast: grey levels the card differs from the background by
+        :param verify: check the last alignment before searching
+        :param max_drift: eighth steps the edge may have moved since the last alignment
+        """
+        start = time.monotonic()
+        search = search or self.edge_search(coarse_n, coarse_size)
+        stats = AlignmentStats(search.name)
+        detect = functools.partial(processing.detect_card_edge_pyramid,
+                                   laplacian_threshold=laplacian_threshold,
+                                   num_points_threshold=num_points_threshold,
+                                   standard_deviation_threshold=standard_deviation_threshold,
+                                   vertical_rad_threshold=vertical_rad_threshold,
+                                   debug=debug,
+                                   min_contrast=min_contrast)
 
         self.stage.speed(1500)
 
+        try:
+            # Start the camera in live stream mode, edges are detected
+            # straight on the Y plane of the lores stream
+            self.hq_cam.start_align()
+
+            if verify and self.last_edge is not None and self.stage.status().calibrated:
+                # The last alignment zeroed the position on the edge
+                stats.moves += 1
+                stats.travel += abs(self.stage.status().position)
+                self.approach_absolute(0, StageStepSize.EIGHTH)
+
+                img = self.hq_cam.acquire_luma(settle_timeout=step_delay)
+                stats.iterations += 1
+                edge_position, img, confidence = detect(img)
+
+                if debug:
+                    yield img
+
+                drift = None if edge_position is None else \
+                    int(round((0.5 - edge_position) / IM_WIDTH_PER_EIGHTH_STEP))
+                if drift is not None and abs(drift) <= max_drift:
+                    stats.strategy = "verify"
+                    return self._center_edge(edge_position, confidence, -self.last_edge,
+                                             stats, start, step_delay, detect, drift)
+
+                log.info("Card edge %s since the last alignment, searching from home",
+                         "lost" if drift is None else f"moved {drift} eighth steps")
+
+            # Move to the start of the stage
+            self.stage.home(StageDirection.BACKWARD, StageStepSize.QUARTER)
+            self.stage.wait(fault_on_limit=False, granularity=0.05)
+
+            # Homing ended on a limit switch, learn where we are
+            home = self.stage.status(ttl=0).position
+            position = 0
+
+            background = None
+            if search.uses_side:
+                # Far enough from the card to only see background
+                background = self._background = cv2.mean(self.hq_cam.acquire_luma(settle_timeout=step_delay))[0]
+
+            while True:
+                target = search.next()
+                if target is None:
+                    raise EdgeNotFoundError(f"No card edge found after {stats.iterations} frames")
+
+                self.stage.absolute(home + target, coarse_size)
+                self.stage.wait(granularity=0.05)
+                stats.moves += 1
+                stats.travel += abs(target - position)
+                position = target
+
+                # Capture once the image stops moving, at most step_delay later
+                img = self.hq_cam.acquire_luma(settle_timeout=step_delay)
+                stats.iterations += 1
+                level = cv2.mean(img)[0]
+                edge_position, img, confidence = detect(img)
+
+                if debug:
+                    yield img
+
+                if edge_position is None:
+                    if background is None:
+                        # Stepping forward from home, anything before the edge is background
+                        self._background = level
+                        search.update(position, EdgeSide.BEFORE)
+                    else:
+                        search.update(position, EdgeSide.AFTER if abs(level - background) > min_contrast
+                                      else EdgeSide.BEFORE)
+                    continue
+
+                search.update(position, EdgeSide.EDGE)
+                return self._center_edge(edge_position, confidence, home, stats, start, step_delay, detect)
+        finally:
+            # Stop the camera, even on error
+            self.hq_cam.stop()
+
+    def _center_edge(self,
+                     edge_position: float,
+                     confidence: float,
+                     home: int,
+                     stats: AlignmentStats,
+                     start: float,
+                     step_delay: float,
+                     detect: Callable,
+                     drift: Optional[int] = None) -> np.ndarray:
+        """
+        Fine motion of align, from where the edge is in the frame
+        :param home: position of the home limit
+        :return: final frame
+        """
+        # Found the edge of the card
+        # Perform the fine motion
+        fine_step = (0.5 - edge_position) / IM_WIDTH_PER_EIGHTH_STEP
+        log.info("Edge position @%.2f, confidence %.2f", edge_position, confidence)
+        log.info("Performing %d steps for fine motion", int(round(fine_step)))
+
+        self.approach_relative(int(fine_step), StageStepSize.EIGHTH)
+
+        # Get the final stage position
+        img = self.hq_cam.acquire_luma(settle_timeout=step_delay)
+        new_edge_position, img, _ = detect(img)
+
+        log.info("Card position is now %.2f", new_edge_position if new_edge_position is not None else -1)
+        stats.edge = self.stage.status(ttl=0).position - home
+
+        # Sets the initial calibration value
+        # Sets the stage calibration flag
+        self.stage.set_position(0)
+
+        self._aligned(stats, start, drift)
+        return img
+
+    def _aligned(self, stats: AlignmentStats, start: float, drift: Optional[int] = None):
+        """
+        Remember where the edge was for the next alignment
+        """
+        stats.time = time.monotonic() - start
+        self.align_stats = stats
+        self.last_edge = stats.edge
+        if self.calibration:
+            self.calibration.update(stats.edge, self._background, drift)
+
+        log.info("Aligned after %d frames in %.2fs (%s)", stats.iterations, stats.time, stats.strategy)
+
+    def scan_align(self,
+                   scan_n: int = 8000,
+                   scan_size: StageStepSize = StageStepSize.QUARTER,
+                   scan_speed: int = 1000,
+                   speed: int = 1500,
+                   stop_margin: int = 100,
+                   laplacian_threshold: float = 10.0,
+                   num_points_threshold: int = 100,
+                   standard_deviation_threshold: float = 50.0,
+                   vertical_rad_threshold: float = 0.1,
+                   settle_timeout: float = 0.1,
+                   debug: bool = False):
+        """
+        Align the stage to the card edge in a single sweep
+        The stage moves at a constant speed while the camera streams, each
+        frame is matched to the dead reckoned stage position at its exposure
+        time. Every frame showing the edge refines the position that would
+        centre it, the stage stops once just short of it and the final
+        approach continues in the direction of the sweep.
+        :param scan_n: longest sweep in steps of scan_size
+        :param scan_size: step size of the sweep
+        :param scan_speed: step rate of the sweep, slow enough to not blur the edge
+        :param speed: step rate restored for the final approach
+        :param stop_margin: stop this many eighth steps before the edge to leave room for the stop latency
+        :param settle_timeout: wait up to this long for the final image to settle
+        """
+        start = time.monotonic()
+        stats = AlignmentStats("scan")
+        self.stage.speed(speed)
+
         # Move to the start of the stage
         self.stage.home(StageDirection.BACKWARD, StageStepSize.QUARTER)
         self.stage.wait(fault_on_limit=False, granularity=0.05)
+        self.stage.speed(scan_speed)
 
         try:
-            # Start the camera in live stream mode
-            self.hq_cam.start(still=False)
+            self.hq_cam.start_align()
 
-            while True:
-                self.stage.relative(coarse_n, coarse_size)
-                self.stage.wait(granularity=0.05)
+            # Homing ended on a limit switch, learn where we are before the sweep
+            home = self.stage.status().position
+            self.stage.relative(scan_n, scan_size)
+            motion = self.stage.motion
+            deadline = motion.deadline if motion else time.monotonic()
 
-                time.sleep(step_delay)
+            target = None
+            frames = 0
+            while True:
+                img, t = self.hq_cam.acquire_timed_luma()
+                frames += 1
 
-                img = self.hq_cam.acquire_array()
-                edge_position, img = processing.detect_card_edge(
+                # Where the stage was when this frame was exposed
+                position = motion.position_at(t) if motion else self.stage.state.estimate_position(t)
+                edge_position, img, _ = processing.detect_card_edge_pyramid(
                     img, laplacian_threshold,
                     num_points_threshold,
                     standard_deviation_threshold,
@@ -91,36 +551,48 @@ class System:
                 if debug:
                     yield img
 
-                if edge_position is not None:
-                    # Found the edge of the card
-                    # Perform the fine motion
-                    fine_step = (0.5 - edge_position) / IM_WIDTH_PER_EIGHTH_STEP
-                    log.info("Edge position @%.2f", edge_position)
-                    log.info("Performing %d steps for fine motion", int(round(fine_step)))
+                if edge_position is not None and position is not None:
+                    # Frames closer to the centre are more accurate, keep the latest
+                    target = position + int(round((0.5 - edge_position) / IM_WIDTH_PER_EIGHTH_STEP))
+                    log.debug("Edge @%.3f at position %d, target %d", edge_position, position, target)
 
-                    print(fine_step)
-                    self.approach_relative(int(fine_step), StageStepSize.EIGHTH)
+                now = time.monotonic()
+                current = motion.position_at(now) if motion else None
+                if target is not None and (current is None or current >= target - stop_margin):
+                    break
+                if now > deadline:
+                    self.stage.wait(fault_on_limit=False)
+                    raise EdgeNotFoundError(f"No card edge found after {frames} frames")
 
-                    time.sleep(step_delay)
+            self.stage.stop()
+            self.stage.wait(fault_on_limit=False)
+            self.stage.speed(speed)
+            log.info("Card edge found after %d frames, approaching %d", frames, target)
+            stats.iterations = frames
+            stats.moves = 1
+            stats.travel = self.stage.status(ttl=0).position - home
 
-                    # Get the final stage position
-                    img = self.hq_cam.acquire_array()
-                    new_edge_position, img = processing.detect_card_edge(
-                        img, laplacian_threshold,
-                        num_points_threshold,
-                        standard_deviation_threshold,
-                        vertical_rad_threshold, debug
-                    )
+            # The sweep took up the backlash travelling forward
+            self.planner.travelled(from_negative=True)
+            self.approach_absolute(target, StageStepSize.EIGHTH)
 
-                    log.info("Card position is now %.2f", new_edge_position if new_edge_position is not None else -1)
+            img = self.hq_cam.acquire_luma(settle_timeout=settle_timeout)
+            new_edge_position, img, _ = processing.detect_card_edge_pyramid(
+                img, laplacian_threshold,
+                num_points_threshold,
+                standard_deviation_threshold,
+                vertical_rad_threshold, debug
+            )
+            log.info("Card position is now %.2f", new_edge_position if new_edge_position is not None else -1)
+            stats.edge = self.stage.status(ttl=0).position - home
 
-                    # Sets the initial calibration value
-                    # Sets the stage calibration flag
-                    self.stage.set_position(0)
+            # Sets the initial calibration value
+            # Sets the stage calibration flag
+            self.stage.set_position(0)
 
-                    return img
+            self._aligned(stats, start)
+            return img
         finally:
-            # Stop the camera, even on error
             self.hq_cam.stop()
 
     def single_card(self,
@@ -130,18 +602,207 @@ class System:
                     stage_offsets: List[int] = (),
                     step_size: StageStepSize = StageStepSize.EIGHTH):
         self.stage.speed(speed)
-        self.approach_absolute(initial_position, step_size)
+        self.planner.start_card()
+
+        # Always end up at the initial position, even without sensors to capture
+        self.planner.move_to(initial_position, step_size)
+        self.planner.settle()
 
         with self.hq_cam:
             for i, offset in enumerate(stage_offsets):
-                # This delay is used to allow the system to
-                # stabilize before we acquire an image
-                if delay > 0:
-                    time.sleep(delay)
+                self.planner.settle()
 
-                yield self.hq_cam.acquire_array()
+                # Allow the system to stabilize before we acquire an image,
+                # delay is only the upper bound on waiting for it
+                yield self.hq_cam.acquire_array(settle_timeout=delay)
                 log.info("Captured %s / %s images", i + 1, len(stage_offsets))
 
-                # Move to the next sensor and wait for the motion to finish
-                self.stage.relative(offset, step_size)
-                self.stage.wait(granularity=0.05)
+                # Move to the next sensor, this only happens
+                # once the next image is requested
+                self.planner.move_by(offset, step_size, approach=False)
+
+        # Nothing is captured after the last move
+        self.planner.discard()
+        log.info("Motion planner saved %(steps)d steps and %(moves)d moves (%(time).2fs)",
+                 self.planner.card.dict())
+
+
+class CaptureScheduler:
+    """
+    Captures cards with both cameras kept running.
+    The stage is driven from the calling thread, which only waits for
+    frames to be captured. HQ frames are converted on one worker thread
+    while the stage moves on, the AUX frame is captured and read on another.
+    The card ID is read either before or after the sensors, whichever
+    makes the stage travel less from where it is.
+    """
+
+    system: System
+    cards: int
+    card_id_first: int
+
+    def __init__(self, system: System):
+        self.system = system
+        self.cards = 0
+        self.card_id_first = 0
+
+        self._hq = ThreadPoolExecutor(1, thread_name_prefix="hq-capture")
+        self._aux = ThreadPoolExecutor(1, thread_name_prefix="aux-capture")
+
+    def start(self):
+        """
+        Start both cameras, their sessions keep them running between cards
+        The AUX camera only reads out its region of interest if one is set.
+        """
+        self.system.hq_cam.start()
+        self.system.aux_cam.start_roi()
+
+    def stop(self):
+        self.system.hq_cam.stop()
+        self.system.aux_cam.stop()
+
+    def close(self):
+        """
+        Wait for the outstanding frames and shut down the worker threads
+        """
+        self._hq.shutdown()
+        self._aux.shutdown()
+
+    def order(self,
+              start: int,
+              sensors: List[int],
+              size: StageStepSize,
+              card_id_position: int,
+              card_id_size: StageStepSize) -> bool:
+        """
+        Pick the capture order of a card
+        :param start: stage position in eighth steps
+        :param sensors: sensor positions in eighth steps, in capture order
+        :param size: step size the sensors are approached with
+        :param card_id_position: card ID position in eighth steps
+        :param card_id_size: step size the card ID is approached with
+        :return: True when reading the card ID first makes the stage travel less
+        """
+        planner = self.system.planner
+        span = sum(abs(b - a) for a, b in zip(sensors, sensors[1:]))
+
+        sensors_first = (planner.travel(start, sensors[0], size) + span
+                         + planner.travel(sensors[-1], card_id_position, card_id_size))
+        card_id_first = (planner.travel(start, card_id_position, card_id_size)
+                         + planner.travel(card_id_position, sensors[0], size) + span)
+
+        log.debug("Card travel %d eighth steps sensors first, %d card ID first", sensors_first, card_id_first)
+        return card_id_first < sensors_first
+
+    def run(self,
+            initial_position: int,
+            stage_offsets: List[int],
+            step_size: StageStepSize,
+            delay: float,
+            card_id_position: int,
+            card_id_size: StageStepSize,
+            on_frame: Callable[[int, Optional[Frame]], Any],
+            on_card_id: Callable[[Optional[np.ndarray]], Any],
+            light: Optional[float] = None,
+            card_id_light: Optional[float] = None) -> Tuple[List[Future], Future]:
+        """
+        Capture the sensors and card ID of a card
+        Returns once every frame is captured, the processing may still be running.
+        :param initial_position: position of the first sensor
+        :param stage_offsets: steps from each sensor to the next
+        :param step_size: step size of the sensor moves
+        :param delay: wait up to this long (seconds) for the HQ image to settle
+        :param card_id_position: position the AUX camera reads the card ID at
+        :param card_id_size: step size of the card ID move
+        :param on_frame: called on the HQ thread with the sensor index and frame,
+            which belongs to it from then on and holds a pool buffer until released
+        :param on_card_id: called on the AUX thread with the card ID frame
+        :param light: LED level for the sensors, None to leave it
+        :param card_id_light: LED level for the card ID, None to leave it
+        :return: futures of the on_frame results in sensor order and of the on_card_id result
+        """
+        stage = self.system.stage
+        planner = self.system.planner
+        eighths = STEP_EIGHTHS[step_size]
+
+        # The last offset moves past the final sensor and is never needed
+        sensors = list(itertools.accumulate(
+            [initial_position] + [offset * eighths for offset in stage_offsets[:-1]]
+        )) if stage_offsets else []
+        card_id_first = bool(sensors) and self.order(
+            stage.status().position, sensors, step_size, card_id_position, card_id_size
+        )
+
+        planner.start_card()
+        self.cards += 1
+
+        card_id = None
+        if card_id_first:
+            self.card_id_first += 1
+            card_id = self._read_card_id(card_id_position, card_id_size, card_id_light, on_card_id)
+
+        if light is not None:
+            stage.led_pwm(light)
+
+        frames = []
+        planner.move_to(initial_position, step_size)
+        for i, offset in enumerate(stage_offsets):
+            planner.settle()
+
+            # Only the capture holds up the stage, the
+            # conversion overlaps with the next move
+            frame = self.system.hq_cam.acquire_frame(settle_timeout=delay, convert=False)
+            frames.append(self._hq.submit(self._frame, i, frame, on_frame))
+            log.info("Captured %s / %s images", i + 1, len(stage_offsets))
+
+            planner.move_by(offset, step_size, approach=False)
+
+        if card_id is None:
+            card_id = self._read_card_id(card_id_position, card_id_size, card_id_light, on_card_id)
+        else:
+            planner.discard()
+
+        log.info("Motion planner saved %(steps)d steps and %(moves)d moves (%(time).2fs)",
+                 planner.card.dict())
+        return frames, card_id
+
+    def _read_card_id(self,
+                      position: int,
+                      size: StageStepSize,
+                      light: Optional[float],
+                      on_card_id: Callable[[Optional[np.ndarray]], Any]) -> Future:
+        if light is not None:
+            self.system.stage.led_pwm(light)
+
+        self.system.planner.move_to(position, size)
+        self.system.planner.settle()
+
+        # The stage waits for the capture, not for the card ID to be read
+        captured = threading.Event()
+        future = self._aux.submit(self._card_id, captured, on_card_id)
+        captured.wait()
+        return future
+
+    def _card_id(self, captured: threading.Event, on_card_id: Callable[[Optional[np.ndarray]], Any]):
+        try:
+            img = self.system.aux_cam.acquire_array()
+        finally:
+            captured.set()
+        return on_card_id(img)
+
+    def _frame(self, i: int, frame: Optional[Frame], on_frame: Callable[[int, Optional[Frame]], Any]):
+        if frame is None:
+            return on_frame(i, None)
+
+        self.system.hq_cam.convert_frame(frame, pooled=True)
+        try:
+            return on_frame(i, frame)
+        except BaseException:
+            frame.release()
+            raise
+
+    def dict(self) -> dict:
+        return {
+            "cards": self.cards,
+            "card_id_first": self.card_id_first,
+        }
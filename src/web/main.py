@@ -1,11 +1,12 @@
 import asyncio
 import datetime
+import io
 import logging
 import os
 import shutil
+import socket
 import tempfile
 import threading
-import time
 import typing
 from pathlib import Path
 from queue import Queue
@@ -16,7 +17,7 @@ import numpy as np
 import serial
 
 from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import Response, PlainTextResponse
+from fastapi.responses import Response, PlainTextResponse, StreamingResponse
 
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.background import BackgroundTask
@@ -25,10 +26,14 @@ from starlette.responses import FileResponse
 from starlette.staticfiles import StaticFiles
 
 from rit import processing
-from rit.cam import HqCamera, AuxCamera, Camera
+from rit.broker import FrameBroker
+from rit.calibration import StationCalibration
+from rit.cam import HqCamera, AuxCamera, Camera, CameraMode, CardIdRoi, Frame
+from rit.cam_emulator import CameraEmulator, CardScene, CardIdScene, HQ_SIZE, AUX_SIZE
+from rit.emulator import StageEmulator
 from rit.stage import StageStepSize, Stage
 from rit.storage import Card, Storage
-from rit.system import System
+from rit.system import System, CaptureScheduler
 
 from pydantic import BaseModel
 
@@ -46,14 +51,37 @@ app.add_middleware(
 
 is_dummy = os.getenv("WERFEN_DUMMY")
 serial_file = os.getenv("WERFEN_SERIAL")
+
+# Alignment of this station kept between runs
+calibration = StationCalibration.open(
+    os.getenv("WERFEN_CALIBRATION") or Path(__file__).parents[2] / "data" / f"{socket.gethostname()}.pos")
+
 if is_dummy:
-    system = System(Stage(None), HqCamera(-1), AuxCamera(-1))
+    # The stage emulator runs the firmware model behind a pty, with its
+    # limit switches and motion timing, and the emulated HQ camera serves
+    # a synthetic card at its physical position
+    stage_emulator = StageEmulator()
+    stage_emulator.start()
+    system = System(Stage(stage_emulator.serial()),
+                    HqCamera(-1, backend=CameraEmulator(HQ_SIZE, CardScene(), stage_emulator.physical_position)),
+                    AuxCamera(-1, backend=CameraEmulator(AUX_SIZE, CardIdScene())),
+                    calibration=calibration)
 else:
     if serial_file:
         ser = serial.Serial(serial_file, 115200, timeout=1.0)
     else:
         ser = serial.Serial("/dev/ttyAMA0", 115200, timeout=1.0)
-    system = System(Stage(ser), HqCamera(1), AuxCamera(0))
+    system = System(Stage(ser), HqCamera(1), AuxCamera(0), calibration=calibration)
+
+scheduler = CaptureScheduler(system)
+
+# Every camera access from the endpoints goes through the brokers
+brokers = {
+    "hq": FrameBroker(system.hq_cam),
+    "aux": FrameBroker(system.aux_cam),
+}
+for broker in brokers.values():
+    broker.start()
 
 Encodings = Literal["jpeg", "png", "tiff"]
 Cameras = Literal["hq", "aux"]
@@ -165,41 +193,78 @@ def get_camera(cam_name: Cameras) -> Camera:
 
 
 @app.get("/cam/acquire/{cam_name}", response_class=ImageResponse)
-def cam_acquire(cam_name: Cameras, scale: float = 0.2, encoding: Encodings = "jpeg", start_stop: bool = True):
-    camera = get_camera(cam_name)
+def cam_acquire(cam_name: Cameras, scale: float = 0.2, encoding: Encodings = "jpeg"):
+    # Concurrent requests share a single capture, the camera
+    # session keeps the camera running in still mode between them
+    img = brokers[cam_name].capture(CameraMode.STILL)
 
-    if start_stop:
-        camera.start()
+    # Encode the image if requested
+    return ImageResponse(img, scale=scale, media_type=f"image/{encoding}")
 
-    img = camera.acquire_array()
 
-    if start_stop:
-        camera.stop()
+@app.get("/cam/stream/{cam_name}")
+def cam_stream(cam_name: Cameras, scale: float = 0.5):
+    def frames():
+        # A client falling behind skips frames rather than holding up the others
+        with brokers[cam_name].subscribe(CameraMode.STREAM) as subscription:
+            for img in subscription:
+                img = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)))
+                jpeg = cv2.imencode(".jpg", cv2.cvtColor(img, cv2.COLOR_RGBA2RGB) if img.shape[2] == 4 else img)[1]
+                yield b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + bytes(jpeg) + b"\r\n"
+
+    return StreamingResponse(frames(), media_type="multipart/x-mixed-replace; boundary=frame")
 
-    # Encode the image if requested
-    return ImageResponse(img, scale=scale, media_type=f"image/{encoding}")
+
+@app.get("/cam/broker/{cam_name}")
+def cam_broker(cam_name: Cameras):
+    return brokers[cam_name].dict()
 
 
 @app.get("/cam/preview/start/{cam_name}")
 def preview_start(cam_name: Cameras):
-    camera = get_camera(cam_name)
-    camera.start_preview()
+    with brokers[cam_name].exclusive() as camera:
+        camera.start_preview()
 
 
 @app.get("/cam/preview/stop/{cam_name}")
 def preview_stop(cam_name: Cameras):
-    camera = get_camera(cam_name)
-    camera.stop_preview()
+    with brokers[cam_name].exclusive() as camera:
+        camera.stop_preview()
 
 
 @app.get("/cam/start/{cam_name}")
 def cam_start(cam_name: Cameras):
-    get_camera(cam_name).start()
+    with brokers[cam_name].exclusive() as camera:
+        camera.start()
 
 
 @app.get("/cam/stop/{cam_name}")
 def cam_start(cam_name: Cameras):
-    get_camera(cam_name).stop()
+    with brokers[cam_name].exclusive() as camera:
+        camera.close()
+
+
+@app.get("/cam/frames/{cam_name}")
+def cam_frames(cam_name: Cameras):
+    return get_camera(cam_name).frame_stats.dict()
+
+
+@app.get("/cam/settle/{cam_name}")
+def cam_settle(cam_name: Cameras, threshold: Optional[float] = None):
+    camera = get_camera(cam_name)
+    if threshold is not None:
+        camera.settle_threshold = threshold
+    return {"threshold": camera.settle_threshold, **camera.settle.dict()}
+
+
+@app.get("/cam/session/{cam_name}")
+def cam_session(cam_name: Cameras, keep_alive: Optional[bool] = None):
+    session = get_camera(cam_name).session
+    if keep_alive is not None:
+        session.keep_alive = keep_alive
+        if not keep_alive:
+            session.close()
+    return session.dict()
 
 
 class Status(BaseModel):
@@ -215,16 +280,18 @@ class Status(BaseModel):
 
 
 @app.get("/status", response_model=Status)
-def state_position():
-    position = system.stage.get_position()
+def state_position(ttl: Optional[float] = None):
+    # Served from the host side stage model, only touches
+    # the hardware when the cached state is older than the ttl
+    state = system.stage.status(ttl)
     return {
-        "limit1": system.stage.limit_1,
-        "limit2": system.stage.limit_2,
-        "estop": system.stage.estop,
-        "running": system.stage.running,
-        "led": system.stage.led,
-        "position": position,
-        "calibrated": system.stage.calibrated,
+        "limit1": state.limit_1,
+        "limit2": state.limit_2,
+        "estop": state.estop,
+        "running": state.running,
+        "led": state.led,
+        "position": state.estimate_position() or 0,
+        "calibrated": state.calibrated,
         "hq_preview": system.hq_cam.preview,
         "aux_preview": system.aux_cam.preview,
     }
@@ -277,6 +344,39 @@ def stage_speed(n: int, size: StageStepSizes = "EIGHTH"):
     system.stage.switch_step_off(StageStepSizesMap[size], n)
 
 
+@app.get("/stage/stats")
+def stage_stats():
+    return system.stage.stats.dict()
+
+
+@app.post("/stage/trace/start")
+def stage_trace_start(capacity: int = 65536):
+    system.stage.start_trace(capacity)
+
+
+@app.post("/stage/trace/stop")
+def stage_trace_stop():
+    system.stage.stop_trace()
+
+
+@app.get("/stage/trace")
+def stage_trace():
+    if system.stage.trace is None:
+        raise HTTPException(status_code=404, detail="No trace is being recorded")
+    return system.stage.trace.dict()
+
+
+@app.get("/stage/trace/export")
+def stage_trace_export():
+    if system.stage.trace is None:
+        raise HTTPException(status_code=404, detail="No trace is being recorded")
+
+    f = io.BytesIO()
+    system.stage.trace.export(f)
+    return Response(f.getvalue(), media_type="application/octet-stream",
+                    headers={"Content-Disposition": "attachment; filename=stage-trace.npy"})
+
+
 @app.get("/system/estop")
 def estop(stop: bool):
     if stop:
@@ -323,30 +423,31 @@ async def single_card(
         fids.append(fid)
 
     def execute():
-        system.stage.led_pwm(light_pwm)
-        if buffer:
-            # First gather all the images
-            images = []
-            for image in system.single_card(
-                    initial_position,
-                    delay, speed, stage_offsets,
-                    StageStepSizesMap[step_size]
-            ):
-                images.append(image)
-
-            # Now reply to the futures
-            for i, image in enumerate(images):
-                futures[i].set_result(ImageResponse(image, scale=scale, media_type=f"image/{encoding}"))
-        else:
-            # Reply to the futures as they come
-            # This encodes in-between each step
-            for i, image in enumerate(system.single_card(
-                    initial_position,
-                    delay, speed, stage_offsets,
-                    StageStepSizesMap[step_size]
-            )):
-                futures[i].set_result(ImageResponse(image, scale=scale, media_type=f"image/{encoding}"))
-        system.stage.led_pwm(0)
+        with brokers["hq"].exclusive():
+            system.stage.led_pwm(light_pwm)
+            if buffer:
+                # First gather all the images
+                images = []
+                for image in system.single_card(
+                        initial_position,
+                        delay, speed, stage_offsets,
+                        StageStepSizesMap[step_size]
+                ):
+                    images.append(image)
+
+                # Now reply to the futures
+                for i, image in enumerate(images):
+                    futures[i].set_result(ImageResponse(image, scale=scale, media_type=f"image/{encoding}"))
+            else:
+                # Reply to the futures as they come
+                # This encodes in-between each step
+                for i, image in enumerate(system.single_card(
+                        initial_position,
+                        delay, speed, stage_offsets,
+                        StageStepSizesMap[step_size]
+                )):
+                    futures[i].set_result(ImageResponse(image, scale=scale, media_type=f"image/{encoding}"))
+            system.stage.led_pwm(0)
 
     # Actually execute the request
     # Do this asynchronously
@@ -366,16 +467,49 @@ def system_align(
         num_points_threshold: int = 100,
         standard_deviation_threshold: float = 100.0,
         vertical_rad_threshold: float = 0.5,
-        step_delay: float = 0.2
+        step_delay: float = 0.2,
+        verify: bool = True,
+        max_drift: int = 100
+):
+    with brokers["hq"].exclusive():
+        system.stage.led_pwm(light_pwm)
+        for _ in system.align(coarse_n, StageStepSizesMap[coarse_size],
+                              laplacian_threshold, num_points_threshold,
+                              standard_deviation_threshold,
+                              vertical_rad_threshold, step_delay,
+                              debug=False, verify=verify, max_drift=max_drift):
+            pass
+        system.stage.led_pwm(0)
+
+    return system.align_stats.dict()
+
+
+@app.post("/system/scan_align")
+def system_scan_align(
+        light_pwm: float = 0.2,
+        scan_n: int = 8000,
+        scan_size: StageStepSizes = "QUARTER",
+        scan_speed: int = 1000,
+        laplacian_threshold: float = 12.0,
+        num_points_threshold: int = 100,
+        standard_deviation_threshold: float = 100.0,
+        vertical_rad_threshold: float = 0.5,
+        settle_timeout: float = 0.2
 ):
-    system.stage.led_pwm(light_pwm)
-    for _ in system.align(coarse_n, StageStepSizesMap[coarse_size],
-                          laplacian_threshold, num_points_threshold,
-                          standard_deviation_threshold,
-                          vertical_rad_threshold, step_delay,
-                          debug=False):
-        pass
-    system.stage.led_pwm(0)
+    with brokers["hq"].exclusive():
+        system.stage.led_pwm(light_pwm)
+        try:
+            for _ in system.scan_align(scan_n, StageStepSizesMap[scan_size], scan_speed,
+                                       laplacian_threshold=laplacian_threshold,
+                                       num_points_threshold=num_points_threshold,
+                                       standard_deviation_threshold=standard_deviation_threshold,
+                                       vertical_rad_threshold=vertical_rad_threshold,
+                                       settle_timeout=settle_timeout):
+                pass
+        finally:
+            system.stage.led_pwm(0)
+
+    return system.align_stats.dict()
 
 
 @app.post("/system/debug_align")
@@ -392,20 +526,41 @@ async def system_debug_align(
     fid = sequenced_future_manager.create()
 
     def run_alignment():
-        system.stage.led_pwm(light_pwm)
-        for img in system.align(coarse_n, StageStepSizesMap[coarse_size],
-                                laplacian_threshold, num_points_threshold,
-                                standard_deviation_threshold,
-                                vertical_rad_threshold, step_delay,
-                                debug=True):
-            sequenced_future_manager.put(fid, ImageResponse(img, scale=1))
-        system.stage.led_pwm(0)
+        with brokers["hq"].exclusive():
+            system.stage.led_pwm(light_pwm)
+            for img in system.align(coarse_n, StageStepSizesMap[coarse_size],
+                                    laplacian_threshold, num_points_threshold,
+                                    standard_deviation_threshold,
+                                    vertical_rad_threshold, step_delay,
+                                    debug=True):
+                sequenced_future_manager.put(fid, ImageResponse(img, scale=1))
+            system.stage.led_pwm(0)
         sequenced_future_manager.finish(fid)
 
     threading.Thread(target=run_alignment, daemon=True).start()
     return fid
 
 
+@app.get("/system/align/stats")
+def system_align_stats():
+    return system.align_stats.dict() if system.align_stats else None
+
+
+@app.get("/system/calibration")
+def system_calibration():
+    return system.calibration.dict()
+
+
+@app.get("/system/planner")
+def system_planner():
+    return system.planner.dict()
+
+
+@app.get("/system/scheduler")
+def system_scheduler():
+    return scheduler.dict()
+
+
 @app.post("/system/card_id")
 def system_card_id(
         scale: float = 1,
@@ -416,13 +571,27 @@ def system_card_id(
         position: int = 8200,
         light_level: float = 0,
         step_size: StageStepSizes = "QUARTER",
+        roi: bool = True,
         return_img: bool = True
 ):
     system.approach_absolute(position, size=StageStepSizesMap[step_size])
     system.stage.led_pwm(light_level)
 
-    with system.aux_cam:
-        img = system.aux_cam.acquire_array()
+    with brokers["aux"].exclusive():
+        # Only read out the part of the sensor the card ID is cropped from
+        card_id_roi = system.aux_cam.set_card_id_roi(scale, start_row, end_row, start_col, end_col) if roi else None
+        if card_id_roi is None:
+            system.aux_cam.set_roi(None)
+
+        system.aux_cam.start_roi()
+        try:
+            img = system.aux_cam.acquire_array()
+        finally:
+            system.aux_cam.stop()
+
+    if card_id_roi is not None:
+        card_id, img = card_id_roi.card_id(img)
+    else:
         card_id, img = processing.card_id(img, scale, start_row, end_row, start_col, end_col)
 
     if return_img:
@@ -495,14 +664,15 @@ class SingleCardParameters(BaseModel):
 
 
 class CardIDParameters(BaseModel):
-    scale: float = 1,
-    start_row: int = 1150,
-    end_row: int = 1300,
-    start_col: int = 600,
-    end_col: int = 1250,
-    position: int = 8200,
+    scale: float = 1
+    start_row: int = 1150
+    end_row: int = 1300
+    start_col: int = 600
+    end_col: int = 1250
+    position: int = 8200
     light_level: float = 0
     step_size: StageStepSizes = "QUARTER"
+    roi: bool = True
 
 
 class RunParams(BaseModel):
@@ -561,7 +731,7 @@ async def run(request: RunParams):
         futures.append(future)
         fids.append(fid)
 
-    encoding_queue = Queue[Tuple[int, np.ndarray]]()
+    encoding_queue = Queue[Tuple[int, Frame]]()
 
     acquisition_time = datetime.datetime.now()
     subdir = acquisition_time.strftime(f"%Y-%m-%d-%H-%M-%S-tmp")
@@ -570,70 +740,46 @@ async def run(request: RunParams):
 
     def encode_worker():
         while True:
-            i, img = encoding_queue.get()
+            i, frame = encoding_queue.get()
 
-            if request.sensor.encoding == "jpeg":
-                cv2.imwrite(str(output_path / f"{i}.jpg"), img)
-            elif request.sensor.encoding == "png":
-                cv2.imwrite(str(output_path / f"{i}.png"), img)
-            elif request.sensor.encoding == "tiff":
-                cv2.imwrite(str(output_path / f"{i}.tiff"), img)
+            with frame:
+                if request.sensor.encoding == "jpeg":
+                    cv2.imwrite(str(output_path / f"{i}.jpg"), frame.array)
+                elif request.sensor.encoding == "png":
+                    cv2.imwrite(str(output_path / f"{i}.png"), frame.array)
+                elif request.sensor.encoding == "tiff":
+                    cv2.imwrite(str(output_path / f"{i}.tiff"), frame.array)
 
             encoding_queue.task_done()
 
     # Boot up the encoder worker
     threading.Thread(target=encode_worker, daemon=True).start()
 
-    def execute():
-        # Run all the sensor captures
-        # Start up both cameras to reduce startup overhead
-        try:
-            system.hq_cam.start()
-
-            system.stage.led_pwm(request.sensor.light_pwm)
-
-            system.stage.speed(request.sensor.speed)
-            system.approach_absolute(request.sensor.initial_position, size=StageStepSizesMap[request.sensor.step_size])
-            for i, pos in enumerate(request.sensor.stage_offsets):
-                if request.sensor.delay > 0:
-                    time.sleep(request.sensor.delay)
-
-                img = system.hq_cam.acquire_array()
-
-                # Queue the image to be encoded and written to disk
-                encoding_queue.put((i, img))
-
-                log.info("Acquired %d/%d", i + 1, len(request.sensor.stage_offsets))
-
-                # No need to buffer since we are encoding with preview size
-                futures[i].set_result(ImageResponse(img, scale=request.sensor.scale))
-
-                # Move to the next image
-                system.stage.relative(
-                    pos,
-                    StageStepSizesMap[request.sensor.step_size],
-                )
-                system.stage.wait(granularity=0.05)
-
-            # Move to where the out camera can take an image
-            # (Move quickly)
-            log.info("Detecting card ID")
-            system.stage.led_pwm(request.card_id.light_level)
-            system.approach_absolute(request.card_id.position, size=StageStepSizesMap[request.card_id.step_size])
-
-            # Save images and files to disk
-            # Do this while we wait for the card to move to Aux position
-            card = Card(
-                card_id="tmp",
-                stage_offsets=request.sensor.stage_offsets,
-                acquisition_time=acquisition_time,
-                subdir_path=subdir,
-                image_format=request.sensor.encoding
-            )
+    def on_frame(i: int, frame: Frame):
+        # No need to buffer since we are encoding with preview size
+        # (the response is rendered right away)
+        futures[i].set_result(ImageResponse(frame.array, scale=request.sensor.scale))
+
+        # Queue the image to be encoded and written to disk,
+        # the encoder hands the buffer back to the pool
+        encoding_queue.put((i, frame))
+
+    # The AUX camera only reads out the card ID region
+    card_id_roi = None
+    if request.card_id.roi:
+        card_id_roi = CardIdRoi(
+            AuxCamera.STILL_SIZE,
+            request.card_id.scale,
+            request.card_id.start_row,
+            request.card_id.end_row,
+            request.card_id.start_col,
+            request.card_id.end_col
+        )
 
-            # Grab an aux image and process it
-            with system.aux_cam:
-                card_id_img = system.aux_cam.acquire_array()
+    def on_card_id(card_id_img: np.ndarray) -> str:
+        if card_id_roi is not None:
+            card_id, card_id_img_proc = card_id_roi.card_id(card_id_img)
+        else:
             card_id, card_id_img_proc = processing.card_id(
                 card_id_img,
                 request.card_id.scale,
@@ -643,24 +789,62 @@ async def run(request: RunParams):
                 request.card_id.end_col
             )
 
-            # This encoding should be pretty fast since the image is tiny
-            cv2.imwrite(str(output_path / f"card_id.png"), card_id_img_proc)
-            with (output_path / f"card_id.gt.txt").open("w+") as f:
-                f.write(card_id)
+        # This encoding should be pretty fast since the image is tiny
+        cv2.imwrite(str(output_path / f"card_id.png"), card_id_img_proc)
+        with (output_path / f"card_id.gt.txt").open("w+") as f:
+            f.write(card_id)
 
-            # Write to the listings file
-            Storage.open(mount_point_path).add_card(card)
+        futures[-2].set_result(ImageResponse(card_id_img_proc, scale=1))
+        return card_id
 
-            # Resolve the final future
-            futures[-2].set_result(ImageResponse(card_id_img_proc, scale=1))
+    def execute():
+        # Nothing else touches the cameras until the card is done
+        with brokers["hq"].exclusive(), brokers["aux"].exclusive():
+            if card_id_roi is not None:
+                system.aux_cam.set_roi(card_id_roi.region, card_id_roi.size)
+            else:
+                system.aux_cam.set_roi(None)
+
+            # Both cameras stay running, the card ID is read before or
+            # after the sensors depending on where the stage is
+            try:
+                scheduler.start()
+
+                system.stage.speed(request.sensor.speed)
+                frames, card_id = scheduler.run(
+                    request.sensor.initial_position,
+                    request.sensor.stage_offsets,
+                    StageStepSizesMap[request.sensor.step_size],
+                    request.sensor.delay,
+                    request.card_id.position,
+                    StageStepSizesMap[request.card_id.step_size],
+                    on_frame, on_card_id,
+                    light=request.sensor.light_pwm,
+                    card_id_light=request.card_id.light_level
+                )
 
-            encoding_queue.join()
+                # Write to the listings file
+                card = Card(
+                    card_id="tmp",
+                    stage_offsets=request.sensor.stage_offsets,
+                    acquisition_time=acquisition_time,
+                    subdir_path=subdir,
+                    image_format=request.sensor.encoding
+                )
+                Storage.open(mount_point_path).add_card(card)
 
-            futures[-1].set_result(rename_card_id(request.path, subdir, card_id))
+                # Raise any error from the camera threads
+                for frame in frames:
+                    frame.result()
+                card_id = card_id.result()
 
-        finally:
-            system.stage.led_pwm(0)
-            system.hq_cam.stop()
+                encoding_queue.join()
+
+                futures[-1].set_result(rename_card_id(request.path, subdir, card_id))
+
+            finally:
+                system.stage.led_pwm(0)
+                scheduler.stop()
 
     # Actually execute the request
     # Do this asynchronously